@@ -0,0 +1,741 @@
+"""
+This module contains the request handling shared by the Flask APP in main.py
+and the ASGI APP in asgi.py. Nothing in it depends on the framework serving
+the request: query parameters are passed in as a mapping and responses are
+returned as encoded documents.
+"""
+
+import functools
+import itertools
+import os
+import typing
+from urllib.parse import urlencode
+
+from feed import FeedGapError, change_feed
+from idempotency import FingerprintReader, fingerprint, idempotency_cache
+from jsonapi_schema import reject_member, validate_operation, validate_operations
+from operations import (
+    LidRegistry,
+    OperationResponse,
+    ScheduledRun,
+    plan,
+    schedule,
+)
+from models import (
+    Model,
+    Transaction,
+    atomic,
+    current_transaction,
+    set_storage,
+    type_to_model,
+)
+from responses import document, encode, json_object, resource_array
+from storage import SQLiteStorage, pk_key
+from streaming import iter_array
+from wal import DurableDictStorage
+
+# The largest page that can be requested with `page[limit]`.
+MAX_PAGE_LIMIT = 1000
+
+# The most operations held in memory at a time when they are streamed
+STREAM_RUN_SIZE = 1000
+
+# Seconds a request to `/changes` waits for a batch, by default and at most
+LONG_POLL_TIMEOUT = 30
+
+# Seconds between the comments that keep a `/changes/stream` connection open
+HEARTBEAT_INTERVAL = 15
+
+ENDPOINTS = [
+    "/                  - GET  - Lists all endpoints in this app",
+    "/operations        - POST - Make atomic operations here",
+    "/bulk/export       - GET  - Exports the resources as NDJSON",
+    "/bulk/import       - POST - Imports resources from NDJSON",
+    "/changes           - GET  - Waits for the batches committed after `after`",
+    "/changes/stream    - GET  - Streams the committed batches as events",
+    "/artists           - GET  - Lists all artists in the DB",
+    "/artists/:id       - GET  - Get an artist's details by it's ID",
+    "/illustrations     - GET  - Lists all illustrations in the DB",
+    "/illustrations/:id - GET  - Get an illustration's details by it's ID",
+    "/users             - GET  - Lists all illustrations in the DB",
+    "/users/:id         - GET  - Get an user's details by it's ID",
+]
+
+
+def setup_storage():
+    """
+    Resources are kept in memory unless `JSONAPI_DATABASE` points to a SQLite
+    database to persist them in. In memory, they are made durable with a
+    write-ahead log if `JSONAPI_WAL_DIRECTORY` is set.
+    """
+
+    if os.environ.get("JSONAPI_DATABASE"):
+        set_storage(SQLiteStorage(os.environ["JSONAPI_DATABASE"]))
+    elif os.environ.get("JSONAPI_WAL_DIRECTORY"):
+        set_storage(DurableDictStorage(os.environ["JSONAPI_WAL_DIRECTORY"]))
+
+
+class QueryParameterError(Exception):
+    def __init__(self, parameter: str, detail: str):
+        self.parameter = parameter
+        self.detail = detail
+
+    def to_document(self) -> bytes:
+        return document(
+            {
+                "errors": encode(
+                    [
+                        {
+                            "status": "400",
+                            "title": "Invalid query parameter",
+                            "detail": self.detail,
+                            "source": {"parameter": self.parameter},
+                        }
+                    ]
+                )
+            }
+        )
+
+
+def get_sparse_fields(
+    args: typing.Mapping[str, str], resource_name: str
+) -> typing.Set[str] | None:
+    """
+    Returns the fields requested with `fields[<resource_name>]`, or `None` if
+    the whole resource object was requested.
+    """
+
+    value = args.get(f"fields[{resource_name}]", None)
+
+    if value is None:
+        return None
+
+    return {field for field in value.split(",") if field}
+
+
+def get_int_parameter(
+    args: typing.Mapping[str, str], parameter: str, default: int
+) -> int:
+    try:
+        value = int(args.get(parameter, default))
+    except ValueError:
+        raise QueryParameterError(parameter, "Must be an integer.")
+
+    if value < 0:
+        raise QueryParameterError(parameter, "Must not be negative.")
+
+    return value
+
+
+def get_includes(
+    args: typing.Mapping[str, str], model: typing.Type[Model]
+) -> typing.List[str]:
+    """
+    Returns the relationships of `model` requested with `include`. Only
+    relationships of the primary resources can be included, not
+    relationships of related resources.
+    """
+
+    value = args.get("include", None)
+
+    if value is None:
+        return []
+
+    includes = [path for path in value.split(",") if path]
+
+    for path in includes:
+        if path not in model.Meta.relationship_fields:
+            raise QueryParameterError(
+                "include",
+                f"`{path}` is not a relationship of `{model.Meta.resource_name}`.",
+            )
+
+    return includes
+
+
+def included_resources(
+    model: typing.Type[Model],
+    instances: typing.Iterable[Model],
+    includes: typing.List[str],
+    args: typing.Mapping[str, str],
+) -> bytes:
+    """
+    Returns the encoded `included` member with the resources related to
+    `instances` through `includes`. The related IDs are collected first, so
+    each related resource is included once and every related model is
+    looked up with a single `get_many()`.
+    """
+
+    # related model -> related pks, in the order they are first referenced
+    related_pks: typing.Dict[typing.Type[Model], typing.Dict[str, None]] = {}
+
+    for instance in instances:
+        for field in includes:
+            pks = related_pks.setdefault(getattr(model, field).model, {})
+            pks.update(dict.fromkeys(instance.related_ids(field)))
+
+    return (
+        b"["
+        + b",".join(
+            related.to_json_bytes(
+                get_sparse_fields(args, related_model.Meta.resource_name)
+            )
+            for related_model, pks in related_pks.items()
+            for related in related_model.get_many(pks.keys())
+        )
+        + b"]"
+    )
+
+
+def get_filters(
+    args: typing.Mapping[str, str], model: typing.Type[Model]
+) -> typing.Dict[str, str]:
+    """
+    Returns the values requested with `filter[<field>]`. Relationships are
+    filtered by the ID of a related resource.
+    """
+
+    filters = {}
+
+    for parameter, value in args.items():
+        if not (parameter.startswith("filter[") and parameter.endswith("]")):
+            continue
+
+        field = parameter[len("filter[") : -1]
+        if field not in model.Meta.filterable_fields:
+            raise QueryParameterError(parameter, f"Can't filter on `{field}`.")
+
+        filters[field] = value
+
+    return filters
+
+
+def get_sort(
+    args: typing.Mapping[str, str], model: typing.Type[Model]
+) -> typing.List[typing.Tuple[str, bool]]:
+    """
+    Returns the `(field, descending)` pairs requested with `sort`, fields
+    prefixed with `-` are sorted in descending order.
+    """
+
+    value = args.get("sort", None)
+
+    if value is None:
+        return []
+
+    sort = []
+
+    for field in value.split(","):
+        descending = field.startswith("-")
+        field = field.removeprefix("-")
+
+        if field not in model.Meta.sortable_fields:
+            raise QueryParameterError("sort", f"Can't sort by `{field}`.")
+
+        sort.append((field, descending))
+
+    return sort
+
+
+def get_export_models(
+    args: typing.Mapping[str, str],
+) -> typing.List[typing.Type[Model]]:
+    """
+    Returns the models of the comma-separated types in `type`, for
+    `/bulk/export`. An empty list means every model.
+    """
+
+    model_list = []
+
+    for resource_name in filter(None, args.get("type", "").split(",")):
+        if resource_name not in type_to_model:
+            raise QueryParameterError("type", f"Unknown type `{resource_name}`.")
+
+        model_list.append(type_to_model[resource_name])
+
+    return model_list
+
+
+def page_link(args: typing.Mapping[str, str], base_url: str, **params) -> str:
+    query = {key: value for key, value in args.items() if not key.startswith("page[")}
+    query.update({f"page[{key}]": value for key, value in params.items()})
+
+    return f"{base_url}?{urlencode(query)}"
+
+
+def paginate(
+    model: typing.Type[Model], args: typing.Mapping[str, str], base_url: str
+) -> typing.Tuple[typing.Iterable[Model], dict | None]:
+    """
+    Applies the `page[offset]`/`page[limit]` or the cursor based
+    `page[after]`/`page[limit]` query parameters to the instances of `model`,
+    filtered and sorted as requested. Returns the instances of the page and
+    the pagination links, or every instance and no links if no page was
+    requested.
+    """
+
+    filters = get_filters(args, model)
+    sort = get_sort(args, model)
+
+    if not any(key.startswith("page[") for key in args.keys()):
+        return model.query(filters, sort), None
+
+    limit = get_int_parameter(args, "page[limit]", MAX_PAGE_LIMIT)
+    if limit == 0 or limit > MAX_PAGE_LIMIT:
+        raise QueryParameterError(
+            "page[limit]", f"Must be between 1 and {MAX_PAGE_LIMIT}."
+        )
+
+    if "page[after]" in args:
+        # The cursor is a primary key, which only orders unsorted pages
+        if sort:
+            raise QueryParameterError("page[after]", "Can't be used with `sort`.")
+
+        # Seeks past the cursor in the storage, even if its resource has been
+        # deleted since
+        after = str(get_int_parameter(args, "page[after]", 0))
+        page = list(model.query(filters, sort, after, limit + 1))
+        links = {"first": page_link(args, base_url, limit=limit)}
+
+        if len(page) > limit:
+            page.pop()
+            links["next"] = page_link(args, base_url, after=page[-1].id, limit=limit)
+
+        return page, links
+
+    offset = get_int_parameter(args, "page[offset]", 0)
+    instances = model.query(filters, sort, limit=offset + limit + 1)
+
+    page = list(itertools.islice(instances, offset, None))
+    links = {"first": page_link(args, base_url, offset=0, limit=limit)}
+
+    if offset > 0:
+        links["prev"] = page_link(
+            args, base_url, offset=max(offset - limit, 0), limit=limit
+        )
+
+    if len(page) > limit:
+        page.pop()
+        links["next"] = page_link(args, base_url, offset=offset + limit, limit=limit)
+
+    return page, links
+
+
+def list_resources(
+    model: typing.Type[Model], args: typing.Mapping[str, str], base_url: str
+) -> typing.Tuple[typing.Iterable[Model], typing.Set[str] | None, dict]:
+    """
+    Lists the instances of `model`, supporting filtering, sorting,
+    pagination, sparse fieldsets and included resources. Returns the
+    instances, the fields to serialize and the encoded members to add after
+    `data`.
+    """
+
+    fields = get_sparse_fields(args, model.Meta.resource_name)
+    includes = get_includes(args, model)
+    instances, links = paginate(model, args, base_url)
+    members = {}
+
+    if includes:
+        # The instances are needed twice
+        instances = list(instances)
+        members["included"] = included_resources(model, instances, includes, args)
+
+    if links is not None:
+        members["links"] = encode(links)
+
+    return instances, fields, members
+
+
+def make_etag(versions: typing.Iterable[int]) -> str:
+    # Weak, the same versions may be encoded differently, e.g. by another
+    # worker without orjson
+    return 'W/"' + "-".join(str(version) for version in versions) + '"'
+
+
+def collection_etag(model: typing.Type[Model], args: typing.Mapping[str, str]) -> str:
+    """
+    Returns the entity tag of a collection response of `model`, made of the
+    versions of `model` and of the included models. It must be taken before
+    the instances are read, so a write in between makes it older than the
+    response rather than newer.
+    """
+
+    included = [getattr(model, field).model for field in get_includes(args, model)]
+
+    return make_etag(related.collection_version() for related in [model, *included])
+
+
+def resource_etag(
+    model: typing.Type[Model], pk: str, args: typing.Mapping[str, str]
+) -> str | None:
+    """
+    Returns the entity tag of the detail response of an instance, made of its
+    version and of the versions of the included models, or `None` if it
+    doesn't exist.
+    """
+
+    version = model.resource_version(pk)
+
+    if version is None:
+        return None
+
+    included = [getattr(model, field).model for field in get_includes(args, model)]
+
+    return make_etag(
+        [version, *(related.collection_version() for related in included)]
+    )
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """
+    Returns whether an `If-None-Match` header lists `etag`, comparing the tags
+    weakly as `If-None-Match` requires.
+    """
+
+    if not if_none_match:
+        return False
+
+    if if_none_match.strip() == "*":
+        return True
+
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+
+    return etag.removeprefix("W/") in tags
+
+
+def get_resource(
+    model: typing.Type[Model], pk: str, args: typing.Mapping[str, str]
+) -> bytes:
+    fields = get_sparse_fields(args, model.Meta.resource_name)
+    includes = get_includes(args, model)
+    instance = model.get(pk=pk)
+    members = {"data": instance.to_json_bytes(fields)}
+
+    if includes:
+        members["included"] = included_resources(model, [instance], includes, args)
+
+    return document(members)
+
+
+def apply_operations(body: dict, scheduled: bool = True) -> bytes:
+    """
+    Validates and applies the operations in a request `body`, returns the
+    document with their results. Raises `ValidationError` if the body is
+    invalid. The operations are scheduled unless `scheduled` is false, see
+    `apply()`.
+    """
+
+    return apply(validate_operations(body, type_to_model), scheduled=scheduled)
+
+
+def apply_operation_stream(stream: typing.BinaryIO) -> bytes:
+    """
+    Like `apply_operations()`, but reads the request body from `stream` and
+    validates and applies each operation as soon as it has been parsed,
+    instead of reading the whole body first. If the body turns out to be
+    invalid, the operations applied so far are rolled back.
+    """
+
+    return apply(
+        (
+            validate_operation(operation, index, type_to_model)
+            for index, operation in enumerate(
+                iter_array(stream, "atomic:operations", other_member=reject_member)
+            )
+        ),
+        max_run=STREAM_RUN_SIZE,
+    )
+
+
+def apply_operations_once(
+    key: str, data: bytes, parse: typing.Callable[[bytes], dict]
+) -> typing.Tuple[bytes, bool]:
+    """
+    Like `apply_operations()` for a request with an `Idempotency-Key`: if a
+    request with the same key and body was committed before, its response is
+    returned without parsing the body (`data`) with `parse()` or applying it
+    again. Returns the response and whether it was replayed.
+    """
+
+    digest = fingerprint(data)
+    entry = idempotency_cache.begin(key)
+
+    if entry is not None:
+        return entry.replay(digest), True
+
+    try:
+        response = apply_operations(parse(data))
+    except BaseException:
+        idempotency_cache.release(key)
+        raise
+
+    idempotency_cache.record(key, digest, response)
+    return response, False
+
+
+def apply_operation_stream_once(
+    key: str, stream: typing.BinaryIO
+) -> typing.Tuple[bytes, bool]:
+    """
+    Like `apply_operations_once()`, but applies the body as it's read like
+    `apply_operation_stream()`. A replayed body is only read to be hashed.
+    """
+
+    reader = FingerprintReader(stream)
+    entry = idempotency_cache.begin(key)
+
+    if entry is not None:
+        return entry.replay(reader.fingerprint()), True
+
+    try:
+        response = apply_operation_stream(reader)
+        digest = reader.fingerprint()
+    except BaseException:
+        idempotency_cache.release(key)
+        raise
+
+    idempotency_cache.record(key, digest, response)
+    return response, False
+
+
+def sequential_runs(
+    operations: typing.Iterable[dict], max_run: int | None = None
+) -> typing.Iterator[ScheduledRun]:
+    """
+    Like `schedule()`, but applies the operations in the order they're in,
+    grouped by `plan()`.
+    """
+
+    # Index of the first operation of the run in the request
+    offset = 0
+
+    for operation_set, op_code, run in plan(operations, max_run):
+        yield operation_set, op_code, run, range(offset, offset + len(run)), None
+        offset += len(run)
+
+
+def apply_runs(runs: typing.Iterable[ScheduledRun]) -> typing.List[OperationResponse]:
+    """
+    Applies `runs`, returns the response of every operation, in the order of
+    the request.
+    """
+
+    lids = LidRegistry()
+    # Index in the request -> response
+    results = {}
+
+    for operation_set, op_code, run, indices, pks in runs:
+        responses = operation_set(lids=lids).apply_many(
+            op_code, run, indices=indices, pks=pks
+        )
+
+        for index, response in zip(indices, responses):
+            results[index] = response
+
+    return [results[index] for index in range(len(results))]
+
+
+def apply(
+    operations: typing.Iterable[dict],
+    max_run: int | None = None,
+    scheduled: bool = False,
+) -> bytes:
+    """
+    Applies `operations`, validated by `validate_operation()`, in a single
+    transaction, returns the document with their results. The resource
+    objects in them are validated as they're applied.
+
+    If `scheduled`, the operations that don't depend on each other are
+    applied together (see `schedule()`). If that fails, the changes are
+    dropped and the operations are applied again in order, so the error
+    reported is the one of the first operation that fails.
+    """
+
+    # Scheduling rolls back on its own, which a transaction that isn't
+    # its own can't do
+    scheduled = scheduled and current_transaction.get() is None
+
+    # Either every operation is applied or none is
+    with atomic() as transaction:
+        results = None
+
+        if scheduled:
+            operations = list(operations)
+            # Scheduling allocates the IDs of the resources added
+            sequences = {
+                model: model.id_sequence.last for model in type_to_model.values()
+            }
+            runs = schedule(operations)
+
+            if runs is not None:
+                try:
+                    results = apply_runs(runs)
+                except Exception:
+                    transaction.rollback()
+
+                    for model, last in sequences.items():
+                        model.id_sequence.rewind(last)
+
+        if results is None:
+            results = apply_runs(sequential_runs(operations, max_run))
+
+        transaction.on_commit(functools.partial(publish_changes, transaction))
+
+    return document(
+        {
+            "atomic:results": resource_array(
+                response.instance
+                for response in results
+                if response.instance is not None
+            )
+        }
+    )
+
+
+def publish_changes(transaction: Transaction):
+    """
+    Called when `transaction` is written: reserves its place in the change
+    feed, so batches are in the order they committed, and publishes the rows
+    it wrote, cascades included, once it's durable. They're listed by type
+    and primary key, whatever order the operations wrote them in.
+    """
+
+    sequence = change_feed.reserve()
+    changes = []
+
+    for model in type_to_model.values():
+        for pk in sorted(transaction.written.get(model, ()), key=pk_key):
+            key = (model, pk)
+            instance = transaction.rows[key]
+
+            if instance is not None:
+                op_code = "add" if key in transaction.created else "update"
+                changes.append(change_entry(op_code, model, pk, instance))
+            elif key not in transaction.created:
+                changes.append(change_entry("remove", model, pk, None))
+
+    transaction.after_commit(
+        lambda durable: change_feed.publish(sequence, changes if durable else [])
+    )
+
+
+def change_entry(
+    op_code: str, model: typing.Type[Model], pk: str, instance: Model | None
+) -> bytes:
+    """
+    Encodes a row a batch added, updated or removed for the change feed,
+    with its resource object after the batch, `null` if it was removed.
+    """
+
+    entry = {"op": op_code, "type": model.Meta.resource_name, "id": pk}
+    data = b"null" if instance is None else instance.to_json_bytes()
+
+    # The cached resource object is spliced in before the closing brace
+    return encode(entry)[:-1] + b',"data":' + data + b"}"
+
+
+def get_feed_parameters(
+    args: typing.Mapping[str, str], last_event_id: str | None = None
+) -> typing.Tuple[int, int, int]:
+    """
+    Returns the sequence to read the batches after, the most batches to
+    return and the seconds to wait for one. The sequence is `after`, the
+    `Last-Event-ID` an event stream is resumed with or, if neither is
+    given, the sequence of the last batch.
+    """
+
+    after = args.get("after", last_event_id)
+
+    if after is None:
+        after = change_feed.last
+    else:
+        try:
+            after = int(after)
+        except ValueError:
+            raise QueryParameterError("after", "Must be an integer.")
+
+    limit = get_int_parameter(args, "limit", MAX_PAGE_LIMIT)
+    if limit == 0 or limit > MAX_PAGE_LIMIT:
+        raise QueryParameterError("limit", f"Must be between 1 and {MAX_PAGE_LIMIT}.")
+
+    timeout = get_int_parameter(args, "timeout", LONG_POLL_TIMEOUT)
+    if timeout > LONG_POLL_TIMEOUT:
+        raise QueryParameterError(
+            "timeout", f"Must not be larger than {LONG_POLL_TIMEOUT}."
+        )
+
+    return after, limit, timeout
+
+
+def changes_document(
+    batches: typing.List[typing.Tuple[int, bytes]], last: int
+) -> bytes:
+    """
+    Returns the document answering a long poll, the batches and the sequence
+    to poll after next.
+    """
+
+    return document(
+        {
+            "meta": json_object(
+                {
+                    "batches": b"[" + b",".join(batch for _, batch in batches) + b"]",
+                    "last": encode(last),
+                }
+            )
+        }
+    )
+
+
+def read_changes(args: typing.Mapping[str, str]) -> bytes:
+    """
+    Returns the batches committed after `after`, waiting up to `timeout`
+    seconds for one if there are none yet (long polling).
+    """
+
+    after, limit, timeout = get_feed_parameters(args)
+
+    return changes_document(*change_feed.wait(after, limit, timeout))
+
+
+def change_event(sequence: int, batch: bytes) -> bytes:
+    return b"id: %d\ndata: %s\n\n" % (sequence, batch)
+
+
+def gap_event(error: FeedGapError) -> bytes:
+    return b"event: gap\ndata: %s\n\n" % encode({"last": error.last})
+
+
+# A comment, ignored by the clients
+HEARTBEAT_EVENT = b": keep-alive\n\n"
+
+
+def stream_changes(
+    args: typing.Mapping[str, str], last_event_id: str | None = None
+) -> typing.Iterator[bytes]:
+    """
+    Returns the server-sent events of the batches committed after `after`
+    or `Last-Event-ID`, and of those committed later as they are. If the
+    consumer falls behind the feed, a `gap` event ends the stream.
+    """
+
+    after, limit, _ = get_feed_parameters(args, last_event_id)
+    # Fails before the response starts if the batches are already gone
+    change_feed.read(after, 0)
+
+    def iter_events(after: int) -> typing.Iterator[bytes]:
+        while True:
+            try:
+                batches, after = change_feed.wait(after, limit, HEARTBEAT_INTERVAL)
+            except FeedGapError as error:
+                yield gap_event(error)
+                return
+
+            if not batches:
+                yield HEARTBEAT_EVENT
+
+            for sequence, batch in batches:
+                yield change_event(sequence, batch)
+
+    return iter_events(after)
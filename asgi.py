@@ -0,0 +1,539 @@
+"""
+ASGI version of the APP in main.py, serving the same routes without any
+framework. Run it with any ASGI server, e.g. `uvicorn asgi:app`.
+
+Everything that touches the models runs in a thread pool, so the event loop
+stays free to serve other connections while a batch is applied or a
+collection is serialized. Collections are streamed in chunks, all of them
+read and serialized by the same thread, which some storages (like SQLite's
+connections) require. Consumers of
+the change feed wait in the event loop, not in the pool, so any number of
+them can be connected.
+"""
+
+import asyncio
+import concurrent.futures
+import json
+import re
+import threading
+import traceback
+import typing
+from urllib.parse import parse_qsl
+
+from api import (
+    ENDPOINTS,
+    HEARTBEAT_EVENT,
+    HEARTBEAT_INTERVAL,
+    QueryParameterError,
+    apply_operations,
+    apply_operations_once,
+    change_event,
+    changes_document,
+    collection_etag,
+    etag_matches,
+    gap_event,
+    get_export_models,
+    get_feed_parameters,
+    get_resource,
+    list_resources,
+    resource_etag,
+    setup_storage,
+)
+from bulk import BulkImportError, export_rows, import_rows
+from feed import FeedGapError, change_feed
+from idempotency import IdempotencyError
+from jsonapi_schema import ValidationError
+from models import Model, type_to_model
+from responses import document, encode, iter_collection
+
+# Bytes of a streamed collection serialized per call to the thread pool
+CHUNK_SIZE = 64 * 1024
+
+# Runs the blocking work of the requests
+executor = concurrent.futures.ThreadPoolExecutor()
+
+# URL path -> model of the collection routes
+collections = {
+    f"/{model.Meta.resource_name}s": model for model in type_to_model.values()
+}
+
+detail_route = re.compile(r"^/(?P<collection>[^/]+)/(?P<pk>[^/]+)$")
+
+setup_storage()
+
+
+class Request:
+    """
+    The parts of an HTTP connection scope the routes use.
+    """
+
+    def __init__(self, scope: dict, receive: typing.Callable):
+        self.scope = scope
+        self.receive = receive
+        self.method = scope["method"]
+        self.path = scope["path"]
+
+        # The first value of each parameter, like Flask's `request.args`
+        self.args: typing.Dict[str, str] = {}
+        for key, value in parse_qsl(scope["query_string"].decode("latin-1")):
+            self.args.setdefault(key, value)
+
+    @property
+    def base_url(self) -> str:
+        headers = dict(self.scope["headers"])
+        host = headers.get(b"host", b"").decode("latin-1")
+
+        if not host and self.scope.get("server"):
+            host = "%s:%d" % tuple(self.scope["server"])
+
+        root_path = self.scope.get("root_path", "")
+
+        return f"{self.scope['scheme']}://{host}{root_path}{self.path}"
+
+    def header(self, name: bytes) -> str | None:
+        """
+        Returns the values of a header joined by commas, `None` if it wasn't
+        sent. `name` must be lowercase.
+        """
+
+        values = [value for key, value in self.scope["headers"] if key == name]
+
+        if not values:
+            return None
+
+        return b", ".join(values).decode("latin-1")
+
+    async def body(self) -> bytes:
+        chunks = []
+
+        while True:
+            message = await self.receive()
+            chunks.append(message.get("body", b""))
+
+            if not message.get("more_body", False):
+                return b"".join(chunks)
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, title: str, detail: str | None = None):
+        self.status = status
+        self.title = title
+        self.detail = detail
+
+    def to_document(self) -> bytes:
+        error = {"status": str(self.status), "title": self.title}
+
+        if self.detail is not None:
+            error["detail"] = self.detail
+
+        return document({"errors": encode([error])})
+
+
+async def run(func: typing.Callable, *args):
+    return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+
+def read_chunk(chunks: typing.Iterator[bytes]) -> bytes:
+    """
+    Joins pieces of a streamed document until they add up to `CHUNK_SIZE`
+    bytes. Returns an empty string once the document has been read.
+    """
+
+    buffer = []
+    size = 0
+
+    for piece in chunks:
+        buffer.append(piece)
+        size += len(piece)
+
+        if size >= CHUNK_SIZE:
+            break
+
+    return b"".join(buffer)
+
+
+Headers = typing.Dict[str, str]
+
+
+async def start_response(
+    send: typing.Callable,
+    status: int,
+    headers: Headers | None = None,
+    content_type: bytes = b"application/json",
+):
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", content_type),
+                *(
+                    (name.encode("latin-1"), value.encode("latin-1"))
+                    for name, value in (headers or {}).items()
+                ),
+            ],
+        }
+    )
+
+
+async def send_response(
+    send: typing.Callable,
+    body: bytes,
+    status: int = 200,
+    headers: Headers | None = None,
+):
+    await start_response(send, status, headers)
+    await send({"type": "http.response.body", "body": body})
+
+
+def produce_chunks(
+    make_chunks: typing.Callable[[], typing.Iterator[bytes]],
+    loop: asyncio.AbstractEventLoop,
+    queue: asyncio.Queue,
+    demand: threading.Semaphore,
+    stopped: threading.Event,
+):
+    """
+    Runs in the thread pool for the whole of a streamed response: calls
+    `make_chunks()` and reads a chunk from what it returns every time
+    `demand` is released, putting it (or the exception raised) in `queue`.
+    An empty chunk ends the document. Stops early once `stopped` is set.
+    """
+
+    chunks = None
+
+    try:
+        demand.acquire()
+        chunks = make_chunks()
+
+        while not stopped.is_set():
+            chunk = read_chunk(chunks)
+            loop.call_soon_threadsafe(queue.put_nowait, chunk)
+
+            if not chunk:
+                return
+
+            demand.acquire()
+    except Exception as error:
+        loop.call_soon_threadsafe(queue.put_nowait, error)
+    finally:
+        # Closes the storage's cursors in the thread that opened them
+        if chunks is not None and hasattr(chunks, "close"):
+            chunks.close()
+
+
+async def send_stream(
+    send: typing.Callable,
+    make_chunks: typing.Callable[[], typing.Iterator[bytes]],
+    headers: Headers | None = None,
+    content_type: bytes = b"application/json",
+):
+    """
+    Sends the document `make_chunks()` streams, calling it and reading it in
+    a single thread of the pool. The next chunk is only read once the one
+    before it has been sent. The response starts with the first chunk, so
+    errors raised before it are answered as usual.
+    """
+
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    demand = threading.Semaphore(0)
+    stopped = threading.Event()
+
+    loop.run_in_executor(
+        executor, produce_chunks, make_chunks, loop, queue, demand, stopped
+    )
+
+    try:
+        demand.release()
+        chunk = await queue.get()
+
+        if isinstance(chunk, Exception):
+            raise chunk
+
+        await start_response(send, 200, headers, content_type)
+
+        while chunk:
+            await send(
+                {"type": "http.response.body", "body": chunk, "more_body": True}
+            )
+
+            demand.release()
+            chunk = await queue.get()
+
+            if isinstance(chunk, Exception):
+                raise chunk
+
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        stopped.set()
+        demand.release()
+
+
+async def send_not_modified(send: typing.Callable, etag: str):
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 304,
+            "headers": [(b"etag", etag.encode("latin-1"))],
+        }
+    )
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def collection(
+    request: Request, send: typing.Callable, model: typing.Type[Model]
+):
+    etag = await run(collection_etag, model, request.args)
+
+    if etag_matches(request.header(b"if-none-match"), etag):
+        return await send_not_modified(send, etag)
+
+    def make_chunks() -> typing.Iterator[bytes]:
+        instances, fields, members = list_resources(
+            model, request.args, request.base_url
+        )
+        return iter_collection(instances, fields, members)
+
+    await send_stream(send, make_chunks, headers={"etag": etag})
+
+
+async def detail(
+    request: Request, send: typing.Callable, model: typing.Type[Model], pk: str
+):
+    etag = await run(resource_etag, model, pk, request.args)
+
+    if etag is not None and etag_matches(request.header(b"if-none-match"), etag):
+        return await send_not_modified(send, etag)
+
+    body = await run(get_resource, model, pk, request.args)
+    await send_response(send, body, headers=None if etag is None else {"etag": etag})
+
+
+def parse_body(data: bytes) -> dict:
+    try:
+        return json.loads(data)
+    except ValueError:
+        raise HTTPError(400, "Bad Request", "The body is not valid JSON.")
+
+
+def apply_body(data: bytes) -> bytes:
+    return apply_operations(parse_body(data))
+
+
+async def operations(request: Request, send: typing.Callable):
+    data = await request.body()
+    key = request.header(b"idempotency-key")
+
+    if key is None:
+        return await send_response(send, await run(apply_body, data))
+
+    body, replayed = await run(apply_operations_once, key, data, parse_body)
+    await send_response(
+        send, body, headers={"idempotent-replayed": "true"} if replayed else None
+    )
+
+
+def iter_body_lines(
+    receive: typing.Callable, loop: asyncio.AbstractEventLoop
+) -> typing.Iterator[bytes]:
+    """
+    Yields the lines of a request body as they're received. It's iterated in
+    the thread pool and waits for the body in the event loop.
+    """
+
+    pending = b""
+    more_body = True
+
+    while more_body:
+        message = asyncio.run_coroutine_threadsafe(receive(), loop).result()
+
+        if message["type"] == "http.disconnect":
+            raise HTTPError(400, "Bad Request", "The body was cut short.")
+
+        more_body = message.get("more_body", False)
+        lines = (pending + message.get("body", b"")).split(b"\n")
+        pending = lines.pop()
+
+        yield from lines
+
+    if pending:
+        yield pending
+
+
+async def bulk_export(request: Request, send: typing.Callable):
+    model_list = get_export_models(request.args)
+
+    await send_stream(
+        send,
+        lambda: export_rows(model_list),
+        content_type=b"application/x-ndjson",
+    )
+
+
+async def bulk_import(request: Request, send: typing.Callable):
+    lines = iter_body_lines(request.receive, asyncio.get_running_loop())
+    counts = await run(import_rows, lines)
+
+    await send_response(send, document({"meta": encode({"imported": counts})}))
+
+
+async def changes(request: Request, send: typing.Callable):
+    after, limit, timeout = get_feed_parameters(request.args)
+    batches, last = await change_feed.wait_async(after, limit, timeout)
+
+    await send_response(send, changes_document(batches, last))
+
+
+async def wait_for_disconnect(receive: typing.Callable):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def changes_stream(request: Request, send: typing.Callable):
+    after, limit, _ = get_feed_parameters(
+        request.args, request.header(b"last-event-id")
+    )
+    # Fails before the response starts if the batches are already gone
+    change_feed.read(after, 0)
+
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream"),
+                (b"cache-control", b"no-cache"),
+            ],
+        }
+    )
+
+    disconnected = asyncio.ensure_future(wait_for_disconnect(request.receive))
+
+    try:
+        while True:
+            waiting = asyncio.ensure_future(
+                change_feed.wait_async(after, limit, HEARTBEAT_INTERVAL)
+            )
+            await asyncio.wait(
+                [waiting, disconnected], return_when=asyncio.FIRST_COMPLETED
+            )
+
+            if disconnected.done():
+                waiting.cancel()
+                return
+
+            try:
+                batches, after = waiting.result()
+            except FeedGapError as error:
+                await send({"type": "http.response.body", "body": gap_event(error)})
+                return
+
+            body = b"".join(change_event(*batch) for batch in batches)
+            await send(
+                {
+                    "type": "http.response.body",
+                    "body": body or HEARTBEAT_EVENT,
+                    "more_body": True,
+                }
+            )
+    finally:
+        disconnected.cancel()
+
+
+async def dispatch(request: Request, send: typing.Callable):
+    if request.path == "/operations":
+        if request.method != "POST":
+            raise HTTPError(405, "Method Not Allowed")
+
+        return await operations(request, send)
+
+    if request.path == "/bulk/import":
+        if request.method != "POST":
+            raise HTTPError(405, "Method Not Allowed")
+
+        return await bulk_import(request, send)
+
+    if request.method != "GET":
+        raise HTTPError(405, "Method Not Allowed")
+
+    if request.path == "/":
+        return await send_response(send, encode({"endpoints": ENDPOINTS}))
+
+    if request.path == "/bulk/export":
+        return await bulk_export(request, send)
+
+    if request.path == "/changes":
+        return await changes(request, send)
+
+    if request.path == "/changes/stream":
+        return await changes_stream(request, send)
+
+    if request.path in collections:
+        return await collection(request, send, collections[request.path])
+
+    match = detail_route.match(request.path)
+    if match is not None and f"/{match['collection']}" in collections:
+        model = collections[f"/{match['collection']}"]
+        return await detail(request, send, model, match["pk"])
+
+    raise HTTPError(404, "Not Found")
+
+
+async def lifespan(receive: typing.Callable, send: typing.Callable):
+    while True:
+        message = await receive()
+
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            executor.shutdown(wait=True)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+def error_response(error: Exception) -> typing.Tuple[bytes, int]:
+    """
+    Returns the error document and status a request that raised `error`
+    is answered with.
+    """
+
+    if isinstance(error, (QueryParameterError, ValidationError, BulkImportError)):
+        return error.to_document(), 400
+
+    if isinstance(error, FeedGapError):
+        return error.to_document(), 410
+
+    if isinstance(error, (IdempotencyError, HTTPError)):
+        return error.to_document(), error.status
+
+    traceback.print_exception(error)
+    return HTTPError(500, "Internal Server Error").to_document(), 500
+
+
+async def app(scope: dict, receive: typing.Callable, send: typing.Callable):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+
+    if scope["type"] != "http":
+        raise ValueError(f"Unsupported scope type `{scope['type']}`")
+
+    request = Request(scope, receive)
+    started = False
+
+    async def send_message(message: dict):
+        nonlocal started
+        started = started or message["type"] == "http.response.start"
+        await send(message)
+
+    try:
+        await dispatch(request, send_message)
+    except Exception as error:
+        if started:
+            # Part of the response is sent already, another can't follow it.
+            # The server logs the error and closes the connection, so the
+            # client doesn't take the partial body for a whole one.
+            raise
+
+        body, status = error_response(error)
+        await send_response(send, body, status=status)
@@ -0,0 +1,1009 @@
+"""
+Micro-benchmarks for the hot paths of the APP. Run `py benchmarks.py` to run
+all of them or `py benchmarks.py <name> [<name> ...]` to pick some.
+"""
+
+import json
+import sys
+import time
+import timeit
+import typing
+
+
+def report(label: str, seconds: float, number: int):
+    print(f"{label:<40} {seconds / number * 1_000_000:>10.2f} us/op")
+
+
+def bench_validation(number: int = 5_000):
+    """
+    Per-operation cost of validating the resource object of an added user
+    while building its instance, and the `ref` and linkage of a relationship
+    addition, with the functions generated from the models. Compiling them
+    is a one-off cost, measured too.
+    """
+
+    from codegen import compile_deserializer, compile_validator
+    from models import Artist, User
+
+    ref = {"type": "user", "id": "1", "relationship": "followed_artists"}
+    linkage = [{"type": "artist", "id": "1"}, {"type": "artist", "lid": "a-2"}]
+    resource = {
+        "type": "user",
+        "lid": "user-1",
+        "attributes": {"username": "JamesDoe", "email": "jamesdoe@doemail.com"},
+        "relationships": {
+            "followed_artists": {"data": [{"type": "artist", "lid": "artist-1"}]}
+        },
+    }
+    artist = Artist(id="1", name="John Doe")
+
+    def compile_functions():
+        compile_deserializer(User, "add")
+        compile_validator(User, "ref")
+        compile_validator(User, "add", "followed_artists")
+
+    def add_resource():
+        User.get_deserializer("add")(
+            resource, "1", lambda identifier: artist, lambda lid, instance: None, ""
+        )
+
+    def add_relationship():
+        User.get_validator("ref")(ref, "/ref")
+        User.get_validator("add", "followed_artists")(linkage, "/data")
+
+    for label, func, count in [
+        ("compile the functions", compile_functions, 100),
+        ("add resource", add_resource, number),
+        ("add relationship", add_relationship, number),
+    ]:
+        report(label, timeit.timeit(func, number=count), count)
+
+
+def bench_envelope(count: int = 10_000):
+    """
+    Cost of validating the envelope of a body of `count` operations, mixing
+    resource additions and relationship updates, with the `schema` library
+    against the hand-written validator.
+    """
+
+    from jsonapi_schema import schema, validate_operations
+    from models import type_to_model
+
+    operations = [
+        {
+            "op": "add",
+            "data": {
+                "type": "artist",
+                "lid": f"artist-{i}",
+                "attributes": {"name": "John Doe"},
+            },
+        }
+        if i % 2
+        else {
+            "op": "update",
+            "ref": {"type": "user", "id": "1", "relationship": "followed_artists"},
+            "data": [{"type": "artist", "lid": f"artist-{i - 1}"}],
+        }
+        for i in range(count)
+    ]
+    body = {"atomic:operations": operations}
+
+    for label, func in [
+        ("schema library", lambda: schema.validate(body)),
+        ("hand-written validator", lambda: validate_operations(body, type_to_model)),
+    ]:
+        seconds = timeit.timeit(func, number=5)
+        report(f"{label}, {count} operations", seconds, 5 * count)
+
+
+def bench_id_allocation(count: int = 100_000, bucket: int = 10_000):
+    """
+    Per-insert latency of adding `count` artists with IDs from the model's
+    sequence, reported per bucket of inserts to show it stays flat, next to
+    the old sort-the-whole-table allocation sampled at a few table sizes.
+    """
+
+    from models import Artist, artist_db
+
+    artist_db.clear()
+    Artist.id_sequence.reset()
+
+    start = time.perf_counter()
+    for i in range(1, count + 1):
+        Artist(id=Artist.id_sequence.next(), name="John Doe").save()
+
+        if i % bucket == 0:
+            end = time.perf_counter()
+            report(f"sequence, inserts {i - bucket + 1}-{i}", end - start, bucket)
+            start = end
+
+    def sorted_table_pk():
+        all_instances = Artist.all()
+        all_instances.sort(key=lambda o: o.id)
+        return str(int(all_instances[len(all_instances) - 1].id) + 1)
+
+    for size in [count // 100, count // 10, count]:
+        artist_db.clear()
+        for pk in range(1, size + 1):
+            artist_db[str(pk)] = Artist(id=str(pk), name="John Doe")
+
+        report(
+            f"sorted table, {size} rows",
+            timeit.timeit(sorted_table_pk, number=20),
+            20,
+        )
+
+    artist_db.clear()
+    Artist.id_sequence.reset()
+
+
+def bench_bulk_add(count: int = 5_000):
+    """
+    Per-operation cost of a run of `count` artist additions applied one by
+    one against the same run applied with a single `apply_many()` call.
+    """
+
+    from models import Artist, artist_db
+    from operations import ArtistOperationSet, LidRegistry
+
+    operations = [
+        {
+            "op": "add",
+            "data": {"type": "artist", "lid": f"a-{i}", "attributes": {"name": "J"}},
+        }
+        for i in range(count)
+    ]
+
+    def one_by_one():
+        operation_set = ArtistOperationSet(lids=LidRegistry())
+        for operation in operations:
+            operation_set.add(data=operation["data"])
+
+    def bulk():
+        ArtistOperationSet(lids=LidRegistry()).apply_many("add", operations)
+
+    for label, func in [("one by one", one_by_one), ("apply_many", bulk)]:
+        artist_db.clear()
+        Artist.id_sequence.reset()
+        report(label, timeit.timeit(func, number=1), count)
+
+    artist_db.clear()
+    Artist.id_sequence.reset()
+
+
+def bench_transactions(sizes: typing.Iterable[int] = (1_000, 100_000)):
+    """
+    Cost of committing and rolling back a transaction that updates 10 users
+    with stores of different sizes. It should not grow with the store.
+    """
+
+    from models import Artist, User, atomic, artist_db, user_db
+
+    class Rollback(Exception):
+        pass
+
+    for size in sizes:
+        artist_db.clear()
+        user_db.clear()
+        artist = Artist(id="1", name="John Doe")
+        artist_db["1"] = artist
+        for pk in range(1, size + 1):
+            user_db[str(pk)] = User(str(pk), "JamesDoe", "j@doe.com", [artist])
+
+        def commit():
+            with atomic():
+                for pk in range(1, 11):
+                    user = User.get(str(pk))
+                    user.username = "JaneDoe"
+                    user.save()
+
+        def rollback():
+            try:
+                with atomic():
+                    commit()
+                    raise Rollback()
+            except Rollback:
+                pass
+
+        report(f"commit, {size} users", timeit.timeit(commit, number=100), 100)
+        report(f"rollback, {size} users", timeit.timeit(rollback, number=100), 100)
+
+    artist_db.clear()
+    user_db.clear()
+
+
+def bench_serialization(count: int = 10_000, follows: int = 20):
+    """
+    Cost of serializing `count` users following `follows` artists each,
+    building the resource objects against reading them from the cache.
+    """
+
+    from models import Artist, User
+
+    artists = [Artist(id=str(pk), name="John Doe") for pk in range(1, follows + 1)]
+    users = [
+        User(str(pk), "JamesDoe", "j@doe.com", list(artists))
+        for pk in range(1, count + 1)
+    ]
+
+    def build():
+        for user in users:
+            user.build_json()
+
+    def cached():
+        for user in users:
+            user.to_json()
+
+    cached()
+    report("build_json", timeit.timeit(build, number=5), 5 * count)
+    report("to_json (cached)", timeit.timeit(cached, number=5), 5 * count)
+
+
+def bench_encoding(count: int = 10_000):
+    """
+    Time to encode a collection document of `count` users: one `json.dumps`
+    of the whole document (what `jsonify` does), assembling it from freshly
+    encoded fragments with every available encoder, and splicing cached
+    fragments.
+    """
+
+    import json
+
+    import responses
+    from models import Artist, User
+
+    artists = [Artist(id=str(pk), name="John Doe") for pk in range(1, 6)]
+    users = [
+        User(str(pk), "JamesDoe", "j@doe.com", list(artists))
+        for pk in range(1, count + 1)
+    ]
+
+    def whole_document():
+        json.dumps(
+            {
+                "jsonapi": {
+                    "version": "1.1",
+                    "ext": ["https://jsonapi.org/ext/atomic"],
+                },
+                "data": [user.to_json() for user in users],
+            }
+        )
+
+    def fragments():
+        for user in users:
+            user._json_bytes = None
+
+        responses.document({"data": responses.resource_array(users)})
+
+    def cached_fragments():
+        responses.document({"data": responses.resource_array(users)})
+
+    report("json.dumps(document)", timeit.timeit(whole_document, number=5), 5)
+
+    default_encoder = responses.encoder_name
+    for name in responses.encoders.keys():
+        responses.set_encoder(name)
+        report(f"fragments, {name}", timeit.timeit(fragments, number=5), 5)
+
+    responses.set_encoder(default_encoder)
+    report("cached fragments", timeit.timeit(cached_fragments, number=5), 5)
+
+
+def bench_memory(count: int = 100_000, follows: int = 5):
+    """
+    Bytes per user row following `follows` artists, with the slotted model
+    against a plain class laid out like the models used to be (a `__dict__`
+    per instance and a list of related instances).
+    """
+
+    import tracemalloc
+
+    from models import Artist, User
+
+    class PlainUser:
+        def __init__(self, id, username, email, followed_artists):
+            self.id = id
+            self.username = username
+            self.email = email
+            self.followed_artists = followed_artists
+
+    artists = [Artist(id=str(pk), name="John Doe") for pk in range(1, follows + 1)]
+
+    def measure(factory) -> float:
+        tracemalloc.start()
+        rows = [factory(str(pk)) for pk in range(1, count + 1)]
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del rows
+
+        return size / count
+
+    for label, factory in [
+        ("plain class", lambda pk: PlainUser(pk, "JDoe", "j@doe.com", list(artists))),
+        ("slotted model", lambda pk: User(pk, "JDoe", "j@doe.com", artists)),
+    ]:
+        print(f"{label:<40} {measure(factory):>10.2f} bytes/row")
+
+
+def bench_filtering(sizes: typing.Iterable[int] = (1_000, 100_000)):
+    """
+    Cost of finding the 10 illustrations of an artist and of getting the
+    first 10 illustrations sorted by URL with tables of different sizes,
+    scanning the table against using the indexes.
+    """
+
+    import itertools
+
+    import models
+    from models import Artist, Illustration, atomic
+    from storage import DictStorage
+
+    default_storage = models.storage
+
+    for size in sizes:
+        models.set_storage(DictStorage())
+
+        with atomic():
+            artists = [
+                Artist(id=pk, name="John Doe")
+                for pk in Artist.id_sequence.allocate(size // 10)
+            ]
+            Artist.save_many(artists)
+            Illustration.save_many(
+                [
+                    Illustration(id=pk, url=f"https://{pk}", artist=artists[i // 10])
+                    for i, pk in enumerate(Illustration.id_sequence.allocate(size))
+                ]
+            )
+
+        artist_id = artists[len(artists) // 2].id
+
+        def scan():
+            return [
+                instance
+                for instance in Illustration.iter()
+                if instance.related_ids("artist") == [artist_id]
+            ]
+
+        def indexed():
+            return list(Illustration.query({"artist": artist_id}))
+
+        def sort_scan():
+            return sorted(Illustration.iter(), key=lambda instance: instance.url)[:10]
+
+        def sort_indexed():
+            return list(itertools.islice(Illustration.query(sort=[("url", True)]), 10))
+
+        for label, func, number in [
+            (f"filter scan, {size} rows", scan, 10),
+            (f"filter index, {size} rows", indexed, 1_000),
+            (f"sort scan, {size} rows", sort_scan, 10),
+            (f"sort index, {size} rows", sort_indexed, 10),
+        ]:
+            report(label, timeit.timeit(func, number=number), number)
+
+    models.set_storage(default_storage)
+
+
+def bench_stress(threads: int = 8, seconds: float = 2.0):
+    """
+    Hammers `/operations` and `/artists` from a thread pool. Half of the
+    threads apply batches that add two artists and remove two others, the
+    other half list the artists, which must never fail nor return an odd
+    number of them (a half-applied batch).
+    """
+
+    import concurrent.futures
+
+    from main import app
+    from models import Artist, artist_db
+
+    artist_db.clear()
+    Artist.id_sequence.reset()
+
+    deadline = time.perf_counter() + seconds
+
+    def write() -> typing.Tuple[int, int]:
+        client = app.test_client()
+        batches = errors = 0
+
+        while time.perf_counter() < deadline:
+            response = client.post(
+                "/operations",
+                json={
+                    "atomic:operations": [
+                        {
+                            "op": "add",
+                            "data": {"type": "artist", "attributes": {"name": "J"}},
+                        }
+                    ]
+                    * 2
+                },
+            )
+            if response.status_code != 200:
+                errors += 1
+                continue
+
+            added = [resource["id"] for resource in response.json["atomic:results"]]
+            response = client.post(
+                "/operations",
+                json={
+                    "atomic:operations": [
+                        {"op": "remove", "data": {"type": "artist", "id": pk}}
+                        for pk in added
+                    ]
+                },
+            )
+            batches += 2
+            errors += response.status_code != 200
+
+        return batches, errors
+
+    def read() -> typing.Tuple[int, int]:
+        client = app.test_client()
+        reads = errors = 0
+
+        while time.perf_counter() < deadline:
+            try:
+                response = client.get("/artists")
+                errors += len(response.json["data"]) % 2 != 0
+            except Exception:
+                errors += 1
+            reads += 1
+
+        return reads, errors
+
+    # Switch threads as often as possible to provoke races
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+            writers = [executor.submit(write) for _ in range(threads // 2)]
+            readers = [executor.submit(read) for _ in range(threads - threads // 2)]
+
+            for label, futures in [("batches", writers), ("reads", readers)]:
+                results = [future.result() for future in futures]
+                count = sum(result[0] for result in results)
+                errors = sum(result[1] for result in results)
+                print(f"{label:<40} {count / seconds:>10.0f} /s, {errors} errors")
+    finally:
+        sys.setswitchinterval(switch_interval)
+
+    artist_db.clear()
+    Artist.id_sequence.reset()
+
+
+def load_reads(path: str, rows: int, seconds: float) -> int:
+    """
+    Requests `/artists/<id>` for `seconds` from a worker process, returns
+    the number of requests made.
+    """
+
+    import models
+    from main import app
+    from storage import SQLiteStorage
+
+    models.set_storage(SQLiteStorage(path))
+    client = app.test_client()
+
+    count = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        client.get(f"/artists/{count % rows + 1}")
+        count += 1
+
+    return count
+
+
+def load_adds(path: str, count: int):
+    """
+    Adds `count` artists from a worker process, one request each.
+    """
+
+    import models
+    from main import app
+    from storage import SQLiteStorage
+
+    models.set_storage(SQLiteStorage(path))
+    client = app.test_client()
+
+    for i in range(count):
+        client.post(
+            "/operations",
+            json={
+                "atomic:operations": [
+                    {
+                        "op": "add",
+                        "data": {"type": "artist", "attributes": {"name": "J"}},
+                    }
+                ]
+            },
+        )
+
+
+def bench_workers(
+    worker_counts: typing.Iterable[int] = (1, 2, 4),
+    rows: int = 1_000,
+    seconds: float = 2.0,
+    adds: int = 50,
+):
+    """
+    Read throughput of a SQLite database shared by 1, 2 and 4 worker
+    processes, like the workers of a gunicorn server. It scales with the
+    workers up to the number of cores, as reads don't take any lock.
+
+    Then every worker adds `adds` artists at the same time, which must leave
+    the database with exactly the artists added (no ID handed out twice).
+    """
+
+    import multiprocessing
+    import os
+    import tempfile
+
+    import models
+    from models import Artist, atomic
+    from storage import SQLiteStorage
+
+    default_storage = models.storage
+    context = multiprocessing.get_context("spawn")
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "db.sqlite3")
+
+        models.set_storage(SQLiteStorage(path))
+        with atomic():
+            Artist.save_many(
+                [
+                    Artist(id=pk, name="John Doe")
+                    for pk in Artist.id_sequence.allocate(rows)
+                ]
+            )
+
+        for workers in worker_counts:
+            with context.Pool(workers) as pool:
+                counts = pool.starmap(load_reads, [(path, rows, seconds)] * workers)
+
+            label = f"reads, {workers} workers"
+            print(f"{label:<40} {sum(counts) / seconds:>10.0f} req/s")
+
+        workers = max(worker_counts)
+        with context.Pool(workers) as pool:
+            pool.starmap(load_adds, [(path, adds)] * workers)
+
+        added = Artist.count() - rows
+        label = f"adds, {workers} workers"
+        print(f"{label:<40} {added:>10} / {workers * adds} artists")
+
+        models.set_storage(default_storage)
+
+
+def load_operations(path: str, stream: bool) -> typing.Tuple[float, int, int]:
+    """
+    Applies the operations in the file at `path` from a fresh process, like
+    a request to `/operations`. Returns the time it took and the peak RSS of
+    the process in KiB before and after.
+    """
+
+    import resource
+
+    from api import apply_operation_stream, apply_operations
+
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+
+    with open(path, "rb") as file:
+        if stream:
+            apply_operation_stream(file)
+        else:
+            apply_operations(json.loads(file.read()))
+
+    seconds = time.perf_counter() - start
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return seconds, before, after
+
+
+def bench_operation_streaming(count: int = 200_000):
+    """
+    Time and peak memory of applying a body of `count` artist additions
+    (about 15 MB per 200k), parsing the whole body before applying it
+    against streaming it. Each run happens in its own process, as the peak
+    RSS of a process can't be reset.
+    """
+
+    import multiprocessing
+    import os
+    import tempfile
+
+    operation = {
+        "op": "add",
+        "data": {"type": "artist", "attributes": {"name": "John Doe"}},
+    }
+    context = multiprocessing.get_context("spawn")
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "operations.json")
+
+        with open(path, "w") as file:
+            file.write('{"atomic:operations": [')
+            file.write(",".join([json.dumps(operation)] * count))
+            file.write("]}")
+
+        for label, stream in [("whole body", False), ("streamed", True)]:
+            with context.Pool(1) as pool:
+                seconds, before, after = pool.apply(load_operations, (path, stream))
+
+            print(
+                f"{label:<40} {seconds:>10.2f} s, "
+                f"peak RSS {before / 1024:.0f} -> {after / 1024:.0f} MiB"
+            )
+
+
+def bench_bulk_import(count: int = 20_000):
+    """
+    Time to load `count` artists with an illustration each into an empty
+    storage, replaying them as `/operations` against importing them as NDJSON,
+    in memory and in SQLite.
+    """
+
+    import os
+    import tempfile
+
+    import models
+    from api import apply_operations
+    from bulk import import_rows
+    from storage import DictStorage, SQLiteStorage
+
+    default_storage = models.storage
+
+    operations = []
+    lines = []
+    for i in range(1, count + 1):
+        operations.append(
+            {
+                "op": "add",
+                "data": {
+                    "type": "artist",
+                    "lid": str(i),
+                    "attributes": {"name": "John Doe"},
+                },
+            }
+        )
+        operations.append(
+            {
+                "op": "add",
+                "data": {
+                    "type": "illustration",
+                    "attributes": {"url": f"https://{i}"},
+                    "relationships": {
+                        "artist": {"data": {"type": "artist", "lid": str(i)}}
+                    },
+                },
+            }
+        )
+        lines.append(json.dumps({"type": "artist", "id": str(i), "name": "John Doe"}))
+        lines.append(
+            json.dumps(
+                {
+                    "type": "illustration",
+                    "id": str(i),
+                    "url": f"https://{i}",
+                    "artist": str(i),
+                }
+            )
+        )
+
+    body = {"atomic:operations": operations}
+
+    with tempfile.TemporaryDirectory() as directory:
+        for backend in ["memory", "sqlite"]:
+            for label, load in [
+                ("operations", lambda: apply_operations(body)),
+                ("NDJSON import", lambda: import_rows(lines)),
+            ]:
+                if backend == "memory":
+                    storage = DictStorage()
+                else:
+                    storage = SQLiteStorage(os.path.join(directory, f"{label}.db"))
+
+                models.set_storage(storage)
+
+                start = time.perf_counter()
+                load()
+                seconds = time.perf_counter() - start
+
+                print(f"{f'{label}, {backend}':<40} {seconds:>10.2f} s")
+
+    models.set_storage(default_storage)
+
+
+def bench_wal_commits(commits: int = 2_000, threads: typing.Iterable[int] = (1, 8)):
+    """
+    Latency of committing a transaction adding an artist, in memory against
+    logged to a write-ahead log, with transactions committed from several
+    threads sharing `fsync()` calls.
+    """
+
+    import tempfile
+    import threading
+
+    import models
+    from models import Artist
+    from storage import DictStorage
+    from wal import DurableDictStorage
+
+    default_storage = models.storage
+
+    def commit():
+        Artist(id=Artist.id_sequence.next(), name="John Doe").save()
+
+    for count in threads:
+        with tempfile.TemporaryDirectory() as directory:
+            for label, storage in [
+                ("in memory", DictStorage()),
+                ("write-ahead log", DurableDictStorage(directory)),
+            ]:
+                models.set_storage(storage)
+
+                def run():
+                    for _ in range(commits // count):
+                        commit()
+
+                workers = [threading.Thread(target=run) for _ in range(count)]
+
+                start = time.perf_counter()
+                for worker in workers:
+                    worker.start()
+                for worker in workers:
+                    worker.join()
+                seconds = time.perf_counter() - start
+
+                report(f"commit, {label}, {count} threads", seconds * count, commits)
+
+                if isinstance(storage, DurableDictStorage):
+                    fsyncs = storage.log.fsyncs
+                    print(f"{'':<40} {commits / fsyncs:>10.1f} commits/fsync")
+                    storage.close()
+
+    models.set_storage(default_storage)
+
+
+def bench_recovery(count: int = 10_000_000, tail: int = 100_000):
+    """
+    Time to recover `count` artists from a snapshot followed by a log of
+    `tail` transactions, each updating an artist.
+    """
+
+    import gc
+    import tempfile
+
+    import models
+    from models import Artist
+    from storage import DictStorage
+    from wal import DurableDictStorage
+
+    default_storage = models.storage
+
+    with tempfile.TemporaryDirectory() as directory:
+        storage = DurableDictStorage(directory, snapshot_size=2**63)
+        models.set_storage(storage)
+
+        pks = Artist.id_sequence.allocate(count)
+        for i in range(0, count, 100_000):
+            with storage.transaction():
+                storage.load(
+                    Artist(id=pk, name="John Doe") for pk in pks[i : i + 100_000]
+                )
+
+        start = time.perf_counter()
+        storage.snapshot()
+        print(f"{'snapshot':<40} {time.perf_counter() - start:>10.2f} s")
+
+        for i in range(tail):
+            Artist(id=str(i % count + 1), name="Jane Doe").save()
+
+        storage.close()
+        models.set_storage(DictStorage())
+        del storage
+        gc.collect()
+
+        start = time.perf_counter()
+        models.set_storage(DurableDictStorage(directory))
+        print(f"{'recovery':<40} {time.perf_counter() - start:>10.2f} s")
+
+        assert Artist.count() == count
+
+    models.set_storage(default_storage)
+
+
+def bench_conditional_get(count: int = 10_000, number: int = 20):
+    """
+    Cost of a request to `/artists` with `count` artists, answered in full
+    against answered with `304 Not Modified` from its `ETag`, in memory and
+    in SQLite.
+    """
+
+    import os
+    import tempfile
+
+    import models
+    from bulk import import_rows
+    from main import app
+    from storage import DictStorage, SQLiteStorage
+
+    default_storage = models.storage
+    client = app.test_client()
+    lines = [
+        json.dumps({"type": "artist", "id": str(i), "name": "John Doe"})
+        for i in range(1, count + 1)
+    ]
+
+    with tempfile.TemporaryDirectory() as directory:
+        for backend in ["memory", "sqlite"]:
+            if backend == "memory":
+                models.set_storage(DictStorage())
+            else:
+                models.set_storage(SQLiteStorage(os.path.join(directory, "get.db")))
+
+            import_rows(lines)
+            etag = client.get("/artists").headers["ETag"]
+
+            for label, headers in [
+                ("200 OK", {}),
+                ("304 Not Modified", {"If-None-Match": etag}),
+            ]:
+                seconds = timeit.timeit(
+                    lambda: client.get("/artists", headers=headers), number=number
+                )
+                report(f"{label}, {backend}", seconds, number)
+
+    models.set_storage(default_storage)
+
+
+def bench_change_feed(batches: int = 2_000, consumers: typing.Iterable[int] = (0, 50)):
+    """
+    Cost of applying `batches` single-operation batches while `consumers`
+    threads follow the change feed, and the time it takes the last batch to
+    reach them.
+    """
+
+    import threading
+
+    from api import apply_operations
+    from feed import change_feed
+
+    body = {
+        "atomic:operations": [
+            {"op": "add", "data": {"type": "artist", "attributes": {"name": "A"}}}
+        ]
+    }
+
+    for count in consumers:
+        start_sequence = change_feed.last
+        end_sequence = start_sequence + batches
+        received = []
+
+        def follow():
+            after = start_sequence
+            while after < end_sequence:
+                _, after = change_feed.wait(after, 1000, 1)
+            received.append(time.perf_counter())
+
+        threads = [threading.Thread(target=follow) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+
+        start = time.perf_counter()
+        for _ in range(batches):
+            apply_operations(body)
+        end = time.perf_counter()
+
+        for thread in threads:
+            thread.join()
+
+        report(f"apply, {count} consumers", end - start, batches)
+
+        if received:
+            print(f"{'last batch delivered after':<40} {max(received) - end:>10.4f} s")
+
+
+def bench_idempotent_retry(count: int = 10_000):
+    """
+    Time to answer a POST of `count` resource additions to `/operations` the
+    first time, when it's applied, against a retry with the same
+    `Idempotency-Key`, answered with the recorded response.
+    """
+
+    from main import app
+
+    client = app.test_client()
+    data = json.dumps(
+        {
+            "atomic:operations": [
+                {"op": "add", "data": {"type": "artist", "attributes": {"name": "A"}}}
+            ]
+            * count
+        }
+    )
+
+    for label in ["first attempt", "retry"]:
+        start = time.perf_counter()
+        client.post(
+            "/operations",
+            data=data,
+            content_type="application/json",
+            headers={"Idempotency-Key": "bench_idempotent_retry"},
+        )
+        seconds = time.perf_counter() - start
+
+        print(f"{f'{label}, {count} operations':<40} {seconds * 1000:>10.2f} ms")
+
+
+def bench_scheduling(count: int = 2_000):
+    """
+    Per-operation cost of a batch of `count` artist additions, each followed
+    by the addition of an illustration of it, applied in order (two runs per
+    pair) against scheduled (a run of artists, then one of illustrations).
+    """
+
+    import models
+    from api import apply_operations
+    from storage import DictStorage
+
+    default_storage = models.storage
+    operations = []
+
+    for i in range(count):
+        artist = {"type": "artist", "lid": f"a-{i}"}
+        operations += [
+            {"op": "add", "data": {**artist, "attributes": {"name": "A"}}},
+            {
+                "op": "add",
+                "data": {
+                    "type": "illustration",
+                    "attributes": {"url": "https://example.com"},
+                    "relationships": {"artist": {"data": artist}},
+                },
+            },
+        ]
+
+    body = {"atomic:operations": operations}
+
+    for label, scheduled in [("in order", False), ("scheduled", True)]:
+        models.set_storage(DictStorage())
+        seconds = timeit.timeit(
+            lambda: apply_operations(body, scheduled=scheduled), number=1
+        )
+        report(label, seconds, len(operations))
+
+    models.set_storage(default_storage)
+
+
+benchmarks = {
+    "validation": bench_validation,
+    "envelope": bench_envelope,
+    "id_allocation": bench_id_allocation,
+    "bulk_add": bench_bulk_add,
+    "transactions": bench_transactions,
+    "serialization": bench_serialization,
+    "encoding": bench_encoding,
+    "memory": bench_memory,
+    "filtering": bench_filtering,
+    "stress": bench_stress,
+    "workers": bench_workers,
+    "operation_streaming": bench_operation_streaming,
+    "bulk_import": bench_bulk_import,
+    "wal_commits": bench_wal_commits,
+    "recovery": bench_recovery,
+    "conditional_get": bench_conditional_get,
+    "change_feed": bench_change_feed,
+    "idempotent_retry": bench_idempotent_retry,
+    "scheduling": bench_scheduling,
+}
+
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or benchmarks.keys():
+        print(f"# {name}")
+        benchmarks[name]()
@@ -0,0 +1,293 @@
+"""
+Bulk export and import of the resources as newline-delimited JSON (NDJSON),
+one resource per line:
+
+    {"type": "artist", "id": "1", "name": "John Doe"}
+    {"type": "illustration", "id": "1", "url": "https://...", "artist": "1"}
+    {"type": "user", "id": "1", ..., "followed_artists": ["1", "2"]}
+
+Relationships are written as the IDs of the related resources. It's meant to
+reload and migrate data without the overhead of `/operations`: rows are
+validated in chunks against the models' fields, written without updating the
+indexes row by row and the indexes are rebuilt once at the end.
+
+Run `py bulk.py export [<file>]` or `py bulk.py import [<file>]`, they use the
+database in `JSONAPI_DATABASE`.
+"""
+
+import json
+import typing
+
+import models
+from models import Model, type_to_model
+from responses import document, encode
+from storage import is_pk
+
+# Rows validated and written at a time while importing
+CHUNK_SIZE = 1000
+
+
+class BulkImportError(ValueError):
+    def __init__(self, line: int, detail: str):
+        super().__init__(f"Line {line}: {detail}")
+        self.line = line
+        self.detail = detail
+
+    def to_document(self) -> bytes:
+        return document(
+            {
+                "errors": encode(
+                    [
+                        {
+                            "status": "400",
+                            "title": "Invalid import",
+                            "detail": self.detail,
+                            "meta": {"line": self.line},
+                        }
+                    ]
+                )
+            }
+        )
+
+
+def dependency_order(
+    model_list: typing.Iterable[typing.Type[Model]],
+) -> typing.List[typing.Type[Model]]:
+    """
+    Sorts models so every model comes after the models it has relationships
+    to, the order they must be imported in.
+    """
+
+    ordered = []
+
+    def visit(model):
+        if model in ordered:
+            return
+
+        for field in model.Meta.relationship_fields:
+            related = getattr(model, field).model
+            if related is not model:
+                visit(related)
+
+        ordered.append(model)
+
+    for model in model_list:
+        visit(model)
+
+    return ordered
+
+
+def to_row(instance: Model) -> dict:
+    row = {"type": instance.Meta.resource_name, "id": instance.id}
+
+    for attr in instance.Meta.editable_attrs:
+        row[attr] = getattr(instance, attr)
+
+    for field in instance.Meta.relationship_fields:
+        pks = instance.related_ids(field)
+        row[field] = pks if getattr(type(instance), field).many else next(
+            iter(pks), None
+        )
+
+    return row
+
+
+def export_rows(
+    model_list: typing.Iterable[typing.Type[Model]] | None = None,
+) -> typing.Iterator[bytes]:
+    """
+    Yields a line for every resource of `model_list` (every model by
+    default), related resources before the resources pointing to them.
+    """
+
+    exported = set(model_list or type_to_model.values())
+
+    for model in dependency_order(type_to_model.values()):
+        if model not in exported:
+            continue
+
+        for instance in model.iter():
+            yield encode(to_row(instance)) + b"\n"
+
+
+def from_row(model: typing.Type[Model], row: dict) -> Model:
+    """
+    Builds the instance of a row of `model`, the reverse of `to_row()`.
+    """
+
+    instance = model.__new__(model)
+    instance.id = row["id"]
+
+    for attr in model.Meta.editable_attrs:
+        setattr(instance, attr, row[attr])
+
+    for field in model.Meta.relationship_fields:
+        value = row.get(field)
+
+        if value is None:
+            value = []
+        elif not getattr(model, field).many:
+            value = [value]
+
+        instance.set_related_ids(field, value)
+
+    return instance
+
+
+def validate_row(line: int, row) -> Model:
+    """
+    Checks a row against the fields of its model and builds its instance.
+    """
+
+    if not isinstance(row, dict):
+        raise BulkImportError(line, "Expected an object.")
+
+    model = type_to_model.get(row.get("type"))
+    if model is None:
+        raise BulkImportError(line, f"Unknown type `{row.get('type')}`.")
+
+    if not is_pk(row.get("id")):
+        raise BulkImportError(
+            line, "`id` must be a numeric string without leading zeros."
+        )
+
+    fields = {"type", "id", *model.Meta.editable_attrs}
+    unknown = row.keys() - fields - set(model.Meta.relationship_fields)
+    if unknown:
+        raise BulkImportError(line, f"Unknown fields {sorted(unknown)}.")
+
+    for attr in model.Meta.editable_attrs:
+        if not isinstance(row.get(attr), model.__annotations__[attr]):
+            raise BulkImportError(
+                line, f"`{attr}` must be a {model.__annotations__[attr].__name__}."
+            )
+
+    for field in model.Meta.relationship_fields:
+        value = row.get(field)
+
+        if getattr(model, field).many:
+            valid = value is None or (
+                isinstance(value, list) and all(is_pk(pk) for pk in value)
+            )
+        else:
+            valid = value is None or is_pk(value)
+
+        if not valid:
+            raise BulkImportError(line, f"`{field}` must hold resource IDs.")
+
+    return from_row(model, row)
+
+
+def check_references(
+    chunk: typing.List[typing.Tuple[int, Model]],
+    imported: typing.Dict[typing.Type[Model], typing.Set[str]],
+):
+    """
+    Checks that the relationships of a chunk of rows point to resources that
+    were imported before or already exist, looking up the missing ones with
+    one `get_many()` per model.
+    """
+
+    # related model -> pk -> line of the first row referencing it
+    missing: typing.Dict[typing.Type[Model], typing.Dict[str, int]] = {}
+
+    for line, instance in chunk:
+        for field in instance.Meta.relationship_fields:
+            related = getattr(type(instance), field).model
+
+            for pk in instance.related_ids(field):
+                if pk not in imported.get(related, ()):
+                    missing.setdefault(related, {}).setdefault(pk, line)
+
+    for related, pks in missing.items():
+        found = {instance.id for instance in related.get_many(list(pks))}
+
+        for pk, line in pks.items():
+            if pk not in found:
+                raise BulkImportError(
+                    line, f"`{related.Meta.resource_name}` `{pk}` doesn't exist."
+                )
+
+
+def import_rows(
+    lines: typing.Iterable[bytes | str], chunk_size: int = CHUNK_SIZE
+) -> typing.Dict[str, int]:
+    """
+    Imports the resources in `lines`, replacing existing resources with the
+    same ID. Related resources must come before the resources pointing to
+    them or exist already. Returns the number of resources imported per type.
+
+    The whole import is a single transaction with the SQLite storage. With
+    the in-memory storage the chunks written before an invalid row stay.
+    """
+
+    storage = models.storage
+    imported: typing.Dict[typing.Type[Model], typing.Set[str]] = {}
+    chunk: typing.List[typing.Tuple[int, Model]] = []
+
+    def flush():
+        check_references(chunk, imported)
+        storage.load(instance for _, instance in chunk)
+        chunk.clear()
+
+    with storage.transaction():
+        try:
+            for number, line in enumerate(lines, start=1):
+                if not line.strip():
+                    continue
+
+                try:
+                    row = json.loads(line)
+                except ValueError as error:
+                    raise BulkImportError(number, f"Invalid JSON: {error}")
+
+                instance = validate_row(number, row)
+                chunk.append((number, instance))
+                imported.setdefault(type(instance), set()).add(instance.id)
+
+                if len(chunk) >= chunk_size:
+                    flush()
+
+            flush()
+        finally:
+            # Also after a failure, for the chunks that were loaded
+            storage.rebuild_indexes()
+
+    for model in type_to_model.values():
+        model.id_sequence.reset()
+
+    return {model.Meta.resource_name: len(pks) for model, pks in imported.items()}
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    from api import setup_storage
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("file", nargs="?", help="Defaults to stdout/stdin")
+    parser.add_argument(
+        "--type",
+        action="append",
+        choices=list(type_to_model.keys()),
+        help="Only export resources of this type, can be repeated",
+    )
+    args = parser.parse_args()
+
+    setup_storage()
+
+    if args.command == "export":
+        model_list = [type_to_model[name] for name in args.type or []]
+        with open(args.file, "wb") if args.file else sys.stdout.buffer as file:
+            file.writelines(export_rows(model_list))
+    else:
+        with open(args.file, "rb") if args.file else sys.stdin.buffer as file:
+            try:
+                counts = import_rows(file)
+            except BulkImportError as error:
+                sys.exit(str(error))
+
+        for resource_name, count in counts.items():
+            print(f"{resource_name}: {count}", file=sys.stderr)
@@ -0,0 +1,382 @@
+"""
+Compiles the checks of the operations on a model, derived from its
+annotations and `Meta`, into Python functions specialized for it. The
+source of each function is generated once, `exec`'d and cached by the
+model (see `Model.get_deserializer()` and `Model.get_validator()`), so
+validating a resource object is a straight run of `isinstance()` checks
+instead of a walk over generic schema objects.
+
+Every function raises a `ValidationError` pointing to the member at fault,
+relative to the `pointer` it's given. Pointers are only built when an error
+is raised.
+"""
+
+import contextlib
+import linecache
+import typing
+
+from jsonapi_schema import ValidationError, unknown_member
+
+IDENTIFIER_MEMBERS = frozenset(["type", "id", "lid"])
+REF_MEMBERS = frozenset(["type", "id", "lid", "relationship"])
+RELATIONSHIP_MEMBERS = frozenset(["data"])
+
+
+def identity_error(obj: dict, pointer: str) -> ValidationError:
+    if "id" in obj and "lid" in obj:
+        return ValidationError("`id` and `lid` can't be used together.", pointer)
+
+    for member in ("id", "lid"):
+        if member in obj:
+            return ValidationError("Must be a string.", f"{pointer}/{member}")
+
+    return ValidationError("`id` or `lid` is required.", pointer)
+
+
+class Source:
+    """
+    The lines of a function being generated.
+    """
+
+    def __init__(self, name: str, args: str):
+        self.name = name
+        self.lines = [f"def {name}({args}):"]
+        self.depth = 1
+
+    def line(self, text: str):
+        self.lines.append("    " * self.depth + text)
+
+    @contextlib.contextmanager
+    def block(self, header: str):
+        self.line(header)
+        self.depth += 1
+        yield
+        self.depth -= 1
+
+    def fail(self, detail: str, pointer: str):
+        """
+        Adds a `raise` of a `ValidationError`, `pointer` is an expression.
+        """
+
+        self.line(f"raise ValidationError({detail!r}, {pointer})")
+
+    def compile(self, namespace: dict) -> typing.Callable:
+        source = "\n".join(self.lines) + "\n"
+        filename = f"<generated {self.name}>"
+
+        # Makes tracebacks show the generated source
+        lines = source.splitlines(True)
+        linecache.cache[filename] = (len(source), None, lines, filename)
+
+        exec(compile(source, filename, "exec"), namespace)
+        function = namespace[self.name]
+        function.__source__ = source
+
+        return function
+
+
+def pointer_to(pointer: str, *tokens: str) -> str:
+    """
+    Returns the expression of a pointer to a member below `pointer`.
+    """
+
+    if not tokens:
+        return pointer
+
+    return f"{pointer} + {'/' + '/'.join(tokens)!r}"
+
+
+def emit_identifier(source: Source, var: str, model: type, pointer: str):
+    """
+    Adds the checks of a resource identifier object of `model` in `var`.
+    """
+
+    with source.block(f"if not isinstance({var}, dict):"):
+        source.fail("Must be a resource identifier object.", pointer)
+    with source.block(f"if not {var}.keys() <= IDENTIFIER_MEMBERS:"):
+        source.line(f"raise unknown_member({var}, IDENTIFIER_MEMBERS, {pointer})")
+
+    resource_name = model.Meta.resource_name
+
+    with source.block(f"if {var}.get('type') != {resource_name!r}:"):
+        source.fail(f"Must be `{resource_name}`.", pointer_to(pointer, "type"))
+    emit_identity(source, var, pointer)
+
+
+def emit_identity(source: Source, var: str, pointer: str):
+    """
+    Adds the check that `var` has either a string `id` or a string `lid`.
+    """
+
+    with source.block(f"if 'id' in {var}:"):
+        with source.block(f"if 'lid' in {var} or not isinstance({var}['id'], str):"):
+            source.line(f"raise identity_error({var}, {pointer})")
+    with source.block(f"elif not isinstance({var}.get('lid'), str):"):
+        source.line(f"raise identity_error({var}, {pointer})")
+
+
+def emit_linkage(
+    source: Source, var: str, field, pointer: str, allow_none: bool = True
+):
+    """
+    Adds the checks of the resource linkage in `var` of the relationship
+    `field`: an array of resource identifier objects for a `ToMany`, a
+    single one for a `ToOne`, or `null` if `allow_none`.
+    """
+
+    if field.many:
+        condition = f"not isinstance({var}, list)"
+        if allow_none:
+            condition = f"{var} is not None and {condition}"
+
+        with source.block(f"if {condition}:"):
+            detail = "Must be an array or null." if allow_none else "Must be an array."
+            source.fail(detail, pointer)
+        with source.block(f"for i, item in enumerate({var} or ()):"):
+            emit_identifier(source, "item", field.model, f'f"{{{pointer}}}/{{i}}"')
+
+    elif allow_none:
+        with source.block(f"if {var} is not None:"):
+            emit_identifier(source, var, field.model, pointer)
+
+    else:
+        emit_identifier(source, var, field.model, pointer)
+
+
+def compile_deserializer(model: type, op_code: str) -> typing.Callable:
+    """
+    Compiles the function that validates the resource object of an `"add"`
+    or `"update"` operation on `model` and builds or updates the instance.
+
+    `"add"` functions are called as `(data, pk, get_object, register,
+    pointer)`, build a new instance with primary key `pk` and pass its `lid`
+    to `register(lid, instance)` before its relationships are set.
+    `"update"` functions are called as `(data, get_object, pointer)` and
+    update the instance `data` identifies. Both return the instance and
+    resolve resource identifier objects with `get_object(identifier,
+    pointer)`.
+    """
+
+    adding = op_code == "add"
+    resource_name = model.Meta.resource_name
+    attrs = model.Meta.editable_attrs
+    relationships = model.Meta.relationship_fields
+    members = {"type", "lid", "attributes", "relationships"}
+    if not adding:
+        members.add("id")
+
+    namespace = {
+        "ValidationError": ValidationError,
+        "unknown_member": unknown_member,
+        "identity_error": identity_error,
+        "IDENTIFIER_MEMBERS": IDENTIFIER_MEMBERS,
+        "RELATIONSHIP_MEMBERS": RELATIONSHIP_MEMBERS,
+        "RESOURCE_MEMBERS": frozenset(members),
+        "ATTRIBUTES": frozenset(attrs),
+        "RELATIONSHIPS": frozenset(relationships),
+        "model": model,
+    }
+
+    if adding:
+        args = "data, pk, get_object, register, pointer"
+    else:
+        args = "data, get_object, pointer"
+
+    source = Source(f"deserialize_{resource_name}_{op_code}", args)
+
+    # Resource object
+    with source.block("if not isinstance(data, dict):"):
+        source.fail("Must be a resource object.", "pointer")
+    with source.block("if not data.keys() <= RESOURCE_MEMBERS:"):
+        source.line("raise unknown_member(data, RESOURCE_MEMBERS, pointer)")
+    with source.block(f"if data.get('type') != {resource_name!r}:"):
+        source.fail(f"Must be `{resource_name}`.", pointer_to("pointer", "type"))
+
+    if adding:
+        with source.block("if 'lid' in data and not isinstance(data['lid'], str):"):
+            source.fail("Must be a string.", pointer_to("pointer", "lid"))
+    else:
+        emit_identity(source, "data", "pointer")
+
+    # Attributes
+    if adding and attrs:
+        with source.block("if 'attributes' not in data:"):
+            source.fail("`attributes` is required.", "pointer")
+    else:
+        with source.block(
+            "if 'attributes' not in data and 'relationships' not in data:"
+        ):
+            source.fail("`attributes` or `relationships` is required.", "pointer")
+
+    attributes_pointer = pointer_to("pointer", "attributes")
+    source.line("attributes = data.get('attributes', {})")
+    with source.block("if not isinstance(attributes, dict):"):
+        source.fail("Must be an object.", attributes_pointer)
+    with source.block("if not attributes and 'attributes' in data:"):
+        source.fail("Must not be empty.", attributes_pointer)
+    with source.block("if not attributes.keys() <= ATTRIBUTES:"):
+        source.line(
+            f"raise unknown_member(attributes, ATTRIBUTES, {attributes_pointer})"
+        )
+
+    for attr in attrs:
+        annotation = model.__annotations__[attr]
+        namespace[f"{attr}_type"] = annotation
+        value_pointer = pointer_to("pointer", "attributes", attr)
+
+        if adding:
+            with source.block(f"if {attr!r} not in attributes:"):
+                source.fail(f"`{attr}` is required.", attributes_pointer)
+            with source.block(
+                f"if not isinstance(attributes[{attr!r}], {attr}_type):"
+            ):
+                source.fail(f"Must be a {annotation.__name__}.", value_pointer)
+        else:
+            with source.block(
+                f"if {attr!r} in attributes"
+                f" and not isinstance(attributes[{attr!r}], {attr}_type):"
+            ):
+                source.fail(f"Must be a {annotation.__name__}.", value_pointer)
+
+    # Relationships
+    relationships_pointer = pointer_to("pointer", "relationships")
+    source.line("relationships = data.get('relationships', {})")
+    with source.block("if not isinstance(relationships, dict):"):
+        source.fail("Must be an object.", relationships_pointer)
+    with source.block("if not relationships and 'relationships' in data:"):
+        source.fail("Must not be empty.", relationships_pointer)
+    with source.block("if not relationships.keys() <= RELATIONSHIPS:"):
+        source.line(
+            "raise unknown_member(relationships, RELATIONSHIPS,"
+            f" {relationships_pointer})"
+        )
+
+    for rel in relationships:
+        field = getattr(model, rel)
+        rel_pointer = pointer_to("pointer", "relationships", rel)
+
+        with source.block(f"if {rel!r} in relationships:"):
+            source.line(f"relationship = relationships[{rel!r}]")
+            with source.block(
+                "if not isinstance(relationship, dict) or 'data' not in relationship:"
+            ):
+                source.fail("Must be a relationship object with `data`.", rel_pointer)
+            with source.block("if not relationship.keys() <= RELATIONSHIP_MEMBERS:"):
+                source.line(
+                    "raise unknown_member(relationship, RELATIONSHIP_MEMBERS,"
+                    f" {rel_pointer})"
+                )
+            source.line("linkage = relationship['data']")
+            emit_linkage(
+                source,
+                "linkage",
+                field,
+                pointer_to("pointer", "relationships", rel, "data"),
+            )
+
+    # Instance
+    if adding:
+        kwargs = ", ".join(f"{attr}=attributes[{attr!r}]" for attr in attrs)
+        source.line(f"instance = model(id=pk{', ' if kwargs else ''}{kwargs})")
+        with source.block("if 'lid' in data:"):
+            source.line("register(data['lid'], instance)")
+    else:
+        source.line("instance = get_object(data, pointer)")
+        for attr in attrs:
+            with source.block(f"if {attr!r} in attributes:"):
+                source.line(f"instance.{attr} = attributes[{attr!r}]")
+
+    for rel in relationships:
+        field = getattr(model, rel)
+
+        with source.block(f"if {rel!r} in relationships:"):
+            source.line(f"linkage = relationships[{rel!r}]['data']")
+            linkage_pointer = pointer_to("pointer", "relationships", rel, "data")
+
+            if field.many:
+                source.line(
+                    f"instance.{rel} = [get_object(item, {linkage_pointer} + '/' +"
+                    " str(index)) for index, item in enumerate(linkage or ())]"
+                )
+            else:
+                source.line(
+                    f"instance.{rel} = None if linkage is None"
+                    f" else get_object(linkage, {linkage_pointer})"
+                )
+
+    source.line("return instance")
+
+    return source.compile(namespace)
+
+
+def compile_validator(
+    model: type, key: str, relationship: str | None = None
+) -> typing.Callable:
+    """
+    Compiles the function that validates, called as `(value, pointer)`:
+
+    - the `ref` member of an operation on a relationship of `model` when
+      `key` is `"ref"`;
+    - the resource linkage in `data` of an operation with op code `key` on
+      `relationship` when it's given;
+    - the resource identifier object in `data` of a `"remove"` operation
+      otherwise.
+    """
+
+    resource_name = model.Meta.resource_name
+    namespace = {
+        "ValidationError": ValidationError,
+        "unknown_member": unknown_member,
+        "identity_error": identity_error,
+        "IDENTIFIER_MEMBERS": IDENTIFIER_MEMBERS,
+        "REF_MEMBERS": REF_MEMBERS,
+        "RELATIONSHIPS": frozenset(model.Meta.relationship_fields),
+    }
+
+    name = f"validate_{resource_name}_{key}"
+    if relationship is not None:
+        name += f"_{relationship}"
+
+    source = Source(name, "value, pointer")
+
+    if key == "ref":
+        with source.block("if not isinstance(value, dict):"):
+            source.fail("Must be an object.", "pointer")
+        with source.block("if not value.keys() <= REF_MEMBERS:"):
+            source.line("raise unknown_member(value, REF_MEMBERS, pointer)")
+        with source.block(f"if value.get('type') != {resource_name!r}:"):
+            source.fail(f"Must be `{resource_name}`.", pointer_to("pointer", "type"))
+        emit_identity(source, "value", "pointer")
+        with source.block("if 'relationship' not in value:"):
+            source.fail("`relationship` is required.", "pointer")
+        with source.block(
+            "if not isinstance(value['relationship'], str)"
+            " or value['relationship'] not in RELATIONSHIPS:"
+        ):
+            source.fail(
+                f"Must be a relationship of `{resource_name}`.",
+                pointer_to("pointer", "relationship"),
+            )
+
+    elif relationship is not None:
+        field = getattr(model, relationship)
+
+        if key == "update":
+            # To-one relationships can be replaced or cleared, to-many
+            # relationships are completely replaced.
+            emit_linkage(source, "value", field, "pointer")
+        elif field.many:
+            emit_linkage(source, "value", field, "pointer", allow_none=False)
+        else:
+            source.fail(
+                "Resources can only be added to or removed from to-many"
+                " relationships.",
+                "pointer",
+            )
+
+    else:
+        emit_identifier(source, "value", model, "pointer")
+
+    source.line("return value")
+
+    return source.compile(namespace)
@@ -0,0 +1,192 @@
+"""
+A feed of the batches committed through `/operations`, so other services can
+follow what changed instead of polling the collections.
+
+Every committed batch gets a sequence number, one more than the batch before
+it, and is kept encoded in a ring buffer of the last `FEED_SIZE` batches:
+
+    {"sequence": 1792203288219295526, "operations": [
+        {"op": "add", "type": "artist", "id": "1", "data": {...}},
+        {"op": "remove", "type": "illustration", "id": "4", "data": null}
+    ]}
+
+A consumer remembers the sequence of the last batch it has seen and asks for
+the batches after it. If they have been dropped from the buffer it gets a
+`FeedGapError` and has to fetch the collections again. Sequences start from
+the time the process started, so the sequences of a previous process are
+never reused and are reported as a gap too.
+
+The feed belongs to the process: with several workers, each has the batches
+it applied.
+"""
+
+import asyncio
+import collections
+import itertools
+import threading
+import time
+import typing
+
+from responses import document, encode, json_object
+
+# Batches kept in the feed
+FEED_SIZE = 10_000
+
+
+class FeedGapError(Exception):
+    def __init__(self, after: int, last: int):
+        self.after = after
+        self.last = last
+
+    def to_document(self) -> bytes:
+        return document(
+            {
+                "errors": encode(
+                    [
+                        {
+                            "status": "410",
+                            "title": "Changes no longer available",
+                            "detail": (
+                                f"The batches after `{self.after}` are no longer "
+                                "kept. Fetch the resources again and follow the "
+                                "batches after `meta.last`."
+                            ),
+                            "source": {"parameter": "after"},
+                            "meta": {"last": self.last},
+                        }
+                    ]
+                )
+            }
+        )
+
+
+def wake(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+class ChangeFeed:
+    """
+    Keeps the last `size` committed batches. Readers either get the batches
+    after a sequence right away or wait for the next one, blocking a thread
+    with `wait()` or an event loop task with `wait_async()`.
+    """
+
+    def __init__(self, size: int = FEED_SIZE):
+        # (sequence, encoded batch), the sequences are consecutive
+        self.batches: typing.Deque[typing.Tuple[int, bytes]] = collections.deque(
+            maxlen=size
+        )
+        # Sequence of the last batch published
+        self.last = time.time_ns()
+        # Sequence of the last batch reserved
+        self.reserved = self.last
+        # Sequence -> encoded batch, of the batches published before the
+        # ones reserved ahead of them
+        self.pending: typing.Dict[int, bytes] = {}
+        self.condition = threading.Condition()
+        # (event loop, future) of the tasks waiting in `wait_async()`
+        self.waiters: typing.Set[
+            typing.Tuple[asyncio.AbstractEventLoop, asyncio.Future]
+        ] = set()
+
+    def reserve(self) -> int:
+        """
+        Returns the sequence of the next batch, so a batch gets its place in
+        the feed when it commits and is published once it's durable. Every
+        sequence reserved has to be published, without operations if its
+        batch failed to commit.
+        """
+
+        with self.condition:
+            self.reserved += 1
+            return self.reserved
+
+    def publish(self, sequence: int, operations: typing.List[bytes]):
+        """
+        Adds the batch reserved as `sequence` with the encoded changes of its
+        operations. Readers get it, and are woken up, once the batches
+        reserved before it are published too.
+        """
+
+        with self.condition:
+            self.pending[sequence] = json_object(
+                {
+                    "sequence": b"%d" % sequence,
+                    "operations": b"[" + b",".join(operations) + b"]",
+                }
+            )
+
+            if self.last + 1 not in self.pending:
+                return
+
+            while self.last + 1 in self.pending:
+                self.last += 1
+                self.batches.append((self.last, self.pending.pop(self.last)))
+
+            self.condition.notify_all()
+
+            for loop, future in self.waiters:
+                loop.call_soon_threadsafe(wake, future)
+
+    def read(
+        self, after: int, limit: int
+    ) -> typing.Tuple[typing.List[typing.Tuple[int, bytes]], int]:
+        """
+        Returns up to `limit` `(sequence, batch)` pairs after the sequence
+        `after` and the sequence to read after next. Raises `FeedGapError` if
+        some of the batches after `after` are no longer kept.
+        """
+
+        with self.condition:
+            oldest = self.batches[0][0] if self.batches else self.last + 1
+
+            if not oldest - 1 <= after <= self.last:
+                raise FeedGapError(after, self.last)
+
+            start = after - oldest + 1
+            batches = list(itertools.islice(self.batches, start, start + limit))
+
+        return batches, after + len(batches)
+
+    def wait(
+        self, after: int, limit: int, timeout: float
+    ) -> typing.Tuple[typing.List[typing.Tuple[int, bytes]], int]:
+        """
+        Like `read()`, but waits up to `timeout` seconds for a batch if there
+        is none after `after` yet.
+        """
+
+        with self.condition:
+            self.condition.wait_for(lambda: self.last != after, timeout)
+
+        return self.read(after, limit)
+
+    async def wait_async(
+        self, after: int, limit: int, timeout: float
+    ) -> typing.Tuple[typing.List[typing.Tuple[int, bytes]], int]:
+        """
+        Like `wait()`, but waits without blocking the event loop.
+        """
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        with self.condition:
+            waiting = self.last == after
+            if waiting:
+                self.waiters.add((loop, future))
+
+        if waiting:
+            try:
+                await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                with self.condition:
+                    self.waiters.discard((loop, future))
+
+        return self.read(after, limit)
+
+
+change_feed = ChangeFeed()
@@ -0,0 +1,197 @@
+"""
+Makes retries of a POST to `/operations` safe. A client sends the same
+`Idempotency-Key` header with every attempt of a batch; the first attempt that
+commits records its response under the key and the attempts after it get that
+response back, without the body being validated or applied again.
+
+Responses are kept in memory, least recently used first out, for `CACHE_TTL`
+seconds and up to `CACHE_SIZE` bytes in total. A key is tied to the SHA-256
+of the body it was first sent with, reusing it for another body is an error.
+"""
+
+import collections
+import hashlib
+import threading
+import time
+import typing
+
+from responses import document, encode
+
+# Bytes of responses kept at most
+CACHE_SIZE = 64 * 1024 * 1024
+
+# Seconds a response is kept for after it's recorded
+CACHE_TTL = 24 * 60 * 60
+
+# Longest key accepted
+MAX_KEY_LENGTH = 255
+
+
+class IdempotencyError(Exception):
+    def __init__(self, status: int, title: str, detail: str):
+        self.status = status
+        self.title = title
+        self.detail = detail
+
+    def to_document(self) -> bytes:
+        return document(
+            {
+                "errors": encode(
+                    [
+                        {
+                            "status": str(self.status),
+                            "title": self.title,
+                            "detail": self.detail,
+                            "source": {"header": "Idempotency-Key"},
+                        }
+                    ]
+                )
+            }
+        )
+
+
+class Entry:
+    __slots__ = ("fingerprint", "body", "expires")
+
+    def __init__(self, fingerprint: str, body: bytes, expires: float):
+        self.fingerprint = fingerprint
+        self.body = body
+        self.expires = expires
+
+    def replay(self, fingerprint: str) -> bytes:
+        """
+        Returns the recorded response for a retry with a body of
+        `fingerprint`.
+        """
+
+        if fingerprint != self.fingerprint:
+            raise IdempotencyError(
+                422,
+                "Idempotency-Key reused",
+                "The key was already used for a different request body.",
+            )
+
+        return self.body
+
+
+class IdempotencyCache:
+    """
+    Maps keys to the responses recorded for them, and tracks the keys whose
+    first attempt is still being applied so a concurrent retry isn't applied
+    too.
+    """
+
+    def __init__(self, size: int = CACHE_SIZE, ttl: float = CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        # key -> entry, least recently used first
+        self.entries: typing.OrderedDict[str, Entry] = collections.OrderedDict()
+        # Bytes of the bodies in `entries`
+        self.used = 0
+        # Keys of the attempts being applied
+        self.pending: typing.Set[str] = set()
+        self.lock = threading.Lock()
+
+    def begin(self, key: str) -> Entry | None:
+        """
+        Returns the entry recorded for `key` if there is one. Otherwise marks
+        the key as pending and returns `None`: the caller applies the request
+        and must then call `record()` or `release()`.
+        """
+
+        if not key or len(key) > MAX_KEY_LENGTH:
+            raise IdempotencyError(
+                400,
+                "Invalid Idempotency-Key",
+                f"Must have between 1 and {MAX_KEY_LENGTH} characters.",
+            )
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is not None and entry.expires <= time.monotonic():
+                self.remove(key)
+                entry = None
+
+            if entry is not None:
+                self.entries.move_to_end(key)
+                return entry
+
+            if key in self.pending:
+                raise IdempotencyError(
+                    409,
+                    "Request in progress",
+                    "A request with the same key is still being applied.",
+                )
+
+            self.pending.add(key)
+            return None
+
+    def record(self, key: str, fingerprint: str, body: bytes):
+        """
+        Records the response of a committed request, evicting the least
+        recently used and the expired responses to make room for it. The
+        latest response is kept even if it's larger than the cache.
+        """
+
+        now = time.monotonic()
+
+        with self.lock:
+            self.pending.discard(key)
+            self.remove(key)
+            self.entries[key] = Entry(fingerprint, body, now + self.ttl)
+            self.used += len(body)
+
+            while len(self.entries) > 1:
+                oldest_key, oldest = next(iter(self.entries.items()))
+
+                if self.used <= self.size and oldest.expires > now:
+                    break
+
+                self.remove(oldest_key)
+
+    def release(self, key: str):
+        """
+        Drops the pending mark of a request that failed, so it can be retried.
+        """
+
+        with self.lock:
+            self.pending.discard(key)
+
+    def remove(self, key: str):
+        entry = self.entries.pop(key, None)
+
+        if entry is not None:
+            self.used -= len(entry.body)
+
+
+class FingerprintReader:
+    """
+    Wraps a request body stream, hashing what is read from it.
+    """
+
+    def __init__(self, stream: typing.BinaryIO):
+        self.stream = stream
+        self.hash = hashlib.sha256()
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.stream.read(size)
+        self.hash.update(data)
+        return data
+
+    def fingerprint(self) -> str:
+        """
+        Reads the rest of the stream and returns the hash of the whole body.
+        """
+
+        while self.read(64 * 1024):
+            pass
+
+        return self.hash.hexdigest()
+
+
+def fingerprint(body: bytes) -> str:
+    return hashlib.sha256(body).hexdigest()
+
+
+idempotency_cache = IdempotencyCache()
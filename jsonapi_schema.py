@@ -1,35 +1,237 @@
 """
 Schema to validate an `atomic:operations` JSON body sent in a request.
+
+`schema` is the definition of a valid body. Requests are validated with
+`validate_operations()`, the same checks written out by hand so each
+operation is checked in a single pass, reporting the member at fault. It
+also checks what `schema` can't express without the models: the types of
+`ref` and of the resource object of an operation without `ref` must be
+known, and that resource object must be an object.
 """
 
+import typing
+
 from schema import Schema, And, Or, Use, Optional
 
+from responses import document, encode
+
 resource_schema = Schema(
-    {"type": str, Optional(Or("id", "lid")): str, Optional("attributes"): dict}
+    {
+        "type": str,
+        Optional(Or("id", "lid")): str,
+        Optional("attributes"): dict,
+        Optional("relationships"): dict,
+    }
 )
 
-schema = Schema(
-    {
-        "atomic:operations": [
-            And(
+operation_schema = Schema(
+    And(
+        {
+            "op": Or("add", "update", "remove"),
+            Optional("ref"): Or(
                 {
-                    "op": Or("add", "update", "remove"),
-                    Optional("ref"): Or(
+                    "type": str,
+                    Or("id", "lid"): str,
+                    Optional("relationship"): str,
+                }
+            ),
+            Optional("href"): str,
+            Optional("data"): Or(
+                Optional(resource_schema), [Optional(resource_schema)], None
+            ),
+            Optional("meta"): dict,
+        },
+        lambda op: not ("ref" in op.keys() and "href" in op.keys())
+        and ("ref" in op.keys() or "data" in op.keys()),
+    )
+)
+
+schema = Schema({"atomic:operations": [operation_schema]})
+
+
+OP_CODES = frozenset(["add", "update", "remove"])
+
+BODY_MEMBERS = frozenset(["atomic:operations"])
+
+OPERATION_MEMBERS = frozenset(["op", "ref", "href", "data", "meta"])
+REF_MEMBERS = frozenset(["type", "id", "lid", "relationship"])
+RESOURCE_MEMBERS = frozenset(["type", "id", "lid", "attributes", "relationships"])
+
+
+class ValidationError(ValueError):
+    """
+    An invalid request body. `pointer` is the JSON pointer of the member at
+    fault, e.g. `/atomic:operations/3/data/type`.
+    """
+
+    def __init__(self, detail: str, pointer: str):
+        super().__init__(f"{pointer}: {detail}")
+        self.detail = detail
+        self.pointer = pointer
+
+    def to_document(self) -> bytes:
+        return document(
+            {
+                "errors": encode(
+                    [
                         {
-                            "type": str,
-                            Or("id", "lid"): str,
-                            Optional("relationship"): str,
+                            "status": "400",
+                            "title": "Invalid request body",
+                            "detail": self.detail,
+                            "source": {"pointer": self.pointer},
                         }
-                    ),
-                    Optional("href"): str,
-                    Optional("data"): Or(
-                        Optional(resource_schema), [Optional(resource_schema)], None
-                    ),
-                    Optional("meta"): dict,
-                },
-                lambda op: not ("ref" in op.keys() and "href" in op.keys())
-                and ("ref" in op.keys() or "data" in op.keys()),
-            )
-        ]
-    }
-)
+                    ]
+                )
+            }
+        )
+
+
+def unknown_member(obj: dict, members: frozenset, pointer: str) -> ValidationError:
+    """
+    Returns the error for the first member of `obj` not in `members`.
+    """
+
+    unknown = next(key for key in obj.keys() if key not in members)
+    # Escaped as a JSON pointer reference token
+    token = unknown.replace("~", "~0").replace("/", "~1")
+
+    return ValidationError(f"Unknown member `{unknown}`.", f"{pointer}/{token}")
+
+
+def check_members(obj: dict, members: frozenset, pointer: str):
+    if not obj.keys() <= members:
+        raise unknown_member(obj, members, pointer)
+
+
+def check_string(obj: dict, member: str, pointer: str, required: bool = False):
+    if member in obj:
+        if not isinstance(obj[member], str):
+            raise ValidationError("Must be a string.", f"{pointer}/{member}")
+    elif required:
+        raise ValidationError(f"`{member}` is required.", pointer)
+
+
+def check_object(obj: dict, member: str, pointer: str):
+    if member in obj and not isinstance(obj[member], dict):
+        raise ValidationError("Must be an object.", f"{pointer}/{member}")
+
+
+def validate_resource(resource: typing.Any, pointer: str):
+    if not isinstance(resource, dict):
+        raise ValidationError("Must be a resource object.", pointer)
+
+    check_members(resource, RESOURCE_MEMBERS, pointer)
+    check_string(resource, "type", pointer, required=True)
+    check_string(resource, "id", pointer)
+    check_string(resource, "lid", pointer)
+    check_object(resource, "attributes", pointer)
+    check_object(resource, "relationships", pointer)
+
+
+def check_type(obj: dict, resource_types: typing.Container[str], pointer: str):
+    if obj["type"] not in resource_types:
+        raise ValidationError(
+            f"Unknown resource type `{obj['type']}`.", f"{pointer}/type"
+        )
+
+
+def validate_operation(
+    operation: typing.Any, index: int, resource_types: typing.Container[str]
+) -> dict:
+    """
+    Validates the operation at `index` of the `atomic:operations` array
+    against `operation_schema`, with the types in `resource_types`. Returns
+    the operation.
+    """
+
+    pointer = f"/atomic:operations/{index}"
+
+    if not isinstance(operation, dict):
+        raise ValidationError("Must be an operation object.", pointer)
+
+    check_members(operation, OPERATION_MEMBERS, pointer)
+
+    op = operation.get("op")
+    if not isinstance(op, str) or op not in OP_CODES:
+        raise ValidationError(
+            "Must be one of `add`, `update` or `remove`.", f"{pointer}/op"
+        )
+
+    if "ref" in operation:
+        ref = operation["ref"]
+        ref_pointer = f"{pointer}/ref"
+
+        if "href" in operation:
+            raise ValidationError("`ref` and `href` can't be used together.", pointer)
+
+        if not isinstance(ref, dict):
+            raise ValidationError("Must be an object.", ref_pointer)
+
+        check_members(ref, REF_MEMBERS, ref_pointer)
+        check_string(ref, "type", ref_pointer, required=True)
+        check_string(ref, "id", ref_pointer)
+        check_string(ref, "lid", ref_pointer)
+        check_string(ref, "relationship", ref_pointer)
+
+        if "id" not in ref and "lid" not in ref:
+            raise ValidationError("`id` or `lid` is required.", ref_pointer)
+
+        check_type(ref, resource_types, ref_pointer)
+
+    elif "data" not in operation:
+        raise ValidationError("`ref` or `data` is required.", pointer)
+
+    check_string(operation, "href", pointer)
+    check_object(operation, "meta", pointer)
+
+    data = operation.get("data")
+
+    if "ref" not in operation:
+        # The operation is on the resource object itself
+        validate_resource(data, f"{pointer}/data")
+        check_type(data, resource_types, f"{pointer}/data")
+    elif isinstance(data, list):
+        for i, resource in enumerate(data):
+            validate_resource(resource, f"{pointer}/data/{i}")
+    elif data is not None:
+        validate_resource(data, f"{pointer}/data")
+
+    return operation
+
+
+def reject_member(member: str):
+    """
+    Raises the error `validate_operations()` raises for a body with a
+    top-level `member` other than `atomic:operations`, for bodies that are
+    parsed as they're read.
+    """
+
+    raise unknown_member({member: None}, BODY_MEMBERS, "")
+
+
+def validate_operations(
+    body: typing.Any, resource_types: typing.Container[str]
+) -> typing.List[dict]:
+    """
+    Validates a request body against `schema` with the types in
+    `resource_types`, raising a `ValidationError` for the first invalid
+    member. Returns the operations.
+    """
+
+    if not isinstance(body, dict):
+        raise ValidationError("Must be an object.", "")
+
+    check_members(body, BODY_MEMBERS, "")
+
+    if "atomic:operations" not in body:
+        raise ValidationError("`atomic:operations` is required.", "")
+
+    operations = body["atomic:operations"]
+
+    if not isinstance(operations, list):
+        raise ValidationError("Must be an array.", "/atomic:operations")
+
+    for index, operation in enumerate(operations):
+        validate_operation(operation, index, resource_types)
+
+    return operations
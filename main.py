@@ -2,151 +2,255 @@
 Main APP
 """
 
-import json
 import typing
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 
-from jsonapi_schema import schema
-from operations import type_to_operation_set
-from models import Illustration, Artist, User
+from api import (
+    ENDPOINTS,
+    QueryParameterError,
+    apply_operation_stream,
+    apply_operation_stream_once,
+    apply_operations,
+    apply_operations_once,
+    collection_etag,
+    etag_matches,
+    get_export_models,
+    get_resource,
+    list_resources,
+    read_changes,
+    resource_etag,
+    setup_storage,
+    stream_changes,
+)
+from bulk import BulkImportError, export_rows, import_rows
+from feed import FeedGapError
+from idempotency import IdempotencyError
+from jsonapi_schema import ValidationError
+from models import Model, Illustration, Artist, User
+from responses import document, encode, iter_collection, resource_array
+from streaming import ParseError
 
 app = Flask(__name__)
 
+# When enabled, collection routes stream the `data` array as it is
+# serialized instead of building the whole document in memory first.
+app.config.setdefault("JSONAPI_STREAM_COLLECTIONS", False)
 
-def get_op_resource_type(op: dict):
-    if op.get("ref", None) is not None:
-        return op["ref"]["type"]
+# When enabled, `/operations` applies each operation as soon as it's parsed
+# instead of reading the whole request body first.
+app.config.setdefault("JSONAPI_STREAM_OPERATIONS", False)
+
+setup_storage()
+
+
+def jsonapi_response(body: bytes | typing.Iterator[bytes], status: int = 200):
+    return Response(body, status=status, mimetype=app.json.mimetype)
+
+
+def not_modified(etag: str) -> Response | None:
+    """
+    Returns a `304 Not Modified` response if the request's `If-None-Match`
+    header has `etag`, before anything is read or serialized.
+    """
+
+    if etag_matches(request.headers.get("If-None-Match"), etag):
+        return Response(status=304, headers={"ETag": etag})
+
+    return None
+
+
+@app.errorhandler(QueryParameterError)
+def query_parameter_error(error: QueryParameterError):
+    return jsonapi_response(error.to_document(), status=400)
+
+
+@app.errorhandler(ValidationError)
+def validation_error(error: ValidationError):
+    return jsonapi_response(error.to_document(), status=400)
+
+
+@app.errorhandler(ParseError)
+def parse_error(error: ParseError):
+    return jsonapi_response(
+        document(
+            {
+                "errors": encode(
+                    [
+                        {
+                            "status": "400",
+                            "title": "Invalid request body",
+                            "detail": str(error),
+                        }
+                    ]
+                )
+            }
+        ),
+        status=400,
+    )
+
+
+@app.errorhandler(IdempotencyError)
+def idempotency_error(error: IdempotencyError):
+    return jsonapi_response(error.to_document(), status=error.status)
+
+
+@app.errorhandler(FeedGapError)
+def feed_gap_error(error: FeedGapError):
+    return jsonapi_response(error.to_document(), status=410)
+
+
+@app.errorhandler(BulkImportError)
+def bulk_import_error(error: BulkImportError):
+    return jsonapi_response(error.to_document(), status=400)
+
+
+def collection_response(model: typing.Type[Model]):
+    """
+    Lists the instances of `model`, supporting pagination and sparse
+    fieldsets. Answers `304 Not Modified` if the client has the current
+    version of the collection.
+    """
+
+    etag = collection_etag(model, request.args)
+    if (response := not_modified(etag)) is not None:
+        return response
+
+    instances, fields, members = list_resources(
+        model, request.args, request.base_url
+    )
+
+    if app.config["JSONAPI_STREAM_COLLECTIONS"]:
+        response = jsonapi_response(iter_collection(instances, fields, members))
     else:
-        return op["data"]["type"]
+        response = jsonapi_response(
+            document({"data": resource_array(instances, fields), **members})
+        )
+
+    response.headers["ETag"] = etag
+    return response
+
+
+def detail_response(model: typing.Type[Model], pk: str):
+    etag = resource_etag(model, pk, request.args)
+
+    if etag is not None and (response := not_modified(etag)) is not None:
+        return response
+
+    response = jsonapi_response(get_resource(model, pk, request.args))
+
+    if etag is not None:
+        response.headers["ETag"] = etag
+
+    return response
 
 
 @app.route("/")
 def endpoints():
-    return jsonify(
-        {
-            "endpoints": [
-                "/                  - GET  - Lists all endpoints in this app"
-                "/operations        - POST - Make atomic operations here",
-                "/artists           - GET  - Lists all artists in the DB",
-                "/artists/:id       - GET  - Get an artist's details by it's ID",
-                "/illustrations     - GET  - Lists all illustrations in the DB",
-                "/illustrations/:id - GET  - Get an illustration's details by it's ID",
-                "/users             - GET  - Lists all illustrations in the DB",
-                "/users/:id         - GET  - Get an user's details by it's ID",
-            ]
-        }
-    )
+    return jsonify({"endpoints": ENDPOINTS})
 
 
 @app.route("/operations", methods=["POST"])
 def operations():
-    schema.validate(request.json)
-
-    lid_list = []
-    responses = []
-    for op in request.json["atomic:operations"]:
-        response = getattr(
-            type_to_operation_set[get_op_resource_type(op)](lid_list=lid_list), op["op"]
-        )(
-            ref=op.get("ref", None),
-            data=op.get("data", None),
+    """
+    Applies a batch of operations. Retries of a committed batch sent with
+    the same `Idempotency-Key` header get its response back instead.
+    """
+
+    stream = app.config["JSONAPI_STREAM_OPERATIONS"]
+    key = request.headers.get("Idempotency-Key")
+
+    if key is None:
+        if stream:
+            return jsonapi_response(apply_operation_stream(request.stream))
+
+        return jsonapi_response(apply_operations(request.json))
+
+    if stream:
+        body, replayed = apply_operation_stream_once(key, request.stream)
+    else:
+        # `request.json` parses the data `get_data()` cached
+        body, replayed = apply_operations_once(
+            key, request.get_data(), lambda data: request.json
         )
-        if response.lid:
-            lid_list.append((response.lid, response.instance))
-        responses.append(response)
-
-    return jsonify(
-        {
-            "jsonapi": {
-                "version": "1.1",
-                "ext": ["https://jsonapi.org/ext/atomic"],
-            },
-            "atomic:results": [
-                response.instance.to_json()
-                for instance in responses
-                if response.instance is not None
-            ],
-        }
+
+    response = jsonapi_response(body)
+
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+
+    return response
+
+
+@app.route("/bulk/export")
+def bulk_export():
+    """
+    Streams every resource, or only those of the types in `type`, as NDJSON.
+    """
+
+    return Response(
+        export_rows(get_export_models(request.args)),
+        mimetype="application/x-ndjson",
+    )
+
+
+@app.route("/bulk/import", methods=["POST"])
+def bulk_import():
+    counts = import_rows(request.stream)
+
+    return jsonapi_response(document({"meta": encode({"imported": counts})}))
+
+
+@app.route("/changes")
+def changes():
+    """
+    Long polls the batches committed after `after`.
+    """
+
+    return jsonapi_response(read_changes(request.args))
+
+
+@app.route("/changes/stream")
+def changes_stream():
+    """
+    Streams the committed batches as server-sent events.
+    """
+
+    events = stream_changes(request.args, request.headers.get("Last-Event-ID"))
+
+    return Response(
+        events, mimetype="text/event-stream", headers={"Cache-Control": "no-cache"}
     )
 
 
 @app.route("/artists")
 def artists():
-    return jsonify(
-        {
-            "jsonapi": {
-                "version": "1.1",
-                "ext": ["https://jsonapi.org/ext/atomic"],
-            },
-            "data": [artist.to_json() for artist in Artist.all()],
-        }
-    )
+    return collection_response(Artist)
 
 
 @app.route("/artists/<id>")
 def artist_detail(id):
-    return jsonify(
-        {
-            "jsonapi": {
-                "version": "1.1",
-                "ext": ["https://jsonapi.org/ext/atomic"],
-            },
-            "data": Artist.get(pk=id).to_json(),
-        }
-    )
+    return detail_response(Artist, id)
 
 
 @app.route("/illustrations")
 def illustrations():
-    return jsonify(
-        {
-            "jsonapi": {
-                "version": "1.1",
-                "ext": ["https://jsonapi.org/ext/atomic"],
-            },
-            "data": [illustration.to_json() for illustration in Illustration.all()],
-        }
-    )
+    return collection_response(Illustration)
 
 
 @app.route("/illustrations/<id>")
 def illustration_detail(id):
-    return jsonify(
-        {
-            "jsonapi": {
-                "version": "1.1",
-                "ext": ["https://jsonapi.org/ext/atomic"],
-            },
-            "data": Illustration.get(pk=id).to_json(),
-        }
-    )
+    return detail_response(Illustration, id)
 
 
 @app.route("/users")
 def users():
-    return jsonify(
-        {
-            "jsonapi": {
-                "version": "1.1",
-                "ext": ["https://jsonapi.org/ext/atomic"],
-            },
-            "data": [user.to_json() for user in User.all()],
-        }
-    )
+    return collection_response(User)
 
 
 @app.route("/users/<id>")
 def user_detail(id):
-    return jsonify(
-        {
-            "jsonapi": {
-                "version": "1.1",
-                "ext": ["https://jsonapi.org/ext/atomic"],
-            },
-            "data": User.get(pk=id).to_json(),
-        }
-    )
+    return detail_response(User, id)
 
 
 if __name__ == "__main__":
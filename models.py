@@ -3,162 +3,749 @@ This module contains "Models" that emulate Django models. The `to_json()`
 method would be replaced by DRF serializers in a Django APP.
 """
 
+import array
+import contextlib
+import contextvars
+import sys
+import threading
 import typing
 
+from codegen import compile_deserializer, compile_validator
+from responses import encode
+from storage import DictStorage, ReverseIndex, Storage
+
+
+class IdSequence:
+    """
+    Hands out monotonically increasing primary keys for a model. It's seeded
+    with the highest ID in the storage the first time it's used, so adding a
+    resource doesn't need to look at the rest of the table.
+    """
+
+    def __init__(self, seed: typing.Callable[[], int]):
+        self.seed = seed
+        self.last: int | None = None
+        self.lock = threading.Lock()
+
+    def reset(self):
+        """
+        Forgets the last ID so the next allocation seeds from the storage again.
+        """
+
+        with self.lock:
+            self.last = None
+
+    def rewind(self, last: int | None):
+        """
+        Hands out the IDs after `last` again, a value of `last` read before.
+        The IDs allocated since must not be in use, so it's only safe while
+        no other transaction can allocate IDs.
+        """
+
+        with self.lock:
+            self.last = last
+
+    def allocate(self, count: int = 1) -> typing.List[str]:
+        """
+        Reserves a block of `count` consecutive IDs.
+        """
+
+        with self.lock:
+            if self.last is None:
+                self.last = self.seed()
+
+            first = self.last + 1
+            self.last += count
+
+        return [str(pk) for pk in range(first, first + count)]
+
+    def next(self) -> str:
+        return self.allocate()[0]
+
+
+class Transaction:
+    """
+    A set of changes to the storage that is written all at once when it
+    commits, or dropped when it rolls back.
+
+    Instances read through `Model.get()` inside a transaction are private
+    copies of the committed ones (copy-on-write), so the storage is never
+    modified until commit. Both commit and rollback take time proportional to
+    the rows the transaction touched, not to the size of the storage.
+    """
+
+    def __init__(self):
+        # (model, pk) -> the transaction's version of the row, `None` if it
+        # was deleted
+        self.rows: typing.Dict[typing.Tuple[type, str], Model | None] = {}
+        # model -> pks of the rows saved or deleted by the transaction, in
+        # the order they were first written
+        self.written: typing.Dict[type, typing.Dict[str, None]] = {}
+        # (model, pk) of the rows saved by the transaction that weren't in
+        # the storage
+        self.created: typing.Set[typing.Tuple[type, str]] = set()
+        # Reverse index of the rows written by the transaction only
+        self.reverse_index = ReverseIndex(indexed_relationships)
+        # Called once the transaction is written
+        self.callbacks: typing.List[typing.Callable[[], None]] = []
+        # Called once the transaction is durable, or failed to be
+        self.durable_callbacks: typing.List[typing.Callable[[bool], None]] = []
+
+    def get(self, model: typing.Type["Model"], pk: str) -> "Model":
+        key = (model, pk)
+
+        if key in self.rows:
+            instance = self.rows[key]
+            if instance is None:
+                raise KeyError(pk)
+
+            return instance
+
+        instance = storage.get(model, pk).copy()
+        self.rows[key] = instance
+
+        return instance
+
+    def save(self, instance: "Model"):
+        model = type(instance)
+        key = (model, instance.id)
+
+        if key not in self.rows and not storage.contains(model, instance.id):
+            self.created.add(key)
+
+        self.rows[key] = instance
+        self.written.setdefault(model, {})[instance.id] = None
+        self.reverse_index.update(instance)
+
+    def delete(self, instance: "Model"):
+        model = type(instance)
+        key = (model, instance.id)
+
+        if key in self.rows:
+            exists = self.rows[key] is not None
+        else:
+            exists = storage.contains(model, instance.id)
+
+        if not exists:
+            raise KeyError(instance.id)
+
+        self.rows[key] = None
+        self.written.setdefault(model, {})[instance.id] = None
+        self.reverse_index.remove(instance)
+
+    def reverse_lookup(
+        self, model: typing.Type["Model"], relationship: str, pk: str
+    ) -> typing.Set[str]:
+        """
+        Like `Storage.reverse_lookup()`, but as seen from inside the
+        transaction.
+        """
+
+        committed = storage.reverse_lookup(relationship, pk)
+        committed -= self.written.get(model, {}).keys()
+
+        return committed | self.reverse_index.get(relationship, pk)
+
+    def on_commit(self, callback: typing.Callable[[], None]):
+        """
+        Calls `callback` after the transaction is written, while no other
+        transaction can write yet, so callbacks of different transactions
+        are called in the order they committed. Nothing is called if it
+        rolls back.
+        """
+
+        self.callbacks.append(callback)
+
+    def after_commit(self, callback: typing.Callable[[bool], None]):
+        """
+        Calls `callback(True)` once the transaction is durable, when the
+        transaction of the storage has ended (after SQLite's `COMMIT` or the
+        sync of the log), or `callback(False)` if the storage fails to commit
+        it. Other transactions may have committed in between, so callbacks of
+        different transactions can be called in any order. Nothing is called
+        if it rolls back.
+        """
+
+        self.durable_callbacks.append(callback)
+
+    def commit(self):
+        storage.write(
+            (model, pk, self.rows[(model, pk)])
+            for model, pks in self.written.items()
+            for pk in pks
+        )
+
+        for callback in self.callbacks:
+            callback()
+
+    def ended(self, durable: bool):
+        for callback in self.durable_callbacks:
+            callback(durable)
+
+    def rollback(self):
+        """
+        Drops the changes of the transaction. It can be used again after.
+        """
+
+        self.rows.clear()
+        self.written.clear()
+        self.created.clear()
+        self.reverse_index = ReverseIndex(indexed_relationships)
+        self.callbacks.clear()
+        self.durable_callbacks.clear()
 
-class Model:
+
+current_transaction: contextvars.ContextVar[Transaction | None] = (
+    contextvars.ContextVar("current_transaction", default=None)
+)
+
+
+@contextlib.contextmanager
+def atomic() -> typing.Iterator[Transaction]:
+    """
+    Runs the block in a transaction that commits if the block finishes and
+    rolls back if it raises. Blocks nested in another `atomic()` block join
+    the outer transaction.
+
+    The whole block runs in a transaction of the storage too, so it's the
+    only one writing to it until it finishes.
+    """
+
+    transaction = current_transaction.get()
+
+    if transaction is not None:
+        yield transaction
+        return
+
+    transaction = Transaction()
+    token = current_transaction.set(transaction)
+
+    try:
+        with storage.transaction():
+            if storage.shared:
+                # Other processes may have added rows since the last
+                # transaction
+                for model in type_to_model.values():
+                    model.id_sequence.reset()
+
+            try:
+                yield transaction
+            except BaseException:
+                transaction.rollback()
+                raise
+            else:
+                transaction.commit()
+    except BaseException:
+        # Nothing is left to call if it rolled back
+        transaction.ended(False)
+        raise
+    else:
+        transaction.ended(True)
+    finally:
+        current_transaction.reset(token)
+
+
+class ToOne:
+    """
+    A to-one relationship field. Only the interned primary key of the related
+    instance is stored, the instance is looked up when the field is read.
+    """
+
+    many = False
+
+    def __init__(self, name: str, annotation):
+        self.name = name
+        self.annotation = annotation
+        self.slot = f"_{name}_id"
+
+    @property
+    def model(self) -> typing.Type["Model"]:
+        return related_model(self.annotation)
+
+    def ids(self, instance) -> typing.List[str]:
+        pk = getattr(instance, self.slot, None)
+        return [pk] if pk is not None else []
+
+    def set_ids(self, instance, pks: typing.Iterable[str]):
+        pks = list(pks)
+        setattr(instance, self.slot, sys.intern(pks[0]) if pks else None)
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+
+        pk = getattr(instance, self.slot, None)
+        if pk is None:
+            return None
+
+        return related_model(self.annotation).get(pk)
+
+    def __set__(self, instance, value):
+        setattr(instance, self.slot, None if value is None else sys.intern(value.id))
+
+
+class ToMany:
+    """
+    A to-many relationship field. The primary keys of the related instances
+    are stored in an `array("q")`, the instances are looked up when the field
+    is read.
+    """
+
+    many = True
+
+    def __init__(self, name: str, annotation):
+        self.name = name
+        self.annotation = annotation
+        self.slot = f"_{name}_ids"
+
+    @property
+    def model(self) -> typing.Type["Model"]:
+        return related_model(self.annotation)
+
+    def ids(self, instance) -> typing.List[str]:
+        return [str(pk) for pk in getattr(instance, self.slot, ())]
+
+    def set_ids(self, instance, pks: typing.Iterable[str]):
+        # Built from a list so the array is allocated at its exact size
+        setattr(instance, self.slot, array.array("q", [int(pk) for pk in pks]))
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+
+        model = related_model(self.annotation)
+
+        return [model.get(pk) for pk in self.ids(instance)]
+
+    def __set__(self, instance, value):
+        self.set_ids(instance, (related.id for related in value or ()))
+
+
+def related_model(annotation) -> typing.Type["Model"]:
+    """
+    Returns the model in a relationship annotation like `typing.List[Artist]`
+    or `Artist | None`.
+    """
+
+    for arg in typing.get_args(annotation) or (annotation,):
+        if isinstance(arg, ModelMeta):
+            return arg
+
+    raise TypeError(f"`{annotation}` does not point to a model")
+
+
+class ModelMeta(type):
+    """
+    Builds the `__slots__` of a model from its class annotations so that
+    instances don't carry a `__dict__`. Fields listed in
+    `Meta.relationship_fields` become `ToOne`/`ToMany` fields that store
+    primary keys instead of instances.
+    """
+
+    def __new__(mcs, name, bases, namespace):
+        meta = namespace.get("Meta", None)
+        relationship_fields = getattr(meta, "relationship_fields", [])
+
+        slots = []
+        defaults = {}
+
+        for field, annotation in namespace.get("__annotations__", {}).items():
+            if typing.get_origin(annotation) is typing.ClassVar:
+                continue
+
+            # Slots can't have class level defaults, they are set by
+            # `Model.__new__` instead
+            if field in namespace:
+                defaults[field] = namespace.pop(field)
+
+            if field in relationship_fields:
+                field_type = ToMany if typing.get_origin(annotation) is list else ToOne
+                namespace[field] = field_type(field, annotation)
+                slots.append(namespace[field].slot)
+            else:
+                slots.append(field)
+
+        namespace["__slots__"] = tuple(slots)
+
+        cls = super().__new__(mcs, name, bases, namespace)
+
+        cls._defaults = {
+            **{
+                field: value
+                for base in bases
+                for field, value in getattr(base, "_defaults", {}).items()
+            },
+            **defaults,
+        }
+        # Functions compiled by `get_deserializer()` and `get_validator()`
+        cls._compiled = {}
+        # Every slot but the cached representations makes up the state of an
+        # instance
+        cls._state_slots = tuple(
+            slot
+            for klass in reversed(cls.__mro__)
+            for slot in klass.__dict__.get("__slots__", ())
+            if slot not in ("_json", "_json_bytes")
+        )
+
+        return cls
+
+
+class Model(metaclass=ModelMeta):
     id: str
+    id_sequence: typing.ClassVar[IdSequence]
+
+    # The full resource object and its encoded JSON, built on the first
+    # `to_json()`/`to_json_bytes()` call and dropped whenever the instance is
+    # saved or deleted
+    _json: dict | None = None
+    _json_bytes: bytes | None = None
 
     class Meta:
         resource_name: str
         relationship_fields: typing.List[str]
         reverse_relationships: typing.List[str]
         editable_attrs: typing.List[str]
+        # Fields that can be filtered on and sorted by
+        filterable_fields: typing.List[str]
+        sortable_fields: typing.List[str]
+
+    def __new__(cls, *args, **kwargs):
+        instance = super().__new__(cls)
+
+        for field, value in cls._defaults.items():
+            setattr(instance, field, value)
+
+        return instance
 
     def save(self):
-        raise NotImplementedError()
+        self.invalidate_json()
+
+        with atomic() as transaction:
+            transaction.save(self)
 
     def delete(self):
-        raise NotImplementedError()
+        self.invalidate_json()
 
-    def get(pk: str):
-        raise NotImplementedError()
+        with atomic() as transaction:
+            transaction.delete(self)
 
-    def to_json(self):
-        raise NotImplementedError()
+    @classmethod
+    def save_many(cls, instances: typing.List["Model"]):
+        with atomic() as transaction:
+            for instance in instances:
+                instance.invalidate_json()
+                transaction.save(instance)
 
+    @classmethod
+    def get(cls, pk: str):
+        transaction = current_transaction.get()
 
-class Artist(Model):
-    name: str
+        if transaction is None:
+            return storage.get(cls, pk)
 
-    def __init__(self, id: str, name: str):
-        self.id = id
-        self.name = name
+        return transaction.get(cls, pk)
 
-    class Meta:
-        resource_name = "artist"
-        relationship_fields = []
-        reverse_relationships = ["user.followed_artists", "illustration.artist"]
-        editable_attrs = ["name"]
+    @classmethod
+    def get_many(cls, pks: typing.Collection[str]) -> typing.List["Model"]:
+        """
+        Returns the instances with the primary keys in `pks` that exist, with
+        a single lookup instead of one per primary key.
+        """
 
-    def save(self):
-        global artist_db
-        artist_db[self.id] = self
+        transaction = current_transaction.get()
 
-        for user in User.all():
-            if self.id in [artist.id for artist in user.followed_artists]:
-                user.followed_artists[
-                    [artist.id for artist in user.followed_artists].index(self.id)
-                ] = self
-                user.save()
+        if transaction is None:
+            return storage.get_many(cls, pks)
 
-        for illustration in Illustration.all():
+        instances = []
+        for pk in pks:
             try:
-                if illustration.artist.id == self.id:
-                    illustration.artist = self
-                    illustration.save()
-            except AttributeError:
+                instances.append(transaction.get(cls, pk))
+            except KeyError:
                 pass
 
-    def delete(self):
-        global artist_db
+        return instances
+
+    @classmethod
+    def all(cls):
+        return list(storage.iter(cls))
+
+    @classmethod
+    def iter(cls):
+        return storage.iter(cls)
+
+    @classmethod
+    def query(
+        cls,
+        filters: typing.Mapping[str, str] | None = None,
+        sort: typing.Sequence[typing.Tuple[str, bool]] | None = None,
+        after: str | None = None,
+        limit: int | None = None,
+    ) -> typing.Iterator["Model"]:
+        """
+        Yields up to `limit` instances whose `Meta.filterable_fields` equal
+        the values in `filters`, sorted by the `(field, descending)` pairs in
+        `sort`, or those with a primary key higher than `after` (without
+        `sort`). Only committed instances are considered.
+        """
+
+        if not filters and not sort and after is None and limit is None:
+            return cls.iter()
+
+        return storage.query(cls, filters or {}, sort or [], after, limit)
+
+    @classmethod
+    def count(cls):
+        return storage.count(cls)
+
+    @classmethod
+    def collection_version(cls) -> int:
+        """
+        Returns a number increased by every committed transaction that
+        saves or deletes an instance of the model.
+        """
+
+        return storage.version(cls)
+
+    @classmethod
+    def resource_version(cls, pk: str) -> int | None:
+        """
+        Returns a number increased by every committed transaction that
+        saves the instance with the primary key `pk`, `None` if it doesn't
+        exist.
+        """
+
+        return storage.row_version(cls, pk)
+
+    @classmethod
+    def get_deserializer(cls, op_code: str) -> typing.Callable:
+        """
+        Returns the function that validates the resource object of an `"add"`
+        or `"update"` operation on the model and builds or updates the
+        instance, see `codegen.compile_deserializer()`. It's generated from
+        the model's annotations and `Meta` the first time it's requested.
+        """
+
+        try:
+            return cls._compiled[op_code]
+        except KeyError:
+            function = compile_deserializer(cls, op_code)
+            cls._compiled[op_code] = function
+            return function
+
+    @classmethod
+    def get_validator(
+        cls, key: str, relationship: str | None = None
+    ) -> typing.Callable:
+        """
+        Returns the function that validates the `ref` (`key` is `"ref"`) or
+        the `data` of an operation on the model or on one of its
+        relationships, see `codegen.compile_validator()`. It's generated the
+        first time it's requested.
+        """
+
+        try:
+            return cls._compiled[(key, relationship)]
+        except KeyError:
+            function = compile_validator(cls, key, relationship)
+            cls._compiled[(key, relationship)] = function
+            return function
+
+    def copy(self):
+        """
+        Returns a copy of the instance that can be modified without affecting
+        this one.
+        """
+
+        instance = type(self).__new__(type(self))
+
+        for slot in self._state_slots:
+            try:
+                value = getattr(self, slot)
+            except AttributeError:
+                continue
 
-        del artist_db[self.id]
+            if isinstance(value, array.array):
+                value = array.array(value.typecode, value)
 
-        for user in User.all():
-            if self.id in [artist.id for artist in user.followed_artists]:
-                del user.followed_artists[
-                    [artist.id for artist in user.followed_artists].index(self.id)
-                ]
-                user.save()
+            setattr(instance, slot, value)
 
-        for illustration in Illustration.all():
-            try:
-                if illustration.artist.id == self.id:
-                    illustration.artist = None
-                    illustration.save()
-            except AttributeError:
-                pass
+        return instance
+
+    def related_ids(self, field: str) -> typing.List[str]:
+        """
+        Returns the primary keys of the instances related through `field`
+        without looking them up.
+        """
+
+        return getattr(type(self), field).ids(self)
+
+    def set_related_ids(self, field: str, pks: typing.Iterable[str]):
+        getattr(type(self), field).set_ids(self, pks)
+
+    def to_json(self, fields: typing.Collection[str] | None = None) -> dict:
+        """
+        Returns the resource object of the instance. If `fields` is given
+        only the attributes and relationships named in it are built (a JSON:API
+        sparse fieldset).
+
+        The full resource object is cached until the instance is saved or
+        deleted, so it must not be modified by the caller.
+        """
+
+        if fields is not None:
+            return self.build_json(fields)
+
+        if self._json is None:
+            self._json = self.build_json()
 
-    @staticmethod
-    def get(pk: str):
-        global artist_db
-        return artist_db[pk]
+        return self._json
 
-    @staticmethod
-    def all():
-        global artist_db
-        return [artist_db[id] for id in artist_db.keys()]
+    def to_json_bytes(self, fields: typing.Collection[str] | None = None) -> bytes:
+        """
+        Like `to_json()`, but returns the resource object already encoded.
+        """
 
-    def to_json(self) -> dict:
+        if fields is not None:
+            return encode(self.build_json(fields))
+
+        if self._json_bytes is None:
+            self._json_bytes = encode(self.to_json())
+
+        return self._json_bytes
+
+    def build_json(self, fields: typing.Collection[str] | None = None) -> dict:
+        raise NotImplementedError()
+
+    def invalidate_json(self):
+        self._json = None
+        self._json_bytes = None
+
+    def attributes_json(self, fields: typing.Collection[str] | None = None) -> dict:
         return {
-            "type": "artist",
-            "id": self.id,
-            "attributes": {"name": self.name},
-            "links": {
-                "self": {
-                    "href": f"http://localhost:8000/artists/{self.id}",
-                    "title": "Artist details",
-                    "hreflang": "en-US",
-                }
-            },
+            attr: getattr(self, attr)
+            for attr in self.Meta.editable_attrs
+            if fields is None or attr in fields
         }
 
+    def reverse_related(self):
+        """
+        Yields `(instance, field)` for every instance pointing to this one
+        through one of `Meta.reverse_relationships`.
+        """
+
+        transaction = current_transaction.get()
+
+        for relationship in self.Meta.reverse_relationships:
+            resource_name, field = relationship.split(".")
+            model = type_to_model[resource_name]
+
+            if transaction is None:
+                pks = storage.reverse_lookup(relationship, self.id)
+            else:
+                pks = transaction.reverse_lookup(model, relationship, self.id)
+
+            for pk in pks:
+                yield model.get(pk), field
+
+    def cascade_delete(self):
+        """
+        Removes this instance from the relationships that reference it.
+        """
+
+        for instance, field in self.reverse_related():
+            instance.set_related_ids(
+                field, [pk for pk in instance.related_ids(field) if pk != self.id]
+            )
+            instance.save()
+
+
+class Artist(Model):
+    name: str
+
+    def __init__(self, id: str, name: str):
+        self.id = id
+        self.name = name
+
+    id_sequence = IdSequence(lambda: storage.max_pk(Artist))
+
+    class Meta:
+        resource_name = "artist"
+        relationship_fields = []
+        reverse_relationships = ["user.followed_artists", "illustration.artist"]
+        editable_attrs = ["name"]
+        filterable_fields = ["name"]
+        sortable_fields = ["name"]
+
+    def delete(self):
+        with atomic():
+            super().delete()
+            self.cascade_delete()
+
+    def build_json(self, fields: typing.Collection[str] | None = None) -> dict:
+        resource = {"type": "artist", "id": self.id}
+
+        attributes = self.attributes_json(fields)
+        if attributes:
+            resource["attributes"] = attributes
+
+        resource["links"] = {
+            "self": {
+                "href": f"http://localhost:8000/artists/{self.id}",
+                "title": "Artist details",
+                "hreflang": "en-US",
+            }
+        }
+
+        return resource
+
 
 class Illustration(Model):
     url: str
     artist: Artist | None = None
 
-    def __init__(self, id: str, url: str, artist: Artist | None):
+    def __init__(self, id: str, url: str, artist: Artist | None = None):
         self.id = id
         self.url = url
         self.artist = artist
 
+    id_sequence = IdSequence(lambda: storage.max_pk(Illustration))
+
     class Meta:
         resource_name = "illustration"
         relationship_fields = ["artist"]
         reverse_relationships = []
         editable_attrs = ["url"]
+        filterable_fields = ["artist", "url"]
+        sortable_fields = ["url"]
 
-    def save(self):
-        global illustration_db
-        illustration_db[self.id] = self
-
-    def delete(self):
-        global illustration_db
-        del illustration_db[self.id]
-
-    @staticmethod
-    def get(pk: str):
-        global illustration_db
-        return illustration_db[pk]
+    def build_json(self, fields: typing.Collection[str] | None = None) -> dict:
+        resource = {"type": "illustration", "id": self.id}
 
-    @staticmethod
-    def all():
-        global illustration_db
-        return [illustration_db[id] for id in illustration_db.keys()]
+        attributes = self.attributes_json(fields)
+        if attributes:
+            resource["attributes"] = attributes
 
-    def to_json(self) -> dict:
-        return {
-            "type": "illustration",
-            "id": self.id,
-            "attributes": {"url": self.url},
-            "relationships": {
+        if fields is None or "artist" in fields:
+            resource["relationships"] = {
                 "artist": {
-                    "data": {"type": "artist", "id": self.artist.id}
-                    if self.artist
+                    "data": {"type": "artist", "id": pk}
+                    if (pk := self._artist_id) is not None
                     else None
                 },
-            },
-            "links": {
-                "self": {
-                    "href": f"http://localhost:8000/illustrations/{self.id}",
-                    "title": "Illustration details",
-                    "hreflang": "en-US",
-                }
-            },
+            }
+
+        resource["links"] = {
+            "self": {
+                "href": f"http://localhost:8000/illustrations/{self.id}",
+                "title": "Illustration details",
+                "hreflang": "en-US",
+            }
         }
 
+        return resource
+
 
 class User(Model):
     username: str
@@ -170,63 +757,50 @@ class User(Model):
         id: str,
         username: str,
         email: str,
-        followed_artists: typing.List[Artist] = [],
+        followed_artists: typing.List[Artist] | None = None,
     ):
         self.id = id
         self.username = username
         self.email = email
-        self.followed_artists = followed_artists
+        self.followed_artists = followed_artists or []
+
+    id_sequence = IdSequence(lambda: storage.max_pk(User))
 
     class Meta:
         resource_name = "user"
         relationship_fields = ["followed_artists"]
         reverse_relationships = []
         editable_attrs = ["username", "email"]
+        filterable_fields = ["username", "email", "followed_artists"]
+        sortable_fields = ["username", "email"]
 
-    def save(self):
-        global user_db
-        user_db[self.id] = self
-
-    def delete(self):
-        global user_db
-        del user_db[self.id]
+    def build_json(self, fields: typing.Collection[str] | None = None) -> dict:
+        resource = {"type": "user", "id": self.id}
 
-    @staticmethod
-    def get(pk: str):
-        global user_db
-        return user_db[pk]
+        attributes = self.attributes_json(fields)
+        if attributes:
+            resource["attributes"] = attributes
 
-    @staticmethod
-    def all():
-        global user_db
-        return [user_db[id] for id in user_db.keys()]
+        if fields is None or "followed_artists" in fields:
+            followed_artists = self.related_ids("followed_artists")
 
-    def to_json(self) -> dict:
-        return {
-            "type": "user",
-            "id": self.id,
-            "attributes": {
-                "username": self.username,
-                "email": self.email,
-            },
-            "relationships": {
+            resource["relationships"] = {
                 "followed_artists": {
-                    "data": [
-                        {"type": "artist", "id": artist.id}
-                        for artist in self.followed_artists
-                    ],
-                    "meta": {"count": len(self.followed_artists)},
+                    "data": [{"type": "artist", "id": pk} for pk in followed_artists],
+                    "meta": {"count": len(followed_artists)},
                 },
-            },
-            "links": {
-                "self": {
-                    "href": f"http://localhost:8000/users/{self.id}",
-                    "title": "User details",
-                    "hreflang": "en-US",
-                }
-            },
+            }
+
+        resource["links"] = {
+            "self": {
+                "href": f"http://localhost:8000/users/{self.id}",
+                "title": "User details",
+                "hreflang": "en-US",
+            }
         }
 
+        return resource
+
 
 global illustration_db
 illustration_db = {}
@@ -239,3 +813,31 @@ user_db = {}
 
 
 type_to_model = {"artist": Artist, "illustration": Illustration, "user": User}
+
+# Only the relationships some model declares as reverse relationship are
+# worth indexing.
+indexed_relationships = {
+    relationship
+    for model in type_to_model.values()
+    for relationship in model.Meta.reverse_relationships
+}
+
+storage: Storage = DictStorage(
+    {"illustration": illustration_db, "artist": artist_db, "user": user_db}
+)
+storage.setup(type_to_model.values())
+
+
+def set_storage(backend: Storage):
+    """
+    Makes the models persist to `backend` instead of the in-memory dicts. It
+    should be called before serving requests.
+    """
+
+    global storage
+
+    backend.setup(type_to_model.values())
+    storage = backend
+
+    for model in type_to_model.values():
+        model.id_sequence.reset()
@@ -2,44 +2,77 @@
 This module contains the `ModelOperationSet`s.
 """
 
+import itertools
 import typing
 
-import schema
-
+from jsonapi_schema import ValidationError
 from models import Model, Illustration, Artist, User, type_to_model
 
 
-def get_model_from_typing_type(_type):
-    try:
-        # assert models.User.__bases__ == (models.Model,)
-        if _type.__bases__[0] == Model:
-            return _type
-    except AttributeError:
-        # A models.Model subclass must have a __bases__ property
-        pass
-
-    # Check if it is a type of the `typing` module
-    if isinstance(_type, typing._GenericAlias) or isinstance(
-        _type, typing._SpecialGenericAlias
-    ):
-        # assert typing.List[str].__args__ == (str,)
-        for _subtype in _type.__args__:
-            model_type = get_model_from_typing_type(_subtype)
-            try:
-                # assert models.User.__bases__ == (models.Model,)
-                if model_type.__bases__[0] == Model:
-                    return model_type
-            except AttributeError:
-                pass
+def get_op_resource_type(op: dict):
+    if op.get("ref", None) is not None:
+        return op["ref"]["type"]
+    else:
+        return op["data"]["type"]
 
 
 class OperationResponse:
     instance: Model | None
     lid: str | None
-
-    def __init__(self, instance: Model | None, lid: str | None = None):
+    # The instance deleted by a `"remove"` operation on a resource
+    removed: Model | None
+
+    def __init__(
+        self,
+        instance: Model | None,
+        lid: str | None = None,
+        removed: Model | None = None,
+    ):
         self.instance = instance
         self.lid = lid
+        self.removed = removed
+
+
+class LidRegistry:
+    """
+    Maps the `lid`s given to resources in an atomic batch to the instances
+    they were created as. A single registry is shared by all the operation
+    sets of a request.
+    """
+
+    def __init__(self):
+        self.instances: typing.Dict[str, typing.Tuple[typing.Type[Model], Model]] = {}
+
+    def __contains__(self, lid: str) -> bool:
+        return lid in self.instances
+
+    def register(self, lid: str, instance: Model):
+        self.instances[lid] = (type(instance), instance)
+
+    def get(
+        self, lid: str, model: typing.Type[Model] | None = None, pointer: str = ""
+    ) -> Model:
+        """
+        Returns the instance registered under `lid`. If `model` is given the
+        instance must be of that exact model. `pointer` is the resource
+        identifier object the `lid` is in, errors point to it.
+        """
+
+        try:
+            instance_model, instance = self.instances[lid]
+        except KeyError:
+            raise ValidationError(
+                "Doesn't point to a resource added before it.", f"{pointer}/lid"
+            )
+
+        if model is not None and instance_model is not model:
+            raise ValidationError(
+                f"Points to a resource of type `{instance_model.Meta.resource_name}`,"
+                f" not `{model.Meta.resource_name}`.",
+                f"{pointer}/lid",
+            )
+
+        return instance
 
 
 class ModelOperationSet:
@@ -51,22 +84,109 @@ class ModelOperationSet:
 
     model: Model
 
-    def __init__(self, lid_list: typing.List[typing.Tuple[str, Model]] = []):
-        self.lid_list = lid_list
+    def __init__(self, lids: LidRegistry | None = None):
+        self.lids = lids if lids is not None else LidRegistry()
+
+    def get_object(self, identifier: dict, pointer: str = "") -> Model:
+        """
+        Returns the model instance a resource identifier object points to,
+        either by its `id` or by the `lid` it was given earlier in the batch.
+        `pointer` is the pointer to the identifier.
+        """
+
+        model = type_to_model[identifier["type"]]
+
+        if "id" in identifier:
+            try:
+                return model.get(pk=identifier["id"])
+            except KeyError:
+                raise ValidationError(
+                    "Doesn't point to an existing resource.", f"{pointer}/id"
+                )
+
+        return self.lids.get(identifier["lid"], model, pointer)
+
+    def build_instance(self, pk: str, data: dict, pointer: str) -> Model:
+        """
+        Validates a resource object and builds a new, unsaved instance from
+        it, registering its `lid` so that the operations after it can point
+        to it.
+        """
 
-    def get_object_by_lid(self, lid: str) -> Model:
+        return self.model.get_deserializer("add")(
+            data, pk, self.get_object, self.lids.register, pointer
+        )
+
+    def apply_many(
+        self,
+        op_code: str,
+        operations: typing.List[dict],
+        offset: int = 0,
+        indices: typing.Sequence[int] | None = None,
+        pks: typing.List[str] | None = None,
+    ) -> typing.List[OperationResponse]:
         """
-        Returns a model instance my it's lid.
+        Applies a run of operations with the same op code, in order. Runs of
+        resource additions are applied in bulk. `offset` is the index of the
+        first operation of the run in the request, errors point to it, or
+        `indices` the index of each operation if they aren't consecutive.
+        `pks` are the IDs allocated beforehand for a run of additions.
         """
 
-        for item in self.lid_list:
-            if item[0] == lid:
-                return item[1]
+        if indices is None:
+            indices = range(offset, offset + len(operations))
 
-        raise ValueError("The provided `lid` does not point to any resource")
+        pointers = [f"/atomic:operations/{index}" for index in indices]
+
+        if op_code == "add" and all(
+            operation.get("ref", None) is None for operation in operations
+        ):
+            return self.bulk_add(
+                [operation["data"] for operation in operations], pointers, pks
+            )
+
+        return [
+            getattr(self, op_code)(
+                ref=operation.get("ref", None),
+                data=operation.get("data", None),
+                pointer=pointer,
+            )
+            for operation, pointer in zip(operations, pointers)
+        ]
+
+    def bulk_add(
+        self,
+        data_list: typing.List[dict],
+        pointers: typing.List[str],
+        pks: typing.List[str] | None = None,
+    ) -> typing.List[OperationResponse]:
+        """
+        Creates the resources of several `"add"` operations at once: the IDs
+        are allocated as one block (unless given in `pks`), each resource
+        object is validated while its instance is built and the instances are
+        stored with a single write.
+        """
+
+        if pks is None:
+            pks = self.model.id_sequence.allocate(len(data_list))
+
+        instances = [
+            self.build_instance(pk, data, f"{pointer}/data")
+            for pk, data, pointer in zip(pks, data_list, pointers)
+        ]
+
+        self.model.save_many(instances)
+
+        return [
+            OperationResponse(instance, lid=data.get("lid", None))
+            for instance, data in zip(instances, data_list)
+        ]
 
     def add(
-        self, ref: dict | None = None, data: dict | typing.List[dict] | None = None
+        self,
+        ref: dict | None = None,
+        data: dict | typing.List[dict] | None = None,
+        pointer: str = "",
     ):
         """
         Handles operations with an op code of `"add"`. If `ref` is present then
@@ -75,141 +195,41 @@ class ModelOperationSet:
 
         if ref is not None:
             # Validate that `ref` has all the needed properties
-            schema.Schema(
-                schema.And(
-                    {
-                        schema.Or("id", "lid"): str,
-                        "type": self.model.Meta.resource_name,
-                        "relationship": schema.And(
-                            str, lambda rel: rel in self.model.Meta.relationship_fields
-                        ),
-                    },
-                    lambda o: not ("id" in o.keys() and "lid" in o.keys()),
-                )
-            ).validate(ref)
+            self.model.get_validator("ref")(ref, f"{pointer}/ref")
 
             # Validate that the related resource is valid
-            data_schema = schema.And(
-                {
-                    "type": get_model_from_typing_type(
-                        self.model.__annotations__[ref["relationship"]]
-                    ).Meta.resource_name,
-                    schema.Or("id", "lid"): str,
-                },
-                lambda o: not ("id" in o.keys() and "lid" in o.keys()),
+            self.model.get_validator("add", ref["relationship"])(
+                data, f"{pointer}/data"
             )
 
-            schema.Schema(
-                [data_schema],
-            ).validate(data)
+            instance = self.get_object(ref, f"{pointer}/ref")
 
-            if "id" in ref:
-                instance = self.model.get(pk=ref["id"])
-            else:
-                instance = self.get_object_by_lid(lid=ref["lid"])
-                if not isinstance(instance, self.model):
-                    raise Exception(
-                        f"`lid` does not point to a resource of type `{self.model}`"
-                    )
-
-            for related_instance in [
-                type_to_model[item["type"]].get(item["id"])
-                if "id" in item
-                else self.get_object_by_lid(lid=item["lid"])
-                for item in data
-            ]:
-                getattr(instance, ref["relationship"]).append(related_instance)
+            instance.set_related_ids(
+                ref["relationship"],
+                instance.related_ids(ref["relationship"])
+                + [
+                    self.get_object(item, f"{pointer}/data/{index}").id
+                    for index, item in enumerate(data)
+                ],
+            )
 
             instance.save()
 
             return OperationResponse(instance)
 
         else:
-            # Validate the data
-            attrs_schema = {}
-            rels_schema = {}
-
-            # In a real Django project you'd use
-            # `rest_framework.serializers.Field` to validate a model.
-            for attr in self.model.Meta.editable_attrs:
-                attrs_schema.update({attr: self.model.__annotations__[attr]})
-
-            for rel in self.model.Meta.relationship_fields:
-                data_schema = schema.And(
-                    {
-                        "type": get_model_from_typing_type(
-                            self.model.__annotations__[rel]
-                        ).Meta.resource_name,
-                        schema.Or("id", "lid"): str,
-                    },
-                    lambda o: not ("id" in o.keys() and "lid" in o.keys()),
-                )
-
-                rels_schema.update(
-                    {rel: {"data": schema.Or(data_schema, [data_schema], None)}}
-                )
-
-            schema.Schema(
-                schema.And(
-                    {
-                        "type": self.model.Meta.resource_name,
-                        schema.Optional("lid"): str,
-                        schema.Optional("attributes"): schema.And(
-                            attrs_schema, lambda attrs: len(attrs.keys()) >= 1
-                        ),
-                        schema.Optional("relationships"): schema.And(
-                            rels_schema, lambda rels: len(rels.keys()) >= 1
-                        ),
-                    },
-                    lambda o: not ("id" in o.keys() and "lid" in o.keys())
-                    and ("attributes" in o.keys() or "relationships" in o.keys()),
-                ),
-            ).validate(data)
-
-            all_instances = self.model.all()
-            all_instances.sort(key=lambda o: o.id)
-            new_pk = (
-                str(int(all_instances[len(all_instances) - 1].id) + 1)
-                if len(all_instances) > 0
-                else "1"
+            instance = self.build_instance(
+                self.model.id_sequence.next(), data, f"{pointer}/data"
             )
-
-            instance = self.model(id=new_pk, **data.get("attributes", {}))
-
-            if "relationships" in data:
-                for rel in data["relationships"].keys():
-                    rel_data = data["relationships"]["rel"]["data"]
-
-                    if isinstance(rel_data, list):
-                        related_instances = [
-                            type_to_model[item["type"]].get(item["id"])
-                            if "id" in item
-                            else self.get_object_by_lid(lid=item["lid"])
-                            for item in data
-                        ]
-
-                        setattr(instance, rel, related_instances)
-
-                    else:
-                        # Get the related resource
-                        related_instance = (
-                            type_to_model[
-                                get_model_from_typing_type(
-                                    getattr(self.model, rel)
-                                ).Meta.resource_name
-                            ].get(pk=data["id"])
-                            if "id" in data
-                            else self.get_object_by_lid(lid=data["lid"])
-                        )
-
-                        setattr(instance, rel, related_instance)
-
             instance.save()
 
             return OperationResponse(instance, lid=data.get("lid", None))
 
     def update(
-        self, ref: dict | None = None, data: dict | typing.List[dict] | None = None
+        self,
+        ref: dict | None = None,
+        data: dict | typing.List[dict] | None = None,
+        pointer: str = "",
     ):
         """
         Handles operations with an op code of `"update"`. If `ref` is present a
@@ -219,167 +239,54 @@ class ModelOperationSet:
 
         if ref is not None:
             # Validate that `ref` has all the needed properties
-            schema.Schema(
-                schema.And(
-                    {
-                        schema.Or("id", "lid"): str,
-                        "type": self.model.Meta.resource_name,
-                        "relationship": schema.And(
-                            str, lambda rel: rel in self.model.Meta.relationship_fields
-                        ),
-                    },
-                    lambda o: not ("id" in o.keys() and "lid" in o.keys()),
-                )
-            ).validate(ref)
+            self.model.get_validator("ref")(ref, f"{pointer}/ref")
 
             # Validate that the related resource is valid
-            data_schema = schema.And(
-                {
-                    "type": get_model_from_typing_type(
-                        self.model.__annotations__[ref["relationship"]]
-                    ).Meta.resource_name,
-                    schema.Or("id", "lid"): str,
-                },
-                lambda o: not ("id" in o.keys() and "lid" in o.keys()),
+            self.model.get_validator("update", ref["relationship"])(
+                data, f"{pointer}/data"
             )
 
-            schema.Schema(
-                schema.Or(
-                    data_schema,
-                    [data_schema],
-                    None,
-                )
-            ).validate(data)
-
-            if "id" in ref:
-                instance = self.model.get(pk=ref["id"])
-            else:
-                instance = self.get_object_by_lid(lid=ref["lid"])
-                if not isinstance(instance, self.model):
-                    raise Exception(
-                        f"`lid` does not point to a resource of type `{self.model}`"
-                    )
+            instance = self.get_object(ref, f"{pointer}/ref")
 
             if data is None:
                 # Set the relationship to `None`
                 setattr(instance, ref["relationship"], None)
 
             elif isinstance(data, list):
-                related_instances = [
-                    type_to_model[item["type"]].get(item["id"])
-                    if "id" in item
-                    else self.get_object_by_lid(lid=item["lid"])
-                    for item in data
-                ]
-
-                setattr(instance, ref["relationship"], related_instances)
+                setattr(
+                    instance,
+                    ref["relationship"],
+                    [
+                        self.get_object(item, f"{pointer}/data/{index}")
+                        for index, item in enumerate(data)
+                    ],
+                )
 
             else:
-                # Get the related resource
-                related_instance = (
-                    type_to_model[
-                        get_model_from_typing_type(
-                            getattr(self.model, ref["relationship"])
-                        ).Meta.resource_name
-                    ].get(pk=data["id"])
-                    if "id" in data
-                    else self.get_object_by_lid(lid=data["lid"])
+                setattr(
+                    instance,
+                    ref["relationship"],
+                    self.get_object(data, f"{pointer}/data"),
                 )
 
-                setattr(instance, ref["relationship"], related_instance)
-
             instance.save()
 
             return OperationResponse(instance)
 
         else:
-            # Validate the data
-            attrs_schema = {}
-            rels_schema = {}
-
-            data_schema = schema.And(
-                {
-                    "type": get_model_from_typing_type(
-                        self.model.__annotations__[ref["relationship"]]
-                    ).Meta.resource_name,
-                    schema.Or("id", "lid"): str,
-                },
-                lambda o: not ("id" in o.keys() and "lid" in o.keys()),
+            # Validate the data and apply it to the instance it points to
+            instance = self.model.get_deserializer("update")(
+                data, self.get_object, f"{pointer}/data"
             )
-
-            # In a real Django project you'd use
-            # `rest_framework.serializers.Field` to validate a model.
-            for attr in self.model.Meta.editable_attrs:
-                attrs_schema.update({attr: self.model.__annotations__[attr]})
-
-            for rel in self.model.Meta.relationship_fields:
-                rels_schema.update(
-                    {rel: {"data": schema.Or(data_schema, [data_schema], None)}}
-                )
-
-            schema.Schema(
-                schema.And(
-                    {
-                        "type": self.model.Meta.resource_name,
-                        schema.Optional("lid"): str,
-                        schema.Optional("attributes"): schema.And(
-                            attrs_schema, lambda attrs: len(attrs.keys()) >= 1
-                        ),
-                        schema.Optional("relationships"): schema.And(
-                            rels_schema, lambda rels: len(rels.keys()) >= 1
-                        ),
-                    },
-                    lambda o: not ("id" in o.keys() and "lid" in o.keys())
-                    and ("attributes" in o.keys() or "relationships" in o.keys()),
-                ),
-            ).validate(data)
-
-            if "id" in ref:
-                instance = self.model.get(pk=ref["id"])
-            else:
-                instance = self.get_object_by_lid(lid=ref["lid"])
-                if not isinstance(instance, self.model):
-                    raise Exception(
-                        f"`lid` does not point to a resource of type `{self.model}`"
-                    )
-
-            for attr in data["attributes"].keys():
-                setattr(instance, attr, data["attributes"][attr])
-
-            if "relationships" in data:
-                for rel in data["relationships"].keys():
-                    rel_data = data["relationships"]["rel"]["data"]
-
-                    if isinstance(rel_data, list):
-                        related_instances = [
-                            type_to_model[item["type"]].get(item["id"])
-                            if "id" in item
-                            else self.get_object_by_lid(lid=item["lid"])
-                            for item in data
-                        ]
-
-                        setattr(instance, rel, related_instances)
-
-                    else:
-                        # Get the related resource
-                        related_instance = (
-                            type_to_model[
-                                get_model_from_typing_type(
-                                    getattr(self.model, rel)
-                                ).Meta.resource_name
-                            ].get(pk=data["id"])
-                            if "id" in data
-                            else self.get_object_by_lid(lid=data["lid"])
-                        )
-
-                        setattr(instance, rel, related_instance)
-
             instance.save()
 
             return OperationResponse(instance)
 
     def remove(
-        self, ref: dict | None = None, data: dict | typing.List[dict] | None = None
+        self,
+        ref: dict | None = None,
+        data: dict | typing.List[dict] | None = None,
+        pointer: str = "",
     ):
         """
         Handles operations with an op code of "remove". If `ref` is present
@@ -389,57 +296,26 @@ class ModelOperationSet:
 
         if ref is not None:
             # Validate that `ref` has all the needed properties
-            schema.Schema(
-                schema.And(
-                    {
-                        schema.Or("id", "lid"): str,
-                        "type": self.model.Meta.resource_name,
-                        "relationship": schema.And(
-                            str, lambda rel: rel in self.model.Meta.relationship_fields
-                        ),
-                    },
-                    lambda o: not ("id" in o.keys() and "lid" in o.keys()),
-                )
-            ).validate(ref)
+            self.model.get_validator("ref")(ref, f"{pointer}/ref")
 
             # Validate that the related resource is valid
-            data_schema = schema.And(
-                {
-                    "type": get_model_from_typing_type(
-                        self.model.__annotations__[ref["relationship"]]
-                    ).Meta.resource_name,
-                    schema.Or("id", "lid"): str,
-                },
-                lambda o: not ("id" in o.keys() and "lid" in o.keys()),
+            self.model.get_validator("remove", ref["relationship"])(
+                data, f"{pointer}/data"
             )
 
-            schema.Schema(
-                [data_schema],
-            ).validate(data)
-
-            if "id" in ref:
-                instance = self.model.get(pk=ref["id"])
-            else:
-                instance = self.get_object_by_lid(lid=ref["lid"])
-                if not isinstance(instance, self.model):
-                    raise Exception(
-                        f"`lid` does not point to a resource of type `{self.model}`"
-                    )
+            instance = self.get_object(ref, f"{pointer}/ref")
 
             id_list = [
-                item["id"]
-                if "id" in item
-                else self.get_object_by_lid(lid=item["lid"]).id
-                for item in data
+                self.get_object(item, f"{pointer}/data/{index}").id
+                for index, item in enumerate(data)
             ]
 
-            setattr(
-                instance,
+            instance.set_related_ids(
                 ref["relationship"],
                 [
-                    item
-                    for item in getattr(instance, ref["relationship"])
-                    if item.id not in id_list
+                    pk
+                    for pk in instance.related_ids(ref["relationship"])
+                    if pk not in id_list
                 ],
             )
             instance.save()
@@ -447,26 +323,12 @@ class ModelOperationSet:
             return OperationResponse(instance)
 
         else:
-            schema.Schema(
-                schema.And(
-                    {
-                        "type": self.model.Meta.resource_name,
-                        schema.Or("id", "lid"): str,
-                    },
-                ),
-            ).validate(data)
+            self.model.get_validator("remove")(data, f"{pointer}/data")
 
-            if "id" in ref:
-                instance = self.model.get(pk=ref["id"])
-            else:
-                instance = self.get_object_by_lid(lid=ref["lid"])
-                if not isinstance(instance, self.model):
-                    raise Exception(
-                        f"`lid` does not point to a resource of type `{self.model}`"
-                    )
+            instance = self.get_object(data, f"{pointer}/data")
             instance.delete()
 
-            return OperationResponse(instance=None)
+            return OperationResponse(instance=None, removed=instance)
 
 
 class IllustrationOperationSet(ModelOperationSet):
@@ -486,3 +348,255 @@ type_to_operation_set = {
     "artist": ArtistOperationSet,
     "user": UserOperationSet,
 }
+
+
+def plan(
+    operations: typing.Iterable[dict], max_run: int | None = None
+) -> typing.Iterator[
+    typing.Tuple[typing.Type[ModelOperationSet], str, typing.List[dict]]
+]:
+    """
+    Splits `operations` into runs of consecutive operations on the same
+    resource type with the same op code (and either all with or all without
+    a `ref`), so each run can be applied with a single `apply_many()` call.
+    The order of the operations is preserved.
+
+    `operations` is consumed lazily and runs are cut at `max_run` operations
+    if it's given, so only a run needs to be held in memory at a time.
+    """
+
+    for (resource_type, op_code, _), group in itertools.groupby(
+        operations,
+        key=lambda op: (get_op_resource_type(op), op["op"], op.get("ref") is None),
+    ):
+        while run := list(itertools.islice(group, max_run)):
+            yield type_to_operation_set[resource_type], op_code, run
+
+
+# A resource an operation touches, `(type, id)`, or the index of the
+# operation that adds it until its ID is allocated
+ResourceKey = typing.Tuple[str, str] | int
+
+# The operation set, op code, operations, their indices in the request and
+# the IDs allocated for them if they add resources
+ScheduledRun = typing.Tuple[
+    typing.Type[ModelOperationSet],
+    str,
+    typing.List[dict],
+    typing.List[int],
+    typing.List[str] | None,
+]
+
+
+def identifier_key(
+    identifier, lids: typing.Dict[str, typing.Tuple[str, int]]
+) -> ResourceKey | None:
+    """
+    Returns the key of the resource a resource identifier object points to,
+    `None` if it doesn't point to one added before it in the batch.
+    """
+
+    if not isinstance(identifier, dict) or identifier.get("type") not in type_to_model:
+        return None
+
+    if "id" in identifier:
+        return (identifier["type"], identifier["id"])
+
+    resource_type, index = lids.get(identifier.get("lid"), (None, None))
+
+    return index if resource_type == identifier["type"] else None
+
+
+def linkage_keys(
+    linkage, lids: typing.Dict[str, typing.Tuple[str, int]]
+) -> typing.List[ResourceKey] | None:
+    """
+    Returns the keys of the resources in resource linkage (`null`, an
+    identifier or an array of them), `None` if any is unknown.
+    """
+
+    if linkage is None:
+        return []
+
+    keys = []
+
+    for identifier in linkage if isinstance(linkage, list) else [linkage]:
+        key = identifier_key(identifier, lids)
+        if key is None:
+            return None
+
+        keys.append(key)
+
+    return keys
+
+
+def footprint(
+    operation: dict, index: int, lids: typing.Dict[str, typing.Tuple[str, int]]
+) -> typing.Tuple[typing.List[ResourceKey], ResourceKey] | None:
+    """
+    Returns the keys of the resources an operation reads (the related
+    resources it points to) and of the resource it writes, registering the
+    `lid` of an added resource. Returns `None` if they can't be known before
+    it's applied.
+    """
+
+    ref = operation.get("ref", None)
+    data = operation.get("data", None)
+
+    if ref is not None:
+        if not isinstance(ref, dict) or "relationship" not in ref:
+            return None
+
+        target = identifier_key(ref, lids)
+        reads = linkage_keys(data, lids)
+
+    else:
+        if not isinstance(data, dict) or data.get("type") not in type_to_model:
+            return None
+
+        relationships = data.get("relationships", {})
+        if not isinstance(relationships, dict):
+            return None
+
+        reads = []
+        for relationship in relationships.values():
+            keys = linkage_keys(
+                relationship.get("data") if isinstance(relationship, dict) else 0,
+                lids,
+            )
+            if keys is None:
+                return None
+
+            reads += keys
+
+        if operation["op"] == "add":
+            target = index
+            if "lid" in data:
+                # A `lid` declared again points to another resource from
+                # there on, which the runs can't tell apart
+                if data["lid"] in lids:
+                    return None
+
+                lids[data["lid"]] = (data["type"], index)
+        else:
+            target = identifier_key(data, lids)
+
+    if target is None or reads is None:
+        return None
+
+    return reads, target
+
+
+def schedule(operations: typing.List[dict]) -> typing.List[ScheduledRun] | None:
+    """
+    Orders a batch so operations that don't depend on each other are applied
+    together, in as few runs as possible, with the same results as applying
+    them in order. Returns `None` if the batch must be applied in order.
+
+    An operation depends on the operations before it that write a resource
+    it reads or writes, or read a resource it writes. Resources are known by
+    ID, by the `lid` of the operation adding them, by the `ref` they're the
+    target of and by the relationships pointing to them. Each operation gets
+    a level one higher than those it depends on, and the operations of a
+    level are applied as runs of operations with the same resource type and
+    op code, in their order in the batch. Removing a resource may cascade to
+    any resource pointing to it, so it gets a level of its own.
+
+    The IDs of the added resources are allocated here, in the order of the
+    batch, so they're the IDs applying it in order would hand out. It must
+    be called in a transaction.
+    """
+
+    lids: typing.Dict[str, typing.Tuple[str, int]] = {}
+    footprints = []
+
+    for index, operation in enumerate(operations):
+        if operation["op"] == "remove" and operation.get("ref", None) is None:
+            footprints.append(None)
+            continue
+
+        keys = footprint(operation, index, lids)
+        if keys is None:
+            return None
+
+        footprints.append(keys)
+
+    # Resources added by the batch are known by ID from here on
+    added: typing.Dict[str, typing.List[int]] = {}
+    for index, operation in enumerate(operations):
+        if operation["op"] == "add" and operation.get("ref", None) is None:
+            added.setdefault(operation["data"]["type"], []).append(index)
+
+    pks: typing.Dict[int, str] = {}
+    for resource_type, indices in added.items():
+        allocated = type_to_model[resource_type].id_sequence.allocate(len(indices))
+        pks.update(zip(indices, allocated))
+
+    def resolve(key: ResourceKey) -> typing.Tuple[str, str]:
+        if isinstance(key, int):
+            return (operations[key]["data"]["type"], pks[key])
+
+        return key
+
+    # Highest level of the last write and of the reads of each resource
+    last_write: typing.Dict[typing.Tuple[str, str], int] = {}
+    last_read: typing.Dict[typing.Tuple[str, str], int] = {}
+    # Lowest level the operations after a removal can have
+    floor = 0
+    top = -1
+    levels: typing.List[typing.List[int]] = []
+
+    for index, keys in enumerate(footprints):
+        if keys is None:
+            level = floor = top + 1
+            floor += 1
+        else:
+            reads = [resolve(key) for key in keys[0]]
+            target = resolve(keys[1])
+            level = max(
+                floor, last_write.get(target, -1) + 1, last_read.get(target, -1) + 1
+            )
+
+            for key in reads:
+                level = max(level, last_write.get(key, -1) + 1)
+
+            for key in reads:
+                last_read[key] = max(last_read.get(key, -1), level)
+
+            last_write[target] = level
+
+        if level > top:
+            top = level
+            levels.append([])
+
+        levels[level].append(index)
+
+    runs = []
+
+    for level in levels:
+        # (resource type, op code, whether it has a `ref`) -> indices
+        groups: typing.Dict[typing.Tuple[str, str, bool], typing.List[int]] = {}
+
+        for index in level:
+            operation = operations[index]
+            groups.setdefault(
+                (
+                    get_op_resource_type(operation),
+                    operation["op"],
+                    operation.get("ref") is None,
+                ),
+                [],
+            ).append(index)
+
+        for (resource_type, op_code, _), indices in groups.items():
+            runs.append(
+                (
+                    type_to_operation_set[resource_type],
+                    op_code,
+                    [operations[index] for index in indices],
+                    indices,
+                    [pks[index] for index in indices] if indices[0] in pks else None,
+                )
+            )
+
+    return runs
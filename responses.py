@@ -0,0 +1,122 @@
+"""
+This module assembles JSON:API documents from pre-encoded JSON fragments, so
+cached resource objects can be spliced into a response without encoding them
+again.
+"""
+
+import json
+import typing
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def encode_stdlib(obj) -> bytes:
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+def encode_orjson(obj) -> bytes:
+    return orjson.dumps(obj)
+
+
+encoders: typing.Dict[str, typing.Callable[[typing.Any], bytes]] = {
+    "json": encode_stdlib,
+}
+
+if orjson is not None:
+    encoders["orjson"] = encode_orjson
+
+# orjson is used when it's installed, otherwise the standard library
+encoder_name = "orjson" if orjson is not None else "json"
+
+
+def set_encoder(name: str):
+    """
+    Selects the encoder used by `encode()`. It should be set before serving
+    requests, as resources encoded before the change stay cached.
+    """
+
+    global encoder_name
+
+    if name not in encoders:
+        raise ValueError(f"Unknown or unavailable encoder `{name}`")
+
+    encoder_name = name
+
+
+def encode(obj) -> bytes:
+    return encoders[encoder_name](obj)
+
+
+# The `jsonapi` member is the same in every document
+JSONAPI_MEMBER = b'"jsonapi":' + encode_stdlib(
+    {"version": "1.1", "ext": ["https://jsonapi.org/ext/atomic"]}
+)
+
+
+def document(members: typing.Dict[str, bytes]) -> bytes:
+    """
+    Builds a top-level document from the already encoded values of its
+    members.
+    """
+
+    return b"".join(
+        [
+            b"{",
+            JSONAPI_MEMBER,
+            *(
+                b"," + encode_stdlib(name) + b":" + value
+                for name, value in members.items()
+            ),
+            b"}",
+        ]
+    )
+
+
+def json_object(members: typing.Dict[str, bytes]) -> bytes:
+    """
+    Builds an object from the already encoded values of its members.
+    """
+
+    return (
+        b"{"
+        + b",".join(
+            encode(name) + b":" + value for name, value in members.items()
+        )
+        + b"}"
+    )
+
+
+def resource_array(
+    instances: typing.Iterable, fields: typing.Collection[str] | None = None
+) -> bytes:
+    return (
+        b"["
+        + b",".join(instance.to_json_bytes(fields) for instance in instances)
+        + b"]"
+    )
+
+
+def iter_collection(
+    instances: typing.Iterable,
+    fields: typing.Collection[str] | None = None,
+    members: typing.Dict[str, bytes] | None = None,
+) -> typing.Iterator[bytes]:
+    """
+    Yields a collection document piece by piece, encoding each resource only
+    when it's about to be sent. `members` are added after `data`.
+    """
+
+    yield b"{" + JSONAPI_MEMBER + b',"data":['
+
+    for i, instance in enumerate(instances):
+        yield (b"," if i > 0 else b"") + instance.to_json_bytes(fields)
+
+    yield b"]"
+
+    for name, value in (members or {}).items():
+        yield b"," + encode_stdlib(name) + b":" + value
+
+    yield b"}"
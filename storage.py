@@ -0,0 +1,1236 @@
+"""
+This module contains the storage backends the models are persisted in.
+`DictStorage` keeps the rows in dicts in memory and is the default,
+`SQLiteStorage` keeps them in a SQLite database.
+"""
+
+import bisect
+import collections
+import contextlib
+import itertools
+import json
+import operator
+import os
+import sqlite3
+import threading
+import time
+import typing
+
+# (model, pk, row) for every row written by a transaction, `row` is `None` if
+# the row was deleted
+Change = typing.Tuple[type, str, typing.Any]
+
+
+class ReverseIndex:
+    """
+    Maps related resources back to the resources that point to them through
+    `relationships`, so cascades only touch the affected rows instead of
+    scanning whole tables.
+
+    Relationships are addressed as `"<resource name>.<field>"`, e.g.
+    `"user.followed_artists"`.
+    """
+
+    def __init__(self, relationships: typing.Collection[str]):
+        self.relationships = relationships
+        # relationship -> {target id -> {source ids}}
+        self.sources: typing.Dict[str, typing.Dict[str, typing.Set[str]]] = {}
+        # relationship -> {source id -> {target ids}}, used to diff on save
+        self.targets: typing.Dict[str, typing.Dict[str, typing.Set[str]]] = {}
+
+    def indexed_fields(self, instance) -> typing.List[str]:
+        return [
+            field
+            for field in instance.Meta.relationship_fields
+            if f"{instance.Meta.resource_name}.{field}" in self.relationships
+        ]
+
+    def update(self, instance):
+        """
+        Indexes the current state of `instance`'s relationships.
+        """
+
+        for field in self.indexed_fields(instance):
+            path = f"{instance.Meta.resource_name}.{field}"
+            new_targets = set(instance.related_ids(field))
+
+            targets = self.targets.setdefault(path, {})
+            old_targets = targets.get(instance.id, set())
+            sources = self.sources.setdefault(path, {})
+
+            for target in old_targets - new_targets:
+                sources[target].discard(instance.id)
+                if not sources[target]:
+                    del sources[target]
+
+            for target in new_targets - old_targets:
+                sources.setdefault(target, set()).add(instance.id)
+
+            if new_targets:
+                targets[instance.id] = new_targets
+            else:
+                targets.pop(instance.id, None)
+
+    def remove(self, instance):
+        """
+        Drops every entry `instance` has in the index.
+        """
+
+        for field in self.indexed_fields(instance):
+            path = f"{instance.Meta.resource_name}.{field}"
+            sources = self.sources.get(path, {})
+
+            for target in self.targets.get(path, {}).pop(instance.id, set()):
+                sources[target].discard(instance.id)
+                if not sources[target]:
+                    del sources[target]
+
+    def get(self, relationship: str, pk: str) -> typing.Set[str]:
+        """
+        Returns the IDs of the resources pointing to `pk` through
+        `relationship`.
+        """
+
+        return set(self.sources.get(relationship, {}).get(pk, ()))
+
+
+def sort_key(value) -> tuple:
+    """
+    Makes values of a field comparable even if some of them are `None`, which
+    sorts first.
+    """
+
+    return (value is not None, value)
+
+
+def pk_key(pk: str) -> tuple:
+    """
+    Sorts numeric primary keys by their numeric value.
+    """
+
+    return (len(pk), pk)
+
+
+def is_pk(value) -> bool:
+    """
+    Whether `value` is a primary key as the models' sequences write them, a
+    number without leading zeros.
+    """
+
+    return isinstance(value, str) and value.isdigit() and value == str(int(value))
+
+
+class HashIndex:
+    """
+    Maps each value of a field to the primary keys of the rows that have it,
+    so rows can be found by value without scanning the table. Relationships
+    are indexed by the IDs of the related resources.
+
+    A row is removed by the values it was indexed with, so it's removed
+    correctly even if it was modified in place since.
+    """
+
+    def __init__(self, field: str):
+        self.field = field
+        # value -> {pk: None}
+        self.entries: typing.Dict[typing.Any, typing.Dict[str, None]] = {}
+        # pk -> values the row was indexed with, used to remove it
+        self.keys: typing.Dict[str, typing.Iterable] = {}
+
+    def values(self, instance) -> typing.Iterable:
+        if self.field in instance.Meta.relationship_fields:
+            return set(instance.related_ids(self.field))
+
+        return [getattr(instance, self.field, None)]
+
+    def add(self, instance):
+        values = self.values(instance)
+        self.keys[instance.id] = values
+
+        for value in values:
+            self.entries.setdefault(value, {})[instance.id] = None
+
+    def remove(self, instance):
+        for value in self.keys.pop(instance.id, ()):
+            pks = self.entries.get(value, {})
+            pks.pop(instance.id, None)
+            if not pks:
+                self.entries.pop(value, None)
+
+    def get(self, value) -> typing.Dict[str, None]:
+        return self.entries.get(value, {})
+
+
+class SortedIndex:
+    """
+    Keeps the rows sorted by the value of a field, rows with the same value
+    sorted by primary key. Like in `HashIndex`, a row is removed by the key
+    it was indexed with.
+    """
+
+    def __init__(self, field: str):
+        self.field = field
+        # (sort key of the value, sort key of the pk, row), sorted by the
+        # first two
+        self.entries: typing.List[typing.Tuple[tuple, tuple, typing.Any]] = []
+        # pk -> first two items of the row's entry, used to remove it
+        self.keys: typing.Dict[str, typing.Tuple[tuple, tuple]] = {}
+
+    def key(self, instance) -> typing.Tuple[tuple, tuple]:
+        return (sort_key(getattr(instance, self.field, None)), pk_key(instance.id))
+
+    entry_key = operator.itemgetter(0, 1)
+
+    def add(self, instance):
+        key = self.key(instance)
+        self.keys[instance.id] = key
+        bisect.insort(self.entries, (*key, instance), key=self.entry_key)
+
+    def remove(self, instance):
+        key = self.keys.pop(instance.id, None)
+        if key is None:
+            return
+
+        i = bisect.bisect_left(self.entries, key, key=self.entry_key)
+
+        if i < len(self.entries) and self.entries[i][:2] == key:
+            del self.entries[i]
+
+    def rebuild(self, instances: typing.Iterable):
+        """
+        Indexes `instances` from scratch, sorting them once instead of
+        inserting them one by one.
+        """
+
+        self.entries = sorted(
+            ((*self.key(instance), instance) for instance in instances),
+            key=self.entry_key,
+        )
+        self.keys = {entry[2].id: entry[:2] for entry in self.entries}
+
+    def rows(self, descending: bool = False) -> typing.Iterator:
+        """
+        Iterates a snapshot of the index, so only the rows actually read
+        (e.g. a page) cost anything beyond copying the list.
+        """
+
+        entries = list(self.entries)
+
+        if not descending:
+            return (entry[2] for entry in entries)
+
+        return self.iter_descending(entries)
+
+    @staticmethod
+    def iter_descending(entries: list) -> typing.Iterator:
+        # Walks the runs of equal values from the end, each run in order so
+        # rows with the same value stay sorted by primary key
+        end = len(entries)
+
+        while end > 0:
+            start = end - 1
+            while start > 0 and entries[start - 1][0] == entries[end - 1][0]:
+                start -= 1
+
+            for entry in entries[start:end]:
+                yield entry[2]
+
+            end = start
+
+
+class PrimaryKeyIndex:
+    """
+    Keeps the rows of a table sorted by primary key, so they can be read in
+    order and from a cursor without sorting the table.
+    """
+
+    def __init__(self):
+        # (sort key of the pk, row), sorted by the first
+        self.entries: typing.List[typing.Tuple[tuple, typing.Any]] = []
+
+    entry_key = operator.itemgetter(0)
+
+    def add(self, instance):
+        entry = (pk_key(instance.id), instance)
+
+        if not self.entries or self.entries[-1][0] < entry[0]:
+            # New rows usually have the highest primary key
+            self.entries.append(entry)
+        else:
+            bisect.insort(self.entries, entry, key=self.entry_key)
+
+    def remove(self, instance):
+        key = pk_key(instance.id)
+        i = bisect.bisect_left(self.entries, key, key=self.entry_key)
+
+        if i < len(self.entries) and self.entries[i][0] == key:
+            del self.entries[i]
+
+    def rebuild(self, instances: typing.Iterable):
+        self.entries = sorted(
+            ((pk_key(instance.id), instance) for instance in instances),
+            key=self.entry_key,
+        )
+
+    def rows(
+        self, after: str | None = None, limit: int | None = None
+    ) -> typing.Iterator:
+        """
+        Iterates a snapshot of the first `limit` rows with a primary key
+        higher than `after`, or of every row.
+        """
+
+        start = 0
+        if after is not None:
+            start = bisect.bisect_right(
+                self.entries, pk_key(after), key=self.entry_key
+            )
+
+        end = None if limit is None else start + limit
+
+        return (entry[1] for entry in self.entries[start:end])
+
+
+def reverse_relationships(models: typing.Iterable[type]) -> typing.Set[str]:
+    """
+    Returns the relationships some model declares as reverse relationship,
+    the only ones worth indexing.
+    """
+
+    return {
+        relationship
+        for model in models
+        for relationship in model.Meta.reverse_relationships
+    }
+
+
+class ReadWriteLock:
+    """
+    A lock held by any number of readers at once or by a single writer.
+    Writers are preferred: once one is waiting no new reader gets in, so a
+    steady stream of reads can't starve it.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writing = False
+        self.waiting_writers = 0
+
+    @contextlib.contextmanager
+    def read(self) -> typing.Iterator[None]:
+        with self.condition:
+            while self.writing or self.waiting_writers:
+                self.condition.wait()
+            self.readers += 1
+
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                if self.readers == 0:
+                    self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def write(self) -> typing.Iterator[None]:
+        with self.condition:
+            self.waiting_writers += 1
+            try:
+                while self.writing or self.readers:
+                    self.condition.wait()
+            finally:
+                self.waiting_writers -= 1
+            self.writing = True
+
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
+
+
+class Storage(typing.Protocol):
+    """
+    The interface the models are persisted through. The rows a backend
+    returns are shared, they must be copied before being modified.
+    """
+
+    # Whether other processes may write to the storage too, in which case
+    # state cached by a process (like the ID sequences) must be refreshed in
+    # every transaction
+    shared: bool
+
+    def setup(self, models: typing.Collection[type]):
+        """
+        Prepares the backend to store `models`. Called once before it's used.
+        """
+
+    def get(self, model: type, pk: str) -> typing.Any:
+        """
+        Returns the row of `model` with the primary key `pk`, raises
+        `KeyError` if there is none.
+        """
+
+    def get_many(self, model: type, pks: typing.Collection[str]) -> typing.List:
+        """
+        Returns the rows of `model` with the primary keys in `pks`, in that
+        order, in a single lookup. Primary keys without a row are skipped.
+        """
+
+    def contains(self, model: type, pk: str) -> bool:
+        ...
+
+    def iter(self, model: type) -> typing.Iterator:
+        """
+        Yields the rows of `model` ordered by primary key.
+        """
+
+    def query(
+        self,
+        model: type,
+        filters: typing.Mapping[str, str],
+        sort: typing.Sequence[typing.Tuple[str, bool]],
+        after: str | None = None,
+        limit: int | None = None,
+    ) -> typing.Iterator:
+        """
+        Yields the rows of `model` whose `Meta.filterable_fields` equal the
+        values in `filters`, ordered by the `(field, descending)` pairs in
+        `sort` (fields of `Meta.sortable_fields`) and then by primary key, up
+        to `limit` rows.
+
+        `after` is a numeric primary key, only the rows with a higher one are
+        yielded, found without reading the rows before them. It can't be
+        combined with `sort`. The row with that key needn't exist.
+        """
+
+    def count(self, model: type) -> int:
+        ...
+
+    def max_pk(self, model: type) -> int:
+        """
+        Returns the highest numeric primary key of `model`, 0 if it has no
+        rows.
+        """
+
+    def reverse_lookup(self, relationship: str, pk: str) -> typing.Set[str]:
+        """
+        Returns the primary keys of the rows pointing to `pk` through
+        `relationship`, one of the models' `Meta.reverse_relationships`.
+        """
+
+    def transaction(self) -> typing.ContextManager:
+        """
+        Wraps a whole model transaction. No other transaction can write to
+        the storage until it exits, and rows read inside it stay current.
+        """
+
+    def load(self, instances: typing.Iterable):
+        """
+        Writes `instances` (of any model), replacing the rows with the same
+        primary keys, for bulk imports. The indexes may not be updated until
+        `rebuild_indexes()` is called. Must be called inside `transaction()`.
+        """
+
+    def rebuild_indexes(self):
+        """
+        Brings every index up to date after `load()`.
+        """
+
+    def write(self, changes: typing.Iterable[Change]):
+        """
+        Applies the changes of a committed transaction, all of them or none.
+        """
+
+    def version(self, model: type) -> int:
+        """
+        Returns the version of the rows of `model`. It's increased by every
+        write that changes one of them, so an unchanged version means
+        unchanged rows.
+        """
+
+    def row_version(self, model: type, pk: str) -> int | None:
+        """
+        Returns the version of the row of `model` with the primary key `pk`,
+        `None` if there is none. It's increased by every write that changes
+        the row.
+        """
+
+
+class DictStorage:
+    """
+    Keeps the rows in a dict per model, keyed by primary key, the reverse
+    relationships in a `ReverseIndex`, the `Meta.filterable_fields` in
+    `HashIndex`es and the `Meta.sortable_fields` in `SortedIndex`es.
+
+    It's safe to use from several threads. Transactions are serialized by
+    `transaction_lock`, held from the start of a transaction to its end. The
+    rows are never modified once written (transactions write copies), so
+    readers only need `lock` to take a consistent snapshot of the dicts: it's
+    held for writing just while a committed transaction is applied, and
+    never while the rows are serialized or sent.
+    """
+
+    shared = False
+
+    def __init__(self, tables: typing.Dict[str, typing.Dict] | None = None):
+        # resource name -> {pk -> row}
+        self.tables = tables if tables is not None else {}
+        self.models: typing.Collection[type] = ()
+        self.reverse_index = ReverseIndex(set())
+        # (resource name, field) -> index
+        self.hash_indexes: typing.Dict[typing.Tuple[str, str], HashIndex] = {}
+        self.sorted_indexes: typing.Dict[typing.Tuple[str, str], SortedIndex] = {}
+        # resource name -> index
+        self.pk_indexes: typing.Dict[str, PrimaryKeyIndex] = {}
+        self.lock = ReadWriteLock()
+        self.transaction_lock = threading.RLock()
+        # Versions start from the time of `setup()`, so the versions of a
+        # previous process aren't handed out again for different rows
+        self.initial_version = 0
+        # resource name -> version
+        self.versions: typing.Dict[str, int] = {}
+        # resource name -> {pk -> version}, rows missing were written before
+        # `setup()` and have `initial_version`
+        self.row_versions: typing.Dict[str, typing.Dict[str, int]] = {}
+
+    def setup(self, models: typing.Collection[type]):
+        self.models = models
+        self.initial_version = time.time_ns()
+
+        for model in models:
+            self.tables.setdefault(model.Meta.resource_name, {})
+            self.versions[model.Meta.resource_name] = self.initial_version
+            self.row_versions[model.Meta.resource_name] = {}
+
+        self.rebuild_indexes()
+
+    def rebuild_indexes(self):
+        with self.lock.write():
+            self.reverse_index = ReverseIndex(reverse_relationships(self.models))
+            self.hash_indexes = {}
+            self.sorted_indexes = {}
+            self.pk_indexes = {}
+
+            for model in self.models:
+                resource_name = model.Meta.resource_name
+                rows = list(self.tables[resource_name].values())
+
+                pk_index = PrimaryKeyIndex()
+                pk_index.rebuild(rows)
+                self.pk_indexes[resource_name] = pk_index
+
+                for field in model.Meta.filterable_fields:
+                    hash_index = HashIndex(field)
+                    for instance in rows:
+                        hash_index.add(instance)
+                    self.hash_indexes[(resource_name, field)] = hash_index
+
+                for field in model.Meta.sortable_fields:
+                    sorted_index = SortedIndex(field)
+                    sorted_index.rebuild(rows)
+                    self.sorted_indexes[(resource_name, field)] = sorted_index
+
+                for instance in rows:
+                    self.reverse_index.update(instance)
+
+    def load(self, instances: typing.Iterable):
+        with self.lock.write():
+            versions = {}
+
+            for instance in instances:
+                resource_name = instance.Meta.resource_name
+                if resource_name not in versions:
+                    versions[resource_name] = self.bump_version(resource_name)
+
+                self.tables[resource_name][instance.id] = instance
+                self.row_versions[resource_name][instance.id] = versions[
+                    resource_name
+                ]
+
+    def bump_version(self, resource_name: str) -> int:
+        """
+        Increases the version of a table, must be called holding `lock` for
+        writing.
+        """
+
+        self.versions[resource_name] += 1
+        return self.versions[resource_name]
+
+    def model_indexes(
+        self, instance
+    ) -> typing.Iterator[HashIndex | SortedIndex | PrimaryKeyIndex]:
+        resource_name = instance.Meta.resource_name
+
+        yield self.pk_indexes[resource_name]
+
+        for field in instance.Meta.filterable_fields:
+            yield self.hash_indexes[(resource_name, field)]
+
+        for field in instance.Meta.sortable_fields:
+            yield self.sorted_indexes[(resource_name, field)]
+
+    def index(self, instance):
+        self.reverse_index.update(instance)
+
+        for index in self.model_indexes(instance):
+            index.add(instance)
+
+    def unindex(self, instance):
+        self.reverse_index.remove(instance)
+
+        for index in self.model_indexes(instance):
+            index.remove(instance)
+
+    def get(self, model: type, pk: str):
+        with self.lock.read():
+            return self.tables[model.Meta.resource_name][pk]
+
+    def get_many(self, model: type, pks: typing.Collection[str]) -> typing.List:
+        with self.lock.read():
+            table = self.tables[model.Meta.resource_name]
+            return [table[pk] for pk in pks if pk in table]
+
+    def contains(self, model: type, pk: str) -> bool:
+        with self.lock.read():
+            return pk in self.tables[model.Meta.resource_name]
+
+    def iter(self, model: type) -> typing.Iterator:
+        # The dict is in the order the rows were written, which a scheduled
+        # batch doesn't do by primary key
+        with self.lock.read():
+            return self.pk_indexes[model.Meta.resource_name].rows()
+
+    def query(
+        self,
+        model: type,
+        filters: typing.Mapping[str, str],
+        sort: typing.Sequence[typing.Tuple[str, bool]],
+        after: str | None = None,
+        limit: int | None = None,
+    ) -> typing.Iterator:
+        resource_name = model.Meta.resource_name
+
+        with self.lock.read():
+            table = self.tables[resource_name]
+
+            if not filters and not sort:
+                return self.pk_indexes[resource_name].rows(after, limit)
+
+            if not filters and len(sort) == 1:
+                # Already in order in the sorted index
+                field, descending = sort[0]
+                rows = self.sorted_indexes[(resource_name, field)].rows(descending)
+                return itertools.islice(rows, limit)
+
+            if filters:
+                # Starts from the smallest set of matches and checks the
+                # other filters against their indexes, so it takes time
+                # proportional to the matches, not to the table
+                matches = sorted(
+                    (
+                        self.hash_indexes[(resource_name, field)].get(value)
+                        for field, value in filters.items()
+                    ),
+                    key=len,
+                )
+                pks = sorted(
+                    (
+                        pk
+                        for pk in matches[0]
+                        if all(pk in other for other in matches[1:])
+                    ),
+                    key=pk_key,
+                )
+                if after is not None:
+                    pks = pks[bisect.bisect_right(pks, pk_key(after), key=pk_key) :]
+                if not sort:
+                    pks = pks[:limit]
+                rows = [table[pk] for pk in pks]
+            else:
+                rows = list(self.pk_indexes[resource_name].rows())
+
+        # Sorting is stable, so sorting by the last field first leaves the
+        # rows sorted by every field
+        for field, descending in reversed(sort):
+            rows.sort(
+                key=lambda row: sort_key(getattr(row, field, None)),
+                reverse=descending,
+            )
+
+        return iter(rows[:limit])
+
+    def count(self, model: type) -> int:
+        with self.lock.read():
+            return len(self.tables[model.Meta.resource_name])
+
+    def max_pk(self, model: type) -> int:
+        with self.lock.read():
+            pks = list(self.tables[model.Meta.resource_name])
+
+        return max((int(pk) for pk in pks if pk.isdigit()), default=0)
+
+    def reverse_lookup(self, relationship: str, pk: str) -> typing.Set[str]:
+        with self.lock.read():
+            return self.reverse_index.get(relationship, pk)
+
+    def transaction(self) -> typing.ContextManager:
+        return self.transaction_lock
+
+    def version(self, model: type) -> int:
+        with self.lock.read():
+            return self.versions[model.Meta.resource_name]
+
+    def row_version(self, model: type, pk: str) -> int | None:
+        resource_name = model.Meta.resource_name
+
+        with self.lock.read():
+            if pk not in self.tables[resource_name]:
+                return None
+
+            return self.row_versions[resource_name].get(pk, self.initial_version)
+
+    def write(self, changes: typing.Iterable[Change]):
+        changes = list(changes)
+
+        with self.lock.write():
+            # Every table written gets a single new version
+            versions = {}
+
+            for model, pk, instance in changes:
+                resource_name = model.Meta.resource_name
+                table = self.tables[resource_name]
+                row_versions = self.row_versions[resource_name]
+
+                if resource_name not in versions:
+                    versions[resource_name] = self.bump_version(resource_name)
+
+                old_instance = table.get(pk)
+                if old_instance is not None:
+                    self.unindex(old_instance)
+
+                if instance is None:
+                    table.pop(pk, None)
+                    row_versions.pop(pk, None)
+                else:
+                    table[pk] = instance
+                    row_versions[pk] = versions[resource_name]
+                    self.index(instance)
+
+
+class Table:
+    """
+    The layout of a model in SQLite and the statements used to access it,
+    built once in `SQLiteStorage.setup()`.
+
+    Attributes are stored in columns named after them, to-one relationships
+    in an indexed `<field>_id` column and to-many relationships in a
+    `<resource name>_<field>` join table indexed by target. Attributes in
+    `Meta.filterable_fields` or `Meta.sortable_fields` are indexed too.
+    """
+
+    def __init__(self, model: type):
+        self.model = model
+        self.name = model.Meta.resource_name
+        self.attrs = list(model.Meta.editable_attrs)
+        self.to_one = []
+        self.to_many = []
+
+        for field in model.Meta.relationship_fields:
+            descriptor = getattr(model, field)
+            (self.to_many if descriptor.many else self.to_one).append(descriptor)
+
+        columns = [
+            "id",
+            *self.attrs,
+            *(f"{descriptor.name}_id" for descriptor in self.to_one),
+        ]
+        quoted = ", ".join(f'"{column}"' for column in columns)
+
+        self.schema = [
+            f'CREATE TABLE IF NOT EXISTS "{self.name}" ('
+            + ", ".join(
+                [
+                    '"id" INTEGER PRIMARY KEY',
+                    *(f'"{attr}"' for attr in self.attrs),
+                    *(
+                        f'"{descriptor.name}_id" INTEGER REFERENCES '
+                        f'"{descriptor.model.Meta.resource_name}" ("id")'
+                        for descriptor in self.to_one
+                    ),
+                ]
+            )
+            + ")",
+        ]
+
+        for attr in self.attrs:
+            if attr in model.Meta.filterable_fields + model.Meta.sortable_fields:
+                self.schema.append(
+                    f'CREATE INDEX IF NOT EXISTS "{self.name}_{attr}" '
+                    f'ON "{self.name}" ("{attr}")'
+                )
+
+        for descriptor in self.to_one:
+            self.schema.append(
+                f'CREATE INDEX IF NOT EXISTS "{self.name}_{descriptor.name}_id" '
+                f'ON "{self.name}" ("{descriptor.name}_id")'
+            )
+
+        for descriptor in self.to_many:
+            join_table = self.join_table(descriptor)
+            self.schema += [
+                f'CREATE TABLE IF NOT EXISTS "{join_table}" ('
+                f'"source_id" INTEGER NOT NULL REFERENCES "{self.name}" ("id") '
+                "ON DELETE CASCADE, "
+                '"position" INTEGER NOT NULL, '
+                '"target_id" INTEGER NOT NULL REFERENCES '
+                f'"{descriptor.model.Meta.resource_name}" ("id"), '
+                'PRIMARY KEY ("source_id", "position"))',
+                f'CREATE INDEX IF NOT EXISTS "{join_table}_target_id" '
+                f'ON "{join_table}" ("target_id")',
+            ]
+
+        self.select = f'SELECT {quoted} FROM "{self.name}" WHERE "id" = ?'
+        self.select_from = f'SELECT {quoted} FROM "{self.name}"'
+        self.select_all = f'{self.select_from} ORDER BY "id"'
+        # Takes the primary keys as a JSON array, so the same statement works
+        # for any number of them
+        self.select_many = (
+            f'SELECT {quoted} FROM "{self.name}" '
+            'WHERE "id" IN (SELECT "value" FROM json_each(?))'
+        )
+        self.exists = f'SELECT 1 FROM "{self.name}" WHERE "id" = ?'
+        self.count = f'SELECT COUNT(*) FROM "{self.name}"'
+        self.max_pk = f'SELECT MAX("id") FROM "{self.name}"'
+        self.upsert = (
+            f'INSERT INTO "{self.name}" ({quoted}) '
+            f"VALUES ({', '.join('?' for _ in columns)}) "
+            'ON CONFLICT ("id") DO UPDATE SET '
+            + ", ".join(f'"{column}" = excluded."{column}"' for column in columns[1:])
+            if len(columns) > 1
+            else f'INSERT OR IGNORE INTO "{self.name}" ("id") VALUES (?)'
+        )
+        self.delete = f'DELETE FROM "{self.name}" WHERE "id" = ?'
+
+        # field -> statement
+        self.select_related = {}
+        self.select_related_many = {}
+        self.delete_related = {}
+        self.insert_related = {}
+
+        for descriptor in self.to_many:
+            join_table = self.join_table(descriptor)
+            self.select_related[descriptor.name] = (
+                f'SELECT "target_id" FROM "{join_table}" '
+                'WHERE "source_id" = ? ORDER BY "position"'
+            )
+            self.select_related_many[descriptor.name] = (
+                f'SELECT "source_id", "target_id" FROM "{join_table}" '
+                'WHERE "source_id" IN (SELECT "value" FROM json_each(?)) '
+                'ORDER BY "source_id", "position"'
+            )
+            self.delete_related[descriptor.name] = (
+                f'DELETE FROM "{join_table}" WHERE "source_id" = ?'
+            )
+            self.insert_related[descriptor.name] = (
+                f'INSERT INTO "{join_table}" ("source_id", "position", "target_id") '
+                "VALUES (?, ?, ?)"
+            )
+
+    def join_table(self, descriptor) -> str:
+        return f"{self.name}_{descriptor.name}"
+
+    def query(
+        self,
+        filters: typing.Mapping[str, str],
+        sort: typing.Sequence[typing.Tuple[str, bool]],
+        after: str | None = None,
+        limit: int | None = None,
+    ) -> typing.Tuple[str, list]:
+        """
+        Returns the statement and parameters selecting the first `limit` rows
+        that match `filters` after `after`, sorted by `sort`. See
+        `Storage.query()`.
+        """
+
+        conditions = []
+        params = []
+
+        if after is not None:
+            conditions.append('"id" > ?')
+            params.append(int(after))
+
+        for field, value in filters.items():
+            if field in self.attrs:
+                conditions.append(f'"{field}" = ?')
+                params.append(value)
+                continue
+
+            # Related IDs are numeric, any other value matches nothing
+            params.append(int(value) if is_pk(value) else None)
+            descriptor = getattr(self.model, field)
+
+            if descriptor.many:
+                conditions.append(
+                    '"id" IN (SELECT "source_id" FROM '
+                    f'"{self.join_table(descriptor)}" WHERE "target_id" = ?)'
+                )
+            else:
+                conditions.append(f'"{field}_id" = ?')
+
+        order = [
+            f'"{field}" {"DESC" if descending else "ASC"}'
+            for field, descending in sort
+        ]
+        order.append('"id"')
+        statement = self.select_from
+
+        if conditions:
+            statement += " WHERE " + " AND ".join(conditions)
+
+        statement += f" ORDER BY {', '.join(order)}"
+
+        if limit is not None:
+            statement += " LIMIT ?"
+            params.append(limit)
+
+        return statement, params
+
+    def reverse_lookup(self, field: str) -> str:
+        """
+        Returns the statement selecting the rows pointing to a primary key
+        through `field`.
+        """
+
+        descriptor = getattr(self.model, field)
+
+        if descriptor.many:
+            return (
+                f'SELECT DISTINCT "source_id" FROM "{self.join_table(descriptor)}" '
+                'WHERE "target_id" = ?'
+            )
+
+        return f'SELECT "id" FROM "{self.name}" WHERE "{field}_id" = ?'
+
+    def build(self, row: tuple, related: typing.Dict[str, typing.List[int]]):
+        """
+        Builds an instance from a row selected with `select`/`select_all` and
+        the targets of its to-many relationships.
+        """
+
+        instance = self.model.__new__(self.model)
+        instance.id = str(row[0])
+
+        for attr, value in zip(self.attrs, row[1:]):
+            setattr(instance, attr, value)
+
+        for descriptor, value in zip(self.to_one, row[1 + len(self.attrs) :]):
+            descriptor.set_ids(instance, [] if value is None else [str(value)])
+
+        for descriptor in self.to_many:
+            descriptor.set_ids(instance, related.get(descriptor.name, ()))
+
+        return instance
+
+    def row(self, instance) -> tuple:
+        return (
+            int(instance.id),
+            *(getattr(instance, attr) for attr in self.attrs),
+            *(
+                int(pks[0]) if (pks := descriptor.ids(instance)) else None
+                for descriptor in self.to_one
+            ),
+        )
+
+
+class SQLiteStorage:
+    """
+    Keeps the rows in a SQLite database at `path`. Every thread uses its own
+    connection, statements are built once per model and reused, so SQLite's
+    statement cache only prepares them once per connection.
+
+    The database can be shared by several processes, e.g. the workers of a
+    gunicorn server. It's kept in WAL mode, so reads never wait for writers,
+    and each model transaction holds SQLite's write lock from start to end,
+    so writers are serialized across processes.
+
+    Primary keys must be numeric, as the IDs handed out by the models'
+    sequences are.
+
+    The versions of the tables and rows are kept in the database too, so
+    every process sees the writes of the others.
+    """
+
+    shared = True
+
+    versions_schema = [
+        'CREATE TABLE IF NOT EXISTS "_versions" ('
+        '"resource_name" TEXT PRIMARY KEY, "version" INTEGER NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS "_row_versions" ('
+        '"resource_name" TEXT NOT NULL, "id" INTEGER NOT NULL, '
+        '"version" INTEGER NOT NULL, PRIMARY KEY ("resource_name", "id")) '
+        "WITHOUT ROWID",
+    ]
+    select_version = 'SELECT "version" FROM "_versions" WHERE "resource_name" = ?'
+    insert_version = 'INSERT OR IGNORE INTO "_versions" VALUES (?, ?)'
+    bump_version = (
+        'UPDATE "_versions" SET "version" = "version" + 1 '
+        'WHERE "resource_name" = ? RETURNING "version"'
+    )
+    select_row_version = (
+        'SELECT "version" FROM "_row_versions" WHERE "resource_name" = ? AND "id" = ?'
+    )
+    upsert_row_version = (
+        'INSERT INTO "_row_versions" VALUES (?, ?, ?) '
+        'ON CONFLICT ("resource_name", "id") '
+        'DO UPDATE SET "version" = excluded."version"'
+    )
+    delete_row_version = (
+        'DELETE FROM "_row_versions" WHERE "resource_name" = ? AND "id" = ?'
+    )
+
+    # Rows fetched at a time while iterating a table
+    chunk_size = 500
+
+    # Seconds a transaction waits for the write lock before failing
+    timeout = 30.0
+
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+        # model -> table
+        self.tables: typing.Dict[type, Table] = {}
+        # relationship -> statement
+        self.reverse_lookups: typing.Dict[str, str] = {}
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, "connection", None)
+
+        # A connection must not be used by a forked process, e.g. a worker of
+        # a server that imported the APP before forking
+        if connection is None or self.local.pid != os.getpid():
+            # Transactions are managed explicitly by `transaction()`
+            connection = sqlite3.connect(
+                self.path, timeout=self.timeout, isolation_level=None
+            )
+            connection.execute("PRAGMA foreign_keys = ON")
+            connection.execute("PRAGMA synchronous = NORMAL")
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+
+        return connection
+
+    def setup(self, models: typing.Collection[type]):
+        self.tables = {model: Table(model) for model in models}
+        type_to_table = {table.name: table for table in self.tables.values()}
+
+        for relationship in reverse_relationships(models):
+            resource_name, field = relationship.split(".")
+            self.reverse_lookups[relationship] = type_to_table[
+                resource_name
+            ].reverse_lookup(field)
+
+        connection = self.connection
+        connection.execute("PRAGMA journal_mode = WAL")
+
+        with connection:
+            for statement in self.versions_schema:
+                connection.execute(statement)
+
+            # Versions start from the time the table is created, so a new
+            # database doesn't hand out the versions of a deleted one
+            initial_version = time.time_ns()
+
+            for table in self.tables.values():
+                for statement in table.schema:
+                    connection.execute(statement)
+
+                cursor = connection.execute(
+                    self.insert_version, (table.name, initial_version)
+                )
+                if cursor.rowcount:
+                    # Rows written before versions were kept
+                    connection.execute(
+                        'INSERT OR IGNORE INTO "_row_versions" '
+                        f'SELECT ?, "id", ? FROM "{table.name}"',
+                        (table.name, initial_version),
+                    )
+
+    def get(self, model: type, pk: str):
+        # "007" would find the row "7", which isn't its primary key
+        if not is_pk(pk):
+            raise KeyError(pk)
+
+        table = self.tables[model]
+        connection = self.connection
+
+        row = connection.execute(table.select, (int(pk),)).fetchone()
+        if row is None:
+            raise KeyError(pk)
+
+        related = {
+            field: [target for (target,) in connection.execute(statement, (row[0],))]
+            for field, statement in table.select_related.items()
+        }
+
+        return table.build(row, related)
+
+    def get_many(self, model: type, pks: typing.Collection[str]) -> typing.List:
+        table = self.tables[model]
+        connection = self.connection
+        ids = [int(pk) for pk in pks if is_pk(pk)]
+        param = json.dumps(ids)
+
+        rows = {row[0]: row for row in connection.execute(table.select_many, (param,))}
+        related = collections.defaultdict(dict)
+
+        for field, statement in table.select_related_many.items():
+            for source, target in connection.execute(statement, (param,)):
+                related[source].setdefault(field, []).append(target)
+
+        return [table.build(rows[pk], related[pk]) for pk in ids if pk in rows]
+
+    def contains(self, model: type, pk: str) -> bool:
+        if not is_pk(pk):
+            return False
+
+        cursor = self.connection.execute(self.tables[model].exists, (int(pk),))
+        return cursor.fetchone() is not None
+
+    def build_rows(self, table: Table, cursor: sqlite3.Cursor) -> typing.Iterator:
+        """
+        Yields the instances of the rows selected by `cursor`.
+        """
+
+        connection = self.connection
+
+        while rows := cursor.fetchmany(self.chunk_size):
+            # The to-many relationships of a whole chunk are fetched at once
+            param = json.dumps([row[0] for row in rows])
+            related = collections.defaultdict(dict)
+
+            for field, statement in table.select_related_many.items():
+                for source, target in connection.execute(statement, (param,)):
+                    related[source].setdefault(field, []).append(target)
+
+            for row in rows:
+                yield table.build(row, related[row[0]])
+
+    def iter(self, model: type) -> typing.Iterator:
+        table = self.tables[model]
+        return self.build_rows(table, self.connection.execute(table.select_all))
+
+    def query(
+        self,
+        model: type,
+        filters: typing.Mapping[str, str],
+        sort: typing.Sequence[typing.Tuple[str, bool]],
+        after: str | None = None,
+        limit: int | None = None,
+    ) -> typing.Iterator:
+        table = self.tables[model]
+        statement, params = table.query(filters, sort, after, limit)
+
+        return self.build_rows(table, self.connection.execute(statement, params))
+
+    def count(self, model: type) -> int:
+        return self.connection.execute(self.tables[model].count).fetchone()[0]
+
+    def max_pk(self, model: type) -> int:
+        return self.connection.execute(self.tables[model].max_pk).fetchone()[0] or 0
+
+    def reverse_lookup(self, relationship: str, pk: str) -> typing.Set[str]:
+        if not is_pk(pk):
+            return set()
+
+        cursor = self.connection.execute(
+            self.reverse_lookups[relationship], (int(pk),)
+        )
+        return {str(source) for (source,) in cursor}
+
+    @contextlib.contextmanager
+    def transaction(self) -> typing.Iterator[None]:
+        connection = self.connection
+
+        if connection.in_transaction:
+            yield
+            return
+
+        # Takes the write lock right away instead of on the first write, so
+        # what the transaction reads can't change before it commits
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            # Rows may point to rows written later in the same transaction
+            connection.execute("PRAGMA defer_foreign_keys = ON")
+            yield
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        else:
+            connection.execute("COMMIT")
+
+    def version(self, model: type) -> int:
+        cursor = self.connection.execute(
+            self.select_version, (self.tables[model].name,)
+        )
+        return cursor.fetchone()[0]
+
+    def row_version(self, model: type, pk: str) -> int | None:
+        if not is_pk(pk):
+            return None
+
+        row = self.connection.execute(
+            self.select_row_version, (self.tables[model].name, int(pk))
+        ).fetchone()
+
+        return None if row is None else row[0]
+
+    def load(self, instances: typing.Iterable):
+        self.write((type(instance), instance.id, instance) for instance in instances)
+
+    def rebuild_indexes(self):
+        # SQLite keeps its indexes up to date as rows are written
+        pass
+
+    def write(self, changes: typing.Iterable[Change]):
+        connection = self.connection
+
+        with self.transaction():
+            # Every table written gets a single new version
+            versions = {}
+
+            for model, pk, instance in changes:
+                table = self.tables[model]
+
+                if table.name not in versions:
+                    (versions[table.name],) = connection.execute(
+                        self.bump_version, (table.name,)
+                    ).fetchone()
+
+                if instance is None:
+                    for statement in table.delete_related.values():
+                        connection.execute(statement, (int(pk),))
+                    connection.execute(table.delete, (int(pk),))
+                    connection.execute(self.delete_row_version, (table.name, int(pk)))
+                    continue
+
+                connection.execute(table.upsert, table.row(instance))
+                connection.execute(
+                    self.upsert_row_version,
+                    (table.name, int(pk), versions[table.name]),
+                )
+
+                for descriptor in table.to_many:
+                    connection.execute(
+                        table.delete_related[descriptor.name], (int(pk),)
+                    )
+                    connection.executemany(
+                        table.insert_related[descriptor.name],
+                        [
+                            (int(pk), position, int(target))
+                            for position, target in enumerate(descriptor.ids(instance))
+                        ],
+                    )
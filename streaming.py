@@ -0,0 +1,176 @@
+"""
+This module parses JSON documents incrementally from a stream, so the items
+of a large array can be used as soon as they have been received instead of
+after the whole document has been read.
+"""
+
+import codecs
+import json
+import typing
+
+WHITESPACE = " \t\n\r"
+
+
+class ParseError(ValueError):
+    def __init__(self, detail: str, offset: int):
+        super().__init__(f"{detail} (at character {offset})")
+        self.detail = detail
+        self.offset = offset
+
+
+class StreamParser:
+    """
+    Reads JSON values from a binary stream, buffering only the text of the
+    value being parsed.
+    """
+
+    def __init__(self, stream: typing.BinaryIO, chunk_size: int = 64 * 1024):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.json_decoder = json.JSONDecoder()
+        self.buffer = ""
+        # Position in the buffer and number of characters dropped before it
+        self.pos = 0
+        self.consumed = 0
+        self.eof = False
+
+    @property
+    def offset(self) -> int:
+        return self.consumed + self.pos
+
+    def fill(self) -> bool:
+        """
+        Reads another chunk, dropping the text already parsed. Returns
+        `False` if the end of the stream was reached.
+        """
+
+        if self.eof:
+            return False
+
+        chunk = self.stream.read(self.chunk_size)
+        self.eof = not chunk
+
+        self.consumed += self.pos
+        self.buffer = self.buffer[self.pos :] + self.decoder.decode(
+            chunk, final=self.eof
+        )
+        self.pos = 0
+
+        return not self.eof
+
+    def peek(self) -> str:
+        """
+        Skips whitespace and returns the next character, or an empty string
+        at the end of the stream.
+        """
+
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+
+            if not self.fill():
+                return ""
+
+    def expect(self, char: str):
+        if self.peek() != char:
+            raise ParseError(f"Expected `{char}`", self.offset)
+
+        self.pos += 1
+
+    def value(self) -> typing.Any:
+        self.peek()
+
+        while True:
+            try:
+                value, end = self.json_decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError as error:
+                offset = self.consumed + error.pos
+
+                # The value may just be incomplete
+                if self.fill():
+                    continue
+
+                raise ParseError(error.msg, offset)
+
+            # A number at the end of the buffer may go on in the next chunk
+            if end == len(self.buffer) and self.fill():
+                continue
+
+            self.pos = end
+            return value
+
+
+def iter_items(parser: StreamParser) -> typing.Iterator:
+    """
+    Yields the items of the array the parser is at.
+    """
+
+    parser.expect("[")
+
+    if parser.peek() != "]":
+        while True:
+            yield parser.value()
+
+            if parser.peek() != ",":
+                break
+
+            parser.expect(",")
+
+    parser.expect("]")
+
+
+def iter_array(
+    stream: typing.BinaryIO,
+    member: str,
+    chunk_size: int = 64 * 1024,
+    other_member: typing.Callable[[str], None] | None = None,
+) -> typing.Iterator:
+    """
+    Yields the items of the array in the `member` member of the JSON object
+    in `stream` one by one, each as soon as it has been read. Other members
+    of the object are parsed and ignored, unless `other_member` is given:
+    it's called with the name of each of them before its value is parsed,
+    and raises to reject it.
+
+    Raises `ParseError` when the document turns out not to be valid, which
+    may happen after some items have been yielded.
+    """
+
+    parser = StreamParser(stream, chunk_size)
+    found = False
+
+    parser.expect("{")
+
+    if parser.peek() != "}":
+        while True:
+            if parser.peek() != '"':
+                raise ParseError("Expected a member name", parser.offset)
+
+            key = parser.value()
+            parser.expect(":")
+
+            if key == member:
+                found = True
+                yield from iter_items(parser)
+            else:
+                if other_member is not None:
+                    other_member(key)
+
+                parser.value()
+
+            if parser.peek() != ",":
+                break
+
+            parser.expect(",")
+
+    parser.expect("}")
+
+    if parser.peek() != "":
+        raise ParseError("Unexpected data after the document", parser.offset)
+
+    if not found:
+        raise ParseError(f"Missing `{member}`", parser.offset)
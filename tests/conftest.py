@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import models  # noqa: E402
+from storage import DictStorage  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def storage():
+    """
+    Runs every test against an empty in-memory storage.
+    """
+
+    default_storage = models.storage
+    backend = DictStorage()
+    models.set_storage(backend)
+
+    yield backend
+
+    models.set_storage(default_storage)
+
+
+@pytest.fixture
+def client():
+    from main import app
+
+    return app.test_client()
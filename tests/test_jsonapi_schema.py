@@ -0,0 +1,144 @@
+import copy
+import random
+
+import pytest
+
+from jsonapi_schema import ValidationError, schema, validate_operations
+from models import type_to_model
+
+BODIES = [
+    {
+        "atomic:operations": [
+            {
+                "op": "add",
+                "data": {
+                    "type": "artist",
+                    "lid": "a",
+                    "attributes": {"name": "John Doe"},
+                },
+            },
+            {
+                "op": "add",
+                "data": {
+                    "type": "illustration",
+                    "attributes": {"url": "https://example.com"},
+                    "relationships": {
+                        "artist": {"data": {"type": "artist", "lid": "a"}}
+                    },
+                },
+            },
+        ]
+    },
+    {
+        "atomic:operations": [
+            {
+                "op": "update",
+                "ref": {"type": "user", "id": "1", "relationship": "followed_artists"},
+                "data": [{"type": "artist", "id": "1"}],
+            },
+            {"op": "remove", "data": {"type": "artist", "id": "2"}},
+            {"op": "update", "data": {"type": "user", "id": "1"}, "meta": {}},
+        ]
+    },
+]
+
+VALUES = [None, 0, 1.5, True, "", "x", "artist", "add", "lid", [], {}, [{}], ["x"]]
+
+
+def reference_accepts(body) -> bool:
+    """
+    Whether `schema` accepts `body`, plus the checks it leaves to
+    `validate_operations()`: known types and a resource object for the
+    operations without `ref`.
+    """
+
+    if not schema.is_valid(body):
+        return False
+
+    for operation in body["atomic:operations"]:
+        if "ref" in operation:
+            if operation["ref"]["type"] not in type_to_model:
+                return False
+        elif (
+            not isinstance(operation["data"], dict)
+            or operation["data"]["type"] not in type_to_model
+        ):
+            return False
+
+    return True
+
+
+def containers(value, found):
+    if isinstance(value, (dict, list)):
+        found.append(value)
+        for item in value.values() if isinstance(value, dict) else value:
+            containers(item, found)
+
+    return found
+
+
+def mutate(body, rng: random.Random):
+    """
+    Changes, removes or adds a random member or item somewhere in `body`.
+    """
+
+    container = rng.choice(containers(body, []))
+    value = copy.deepcopy(rng.choice(VALUES))
+
+    if isinstance(container, dict):
+        keys = list(container.keys())
+        action = rng.randrange(3)
+
+        if action == 0 and keys:
+            del container[rng.choice(keys)]
+        elif action == 1 and keys:
+            container[rng.choice(keys)] = value
+        else:
+            member = rng.choice(["op", "ref", "data", "href", "type", "id", "foo"])
+            container[member] = value
+    elif container and rng.randrange(2):
+        container[rng.randrange(len(container))] = value
+    else:
+        container.append(value)
+
+
+def test_matches_schema():
+    rng = random.Random(20)
+    accepted = 0
+
+    for _ in range(5_000):
+        body = copy.deepcopy(rng.choice(BODIES))
+        for _ in range(rng.randint(1, 3)):
+            mutate(body, rng)
+
+        try:
+            validate_operations(body, type_to_model)
+        except ValidationError:
+            valid = False
+        else:
+            valid = True
+            accepted += 1
+
+        assert valid == reference_accepts(body), body
+
+    # Enough of the mutations are valid for the comparison to mean something
+    assert accepted > 500
+
+
+@pytest.mark.parametrize(
+    "operation, pointer",
+    [
+        ({"op": "add", "data": [{"type": "artist"}]}, "/atomic:operations/0/data"),
+        ({"op": "remove", "data": None}, "/atomic:operations/0/data"),
+        ({"op": "add", "data": {"type": "nope"}}, "/atomic:operations/0/data/type"),
+        (
+            {"op": "remove", "ref": {"type": "nope", "id": "1", "relationship": "x"}},
+            "/atomic:operations/0/ref/type",
+        ),
+    ],
+)
+def test_invalid_operation(client, operation, pointer):
+    response = client.post("/operations", json={"atomic:operations": [operation]})
+
+    assert response.status_code == 400
+    assert response.get_json()["errors"][0]["source"]["pointer"] == pointer
@@ -0,0 +1,75 @@
+import copy
+
+import pytest
+
+ILLUSTRATION = {
+    "op": "add",
+    "data": {"type": "illustration", "attributes": {"url": "u"}},
+}
+
+
+@pytest.fixture(autouse=True)
+def populated(client):
+    response = client.post(
+        "/operations", json={"atomic:operations": [ILLUSTRATION]}
+    )
+    assert response.status_code == 200, response.data
+
+
+@pytest.mark.parametrize("key, value", [("id", "99"), ("lid", "a")])
+@pytest.mark.parametrize(
+    "operation, pointer",
+    [
+        (
+            {"op": "update", "data": {"type": "artist", "attributes": {"name": "a"}}},
+            "/data",
+        ),
+        ({"op": "remove", "data": {"type": "artist"}}, "/data"),
+        (
+            {
+                "op": "add",
+                "ref": {"type": "user", "relationship": "followed_artists"},
+                "data": [],
+            },
+            "/ref",
+        ),
+        (
+            {
+                "op": "update",
+                "ref": {"type": "illustration", "id": "1", "relationship": "artist"},
+                "data": {"type": "artist"},
+            },
+            "/data",
+        ),
+        (
+            {
+                "op": "add",
+                "data": {
+                    "type": "illustration",
+                    "attributes": {"url": "u"},
+                    "relationships": {"artist": {"data": {"type": "artist"}}},
+                },
+            },
+            "/data/relationships/artist/data",
+        ),
+    ],
+)
+def test_unknown_resource(client, operation, pointer, key, value):
+    """
+    Identifiers pointing to no resource, by `id` or by `lid`, get an error
+    pointing to them.
+    """
+
+    # The identifier is the object at `pointer`
+    operation = copy.deepcopy(operation)
+    target = operation
+    for name in pointer.strip("/").split("/"):
+        target = target[name]
+    target[key] = value
+
+    response = client.post("/operations", json={"atomic:operations": [operation]})
+
+    assert response.status_code == 400
+    assert response.get_json()["errors"][0]["source"]["pointer"] == (
+        f"/atomic:operations/0{pointer}/{key}"
+    )
@@ -0,0 +1,215 @@
+import random
+
+import pytest
+
+import api
+import models
+from feed import change_feed
+from models import type_to_model
+from storage import DictStorage
+
+TYPES = ["artist", "illustration", "user"]
+
+QUERIES = ["", "?page[offset]=3&page[limit]=4", "?page[after]=5&page[limit]=4"]
+
+ATTRIBUTES = {
+    "artist": lambda i: {"name": f"n{i}"},
+    "illustration": lambda i: {"url": f"u{i}"},
+    "user": lambda i: {"username": f"u{i}", "email": f"e{i}"},
+}
+
+SEED = {
+    "atomic:operations": [
+        {
+            "op": "add",
+            "data": {"type": resource_type, "attributes": ATTRIBUTES[resource_type](i)},
+        }
+        for resource_type in TYPES
+        for i in range(12)
+    ]
+}
+
+
+def identifier(rng: random.Random, resource_type: str, lids: dict) -> dict:
+    if lids[resource_type] and rng.random() < 0.5:
+        return {"type": resource_type, "lid": rng.choice(lids[resource_type])}
+
+    return {"type": resource_type, "id": str(rng.randint(1, 14))}
+
+
+def random_body(rng: random.Random, size: int) -> dict:
+    """
+    Returns a body of `size` operations adding, updating and removing
+    resources, some of them pointing to resources added before them. Some
+    `lid`s are declared again, by a resource of the same type or another.
+    """
+
+    operations = []
+    lids = {resource_type: [] for resource_type in TYPES}
+    declared = []
+
+    for i in range(size):
+        resource_type = rng.choice(TYPES)
+        r = rng.random()
+
+        if r < 0.5:
+            data = {"type": resource_type, "attributes": ATTRIBUTES[resource_type](i)}
+            if rng.random() < 0.5:
+                if declared and rng.random() < 0.5:
+                    data["lid"] = rng.choice(declared)
+                else:
+                    data["lid"] = f"{resource_type}{i}"
+                    declared.append(data["lid"])
+
+                lids[resource_type].append(data["lid"])
+
+            if resource_type == "illustration" and rng.random() < 0.7:
+                data["relationships"] = {
+                    "artist": {"data": identifier(rng, "artist", lids)}
+                }
+            elif resource_type == "user" and rng.random() < 0.7:
+                artists = [identifier(rng, "artist", lids) for _ in range(2)]
+                data["relationships"] = {"followed_artists": {"data": artists}}
+
+            operations.append({"op": "add", "data": data})
+        elif r < 0.7 and resource_type == "illustration":
+            ref = dict(identifier(rng, resource_type, lids), relationship="artist")
+            linkage = identifier(rng, "artist", lids) if rng.random() < 0.8 else None
+            operations.append({"op": "update", "ref": ref, "data": linkage})
+        elif r < 0.7 and resource_type == "user":
+            ref = dict(
+                identifier(rng, resource_type, lids), relationship="followed_artists"
+            )
+            operations.append(
+                {
+                    "op": rng.choice(["add", "update", "remove"]),
+                    "ref": ref,
+                    "data": [identifier(rng, "artist", lids)],
+                }
+            )
+        elif r < 0.95:
+            data = dict(
+                identifier(rng, resource_type, lids),
+                attributes=ATTRIBUTES[resource_type](i),
+            )
+            operations.append({"op": "update", "data": data})
+        else:
+            data = identifier(rng, resource_type, lids)
+            operations.append({"op": "remove", "data": data})
+
+    return {"atomic:operations": operations}
+
+
+def observe(client, body: dict, scheduled: bool) -> list:
+    """
+    Applies `body` and returns what a client sees after it: the response or
+    the error, the batch in the change feed and every collection and
+    page, in order.
+    """
+
+    before = change_feed.last
+
+    try:
+        response = api.apply_operations(body, scheduled=scheduled)
+    except Exception as error:
+        response = (type(error), str(error))
+
+    batches, _ = change_feed.read(before, 10)
+    # The sequences differ between runs
+    changes = [batch.split(b'"operations":', 1)[1] for _, batch in batches]
+    observed = [response, changes]
+
+    for resource_type in TYPES:
+        for query in QUERIES:
+            observed.append(client.get(f"/{resource_type}s{query}").data)
+
+    observed.append(client.get("/bulk/export").data)
+
+    return observed
+
+
+def run(client, seed: int, scheduled: bool) -> list:
+    models.set_storage(DictStorage())
+    api.apply_operations(SEED)
+
+    rng = random.Random(seed)
+
+    return [
+        observe(client, random_body(rng, rng.randint(1, 25)), scheduled)
+        for _ in range(4)
+    ]
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_scheduled_matches_sequential(client, seed):
+    assert run(client, seed, True) == run(client, seed, False)
+
+
+def test_scheduled_lid_declared_again(client):
+    api.apply_operations(
+        {
+            "atomic:operations": [
+                {
+                    "op": "add",
+                    "data": {"type": "artist", "lid": "a", "attributes": {"name": "a"}},
+                },
+                {
+                    "op": "add",
+                    "data": {
+                        "type": "user",
+                        "attributes": {"username": "u", "email": "e"},
+                        "relationships": {
+                            "followed_artists": {
+                                "data": [{"type": "artist", "lid": "a"}]
+                            }
+                        },
+                    },
+                },
+                {
+                    "op": "add",
+                    "data": {"type": "artist", "lid": "a", "attributes": {"name": "b"}},
+                },
+            ]
+        },
+        scheduled=True,
+    )
+
+    user = type_to_model["user"].get("1")
+    assert user.related_ids("followed_artists") == ["1"]
+
+
+def test_scheduled_rows_in_primary_key_order(client):
+    api.apply_operations(
+        {
+            "atomic:operations": [
+                {
+                    "op": "add",
+                    "data": {"type": "artist", "lid": "a", "attributes": {"name": "a"}},
+                },
+                {
+                    "op": "add",
+                    "data": {
+                        "type": "illustration",
+                        "attributes": {"url": "a"},
+                        "relationships": {
+                            "artist": {"data": {"type": "artist", "lid": "a"}}
+                        },
+                    },
+                },
+                {
+                    "op": "add",
+                    "data": {"type": "illustration", "attributes": {"url": "b"}},
+                },
+            ]
+        },
+        scheduled=True,
+    )
+
+    assert [instance.id for instance in type_to_model["illustration"].iter()] == [
+        "1",
+        "2",
+    ]
+    assert client.get("/bulk/export").data.splitlines()[1:] == [
+        b'{"type":"illustration","id":"1","url":"a","artist":"1"}',
+        b'{"type":"illustration","id":"2","url":"b","artist":null}',
+    ]
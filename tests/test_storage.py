@@ -0,0 +1,172 @@
+import pytest
+
+import api
+import models
+from storage import SQLiteStorage
+from wal import DurableDictStorage
+
+QUERIES = [
+    "/artists",
+    "/artists/007",
+    "/artists?sort=-name",
+    "/artists?filter[name]=a",
+    "/artists?page[offset]=2&page[limit]=3",
+    "/artists?page[after]=4&page[limit]=3",
+    "/illustrations?filter[artist]=1&sort=url",
+    "/illustrations?sort=-url&page[limit]=4",
+    "/illustrations?include=artist&fields[artist]=name",
+    "/users?filter[followed_artists]=2",
+    "/users?filter[followed_artists]=5",
+    "/users?filter[followed_artists]=05",
+    "/users?sort=username,-email",
+    "/users/3?include=followed_artists",
+]
+
+
+def populate():
+    """
+    Adds artists, illustrations and users in several batches, then updates
+    and removes some of them, the removals cascading to the rows pointing to
+    them.
+    """
+
+    api.apply_operations(
+        {
+            "atomic:operations": [
+                {"op": "add", "data": {"type": "artist", "attributes": {"name": name}}}
+                for name in "xy"
+            ]
+        }
+    )
+
+    for i in range(1, 9):
+        api.apply_operations(
+            {
+                "atomic:operations": [
+                    {
+                        "op": "add",
+                        "data": {
+                            "type": "artist",
+                            "lid": "a",
+                            "attributes": {"name": "ab"[i % 2]},
+                        },
+                    },
+                    {
+                        "op": "add",
+                        "data": {
+                            "type": "illustration",
+                            "attributes": {"url": f"u{i % 3}"},
+                            "relationships": {
+                                "artist": {
+                                    "data": {"type": "artist", "id": str(i // 2 + 1)}
+                                }
+                            },
+                        },
+                    },
+                    {
+                        "op": "add",
+                        "data": {
+                            "type": "user",
+                            "attributes": {
+                                "username": f"u{i % 4}",
+                                "email": f"e{i}",
+                            },
+                            "relationships": {
+                                "followed_artists": {
+                                    "data": [
+                                        {"type": "artist", "lid": "a"},
+                                        {"type": "artist", "id": "2"},
+                                    ]
+                                }
+                            },
+                        },
+                    },
+                ]
+            }
+        )
+
+    api.apply_operations(
+        {
+            "atomic:operations": [
+                {"op": "remove", "data": {"type": "artist", "id": "2"}},
+                {"op": "remove", "data": {"type": "illustration", "id": "5"}},
+                {
+                    "op": "update",
+                    "data": {"type": "user", "id": "3", "attributes": {"email": "x"}},
+                },
+                {
+                    "op": "add",
+                    "ref": {
+                        "type": "user",
+                        "id": "3",
+                        "relationship": "followed_artists",
+                    },
+                    "data": [{"type": "artist", "id": "7"}],
+                },
+            ]
+        }
+    )
+
+
+def responses(client) -> list:
+    return [client.get(path).data for path in QUERIES + ["/bulk/export"]]
+
+
+def test_sqlite_matches_dict(client, tmp_path):
+    populate()
+    expected = responses(client)
+
+    models.set_storage(SQLiteStorage(str(tmp_path / "db.sqlite3")))
+    populate()
+
+    assert responses(client) == expected
+
+
+@pytest.mark.parametrize("snapshot", [False, True])
+def test_wal_recovery(client, tmp_path, snapshot):
+    storage = DurableDictStorage(str(tmp_path))
+    models.set_storage(storage)
+    populate()
+    if snapshot:
+        # Recovers from the snapshot and the log written after it
+        storage.snapshot()
+    api.apply_operations(
+        {"atomic:operations": [{"op": "remove", "data": {"type": "user", "id": "8"}}]}
+    )
+    expected = responses(client)
+    storage.close()
+
+    storage = DurableDictStorage(str(tmp_path))
+    models.set_storage(storage)
+
+    assert responses(client) == expected
+
+    # The IDs go on from the recovered rows
+    api.apply_operations(
+        {
+            "atomic:operations": [
+                {"op": "add", "data": {"type": "artist", "attributes": {"name": "c"}}}
+            ]
+        }
+    )
+    assert models.Artist.get("11").name == "c"
+    storage.close()
+
+
+def test_row_modified_in_place():
+    populate()
+
+    # Outside a transaction these are the committed rows themselves
+    artist = models.Artist.get("1")
+    artist.name = "z"
+    artist.save()
+    user = models.User.get("3")
+    user.followed_artists = [models.Artist.get("1")]
+    user.save()
+
+    assert [artist.id for artist in models.Artist.query({"name": "x"})] == []
+    assert [artist.id for artist in models.Artist.query({"name": "z"})] == ["1"]
+    by_name = [artist.id for artist in models.Artist.query(sort=[("name", False)])]
+    assert by_name == ["4", "6", "8", "10", "3", "5", "7", "9", "1"]
+    assert [user.id for user in models.User.query({"followed_artists": "7"})] == ["5"]
+    assert [user.id for user in models.User.query({"followed_artists": "1"})] == ["3"]
@@ -0,0 +1,118 @@
+import pytest
+
+import api
+from feed import change_feed
+from jsonapi_schema import ValidationError
+from models import Artist, User, atomic
+
+COLLECTIONS = ["/artists", "/illustrations", "/users?include=followed_artists"]
+
+
+def post(client, *operations, status=200):
+    response = client.post(
+        "/operations", json={"atomic:operations": list(operations)}
+    )
+    assert response.status_code == status, response.data
+
+    return response
+
+
+def state(client) -> list:
+    return [client.get(path).data for path in COLLECTIONS + ["/bulk/export"]]
+
+
+@pytest.fixture
+def populated(client):
+    post(
+        client,
+        {
+            "op": "add",
+            "data": {"type": "artist", "lid": "a", "attributes": {"name": "a"}},
+        },
+        {"op": "add", "data": {"type": "artist", "attributes": {"name": "b"}}},
+        {
+            "op": "add",
+            "data": {
+                "type": "illustration",
+                "attributes": {"url": "u"},
+                "relationships": {
+                    "artist": {"data": {"type": "artist", "lid": "a"}}
+                },
+            },
+        },
+        {
+            "op": "add",
+            "data": {
+                "type": "user",
+                "attributes": {"username": "u", "email": "e"},
+                "relationships": {
+                    "followed_artists": {
+                        "data": [
+                            {"type": "artist", "lid": "a"},
+                            {"type": "artist", "id": "2"},
+                        ]
+                    }
+                },
+            },
+        },
+    )
+
+
+# Changes every row before an operation that fails, removing the artist
+# cascades to the illustration and the user
+FAILING_BATCH = [
+    {
+        "op": "update",
+        "data": {"type": "artist", "id": "2", "attributes": {"name": "c"}},
+    },
+    {"op": "remove", "data": {"type": "artist", "id": "1"}},
+    {"op": "add", "data": {"type": "illustration", "attributes": {"url": "v"}}},
+    {
+        "op": "update",
+        "ref": {"type": "user", "id": "1", "relationship": "followed_artists"},
+        "data": [],
+    },
+    {
+        "op": "add",
+        "data": {"type": "user", "attributes": {"username": 1, "email": "e"}},
+    },
+]
+
+
+@pytest.mark.parametrize("scheduled", [True, False])
+def test_failing_batch_rolls_back(client, populated, scheduled):
+    before = state(client)
+    last = change_feed.last
+
+    with pytest.raises(ValidationError):
+        api.apply_operations(
+            {"atomic:operations": FAILING_BATCH}, scheduled=scheduled
+        )
+
+    assert state(client) == before
+    assert change_feed.last == last
+    # The reverse index of the storage is untouched too
+    assert [user.id for user in User.query({"followed_artists": "1"})] == ["1"]
+
+
+def test_failing_request_rolls_back(client, populated):
+    before = state(client)
+
+    response = post(client, *FAILING_BATCH, status=400)
+
+    assert response.json["errors"][0]["source"]["pointer"] == (
+        "/atomic:operations/4/data/attributes/username"
+    )
+    assert state(client) == before
+
+
+def test_failing_block_rolls_back(client, populated):
+    before = state(client)
+
+    with pytest.raises(RuntimeError):
+        with atomic():
+            Artist.get("1").delete()
+            Artist.get("2").delete()
+            raise RuntimeError
+
+    assert state(client) == before
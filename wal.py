@@ -0,0 +1,404 @@
+"""
+Durability for the in-memory storage: every committed transaction is
+appended to a write-ahead log before the request that made it returns, the
+tables are written to a snapshot from time to time, and on startup the
+latest snapshot is loaded and the log written after it is replayed.
+
+The directory holds numbered log segments and snapshots. `snapshot-<n>`
+has every row committed in the segments before `wal-<n>`, so once it's
+written those segments are deleted:
+
+    snapshot-00000003.ndjson
+    wal-00000003.log
+    wal-00000004.log
+
+Each log record is a committed transaction, framed by its length and CRC32
+so a record torn by a crash is detected and dropped on recovery. Snapshots
+use the NDJSON format of bulk.py.
+"""
+
+import contextlib
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+import typing
+import zlib
+
+from bulk import from_row, to_row
+from responses import encode
+from storage import Change, DictStorage
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+decode = orjson.loads if orjson is not None else json.loads
+
+# Length and CRC32 of the payload of a record
+HEADER = struct.Struct("<II")
+
+segment_name = re.compile(r"^(wal|snapshot)-(\d{8})\.(log|ndjson)$")
+
+
+def fsync_directory(path: str):
+    """
+    Makes the creation, renaming and removal of files in `path` durable.
+    """
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def iter_lines(path: str) -> typing.Iterator[bytes]:
+    """
+    Yields the lines of a file, mapping it in memory instead of reading it.
+    """
+
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return
+
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield from iter(data.readline, b"")
+
+
+def iter_records(path: str) -> typing.Tuple[typing.List[bytes], int]:
+    """
+    Returns the payloads of the complete records in a log segment and the
+    size of the segment up to the end of the last one.
+    """
+
+    records = []
+    end = 0
+
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return records, end
+
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            while end + HEADER.size <= len(data):
+                length, crc = HEADER.unpack_from(data, end)
+                start = end + HEADER.size
+
+                payload = data[start : start + length]
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    break
+
+                records.append(payload)
+                end = start + length
+
+    return records, end
+
+
+class WriteAheadLog:
+    """
+    Appends records to the current log segment. Records are written as soon
+    as they're appended, but made durable by `sync()`: the first thread that
+    needs to wait for its record calls `fsync()` for every record appended
+    until then, and the threads whose records were appended meanwhile wait
+    for it instead of syncing each (group commit).
+    """
+
+    def __init__(self, directory: str, number: int):
+        self.directory = directory
+        self.number = number
+        self.file = open(self.path(number), "ab")
+        fsync_directory(directory)
+
+        # Records appended and made durable, numbered from the start
+        self.written = 0
+        self.synced = 0
+        self.syncing = False
+        # Bytes appended since the last snapshot
+        self.size = 0
+        self.fsyncs = 0
+        self.condition = threading.Condition()
+
+    def path(self, number: int) -> str:
+        return os.path.join(self.directory, f"wal-{number:08d}.log")
+
+    def append(self, payload: bytes) -> int:
+        """
+        Appends a record, returns the position to pass to `sync()`.
+        """
+
+        with self.condition:
+            self.file.write(HEADER.pack(len(payload), zlib.crc32(payload)))
+            self.file.write(payload)
+            self.written += 1
+            self.size += HEADER.size + len(payload)
+
+            return self.written
+
+    def sync(self, position: int):
+        """
+        Waits until the records up to `position` are durable.
+        """
+
+        with self.condition:
+            while self.synced < position:
+                if self.syncing:
+                    self.condition.wait()
+                    continue
+
+                self.syncing = True
+                target = self.written
+                self.file.flush()
+                fd = self.file.fileno()
+
+                # Other threads can append while this one waits for the disk
+                self.condition.release()
+                try:
+                    os.fsync(fd)
+                finally:
+                    self.condition.acquire()
+                    self.syncing = False
+                    self.condition.notify_all()
+
+                self.synced = max(self.synced, target)
+                self.fsyncs += 1
+
+    def rotate(self) -> int:
+        """
+        Makes the current segment durable and starts a new one, returns the
+        number of the new segment.
+        """
+
+        with self.condition:
+            while self.syncing:
+                self.condition.wait()
+
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.synced = self.written
+            self.condition.notify_all()
+
+            self.number += 1
+            self.file = open(self.path(self.number), "ab")
+            fsync_directory(self.directory)
+            self.size = 0
+
+            return self.number
+
+    def close(self):
+        with self.condition:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.synced = self.written
+
+
+class DurableDictStorage(DictStorage):
+    """
+    A `DictStorage` that logs every committed transaction to a
+    `WriteAheadLog` in `directory` and recovers the rows from it on
+    `setup()`.
+
+    A transaction is logged while it's applied, but its `transaction()`
+    block only waits for the log to be durable after releasing
+    `transaction_lock`, so the next transaction can run meanwhile and share
+    the same `fsync()`. A snapshot is written in the background once
+    `snapshot_size` bytes have been logged since the last one.
+    """
+
+    def __init__(self, directory: str, snapshot_size: int = 64 * 1024 * 1024):
+        super().__init__()
+        self.directory = directory
+        self.snapshot_size = snapshot_size
+        self.log: WriteAheadLog | None = None
+        self.snapshot_lock = threading.Lock()
+        self.snapshot_thread: threading.Thread | None = None
+        # Transactions of each thread: nesting depth and log position
+        self.local = threading.local()
+
+    def files(self) -> typing.Dict[str, typing.List[int]]:
+        """
+        Returns the numbers of the segments and snapshots in the directory,
+        in ascending order.
+        """
+
+        files = {"wal": [], "snapshot": []}
+
+        for name in os.listdir(self.directory):
+            match = segment_name.match(name)
+            if match is not None:
+                files[match[1]].append(int(match[2]))
+
+        return {kind: sorted(numbers) for kind, numbers in files.items()}
+
+    def setup(self, models: typing.Collection[type]):
+        os.makedirs(self.directory, exist_ok=True)
+
+        super().setup(models)
+        number = self.recover()
+        self.log = WriteAheadLog(self.directory, number)
+        self.rebuild_indexes()
+
+    def recover(self) -> int:
+        """
+        Loads the latest snapshot and replays the log segments after it into
+        the tables, without updating the indexes. Returns the number of the
+        segment to log to next.
+        """
+
+        models = {model.Meta.resource_name: model for model in self.models}
+        files = self.files()
+        snapshot = files["snapshot"][-1] if files["snapshot"] else 0
+
+        if snapshot:
+            path = os.path.join(self.directory, f"snapshot-{snapshot:08d}.ndjson")
+
+            for line in iter_lines(path):
+                row = decode(line)
+                model = models[row["type"]]
+                self.tables[row["type"]][row["id"]] = from_row(model, row)
+
+        for number in files["wal"]:
+            if number < snapshot:
+                continue
+
+            path = os.path.join(self.directory, f"wal-{number:08d}.log")
+            records, end = iter_records(path)
+
+            for payload in records:
+                for resource_name, pk, row in decode(payload):
+                    if row is None:
+                        self.tables[resource_name].pop(pk, None)
+                    else:
+                        self.tables[resource_name][pk] = from_row(
+                            models[resource_name], row
+                        )
+
+            # Drop a torn record, it was never acknowledged
+            if end < os.path.getsize(path):
+                os.truncate(path, end)
+
+        return max([snapshot, *files["wal"]]) + 1
+
+    @contextlib.contextmanager
+    def transaction(self) -> typing.Iterator[None]:
+        depth = getattr(self.local, "depth", 0)
+        self.local.depth = depth + 1
+
+        try:
+            with self.transaction_lock:
+                yield
+        finally:
+            self.local.depth = depth
+
+        if depth == 0:
+            self.sync()
+
+    def sync(self):
+        """
+        Waits until the transactions of the thread are durable.
+        """
+
+        position = getattr(self.local, "position", 0)
+
+        if position:
+            self.local.position = 0
+            self.log.sync(position)
+
+        if self.log.size >= self.snapshot_size:
+            self.start_snapshot()
+
+    def log_changes(self, changes: typing.List[Change]):
+        payload = encode(
+            [
+                [
+                    model.Meta.resource_name,
+                    pk,
+                    None if instance is None else to_row(instance),
+                ]
+                for model, pk, instance in changes
+            ]
+        )
+        self.local.position = self.log.append(payload)
+
+    def write(self, changes: typing.Iterable[Change]):
+        changes = list(changes)
+
+        with self.transaction_lock:
+            self.log_changes(changes)
+            super().write(changes)
+
+        if getattr(self.local, "depth", 0) == 0:
+            self.sync()
+
+    def load(self, instances: typing.Iterable):
+        instances = list(instances)
+
+        with self.transaction_lock:
+            self.log_changes(
+                [(type(instance), instance.id, instance) for instance in instances]
+            )
+            super().load(instances)
+
+    def start_snapshot(self):
+        """
+        Writes a snapshot in a background thread, unless one is being
+        written already.
+        """
+
+        if self.snapshot_lock.locked():
+            return
+
+        self.snapshot_thread = threading.Thread(target=self.snapshot, daemon=True)
+        self.snapshot_thread.start()
+
+    def snapshot(self):
+        """
+        Writes the rows committed so far to a snapshot and deletes the log
+        segments and snapshots it replaces.
+        """
+
+        if not self.snapshot_lock.acquire(blocking=False):
+            return
+
+        try:
+            with self.transaction_lock:
+                number = self.log.rotate()
+                # Rows are never modified once written, references will do
+                rows = [
+                    instance
+                    for table in self.tables.values()
+                    for instance in list(table.values())
+                ]
+
+            path = os.path.join(self.directory, f"snapshot-{number:08d}.ndjson")
+
+            with open(f"{path}.tmp", "wb") as file:
+                file.writelines(encode(to_row(instance)) + b"\n" for instance in rows)
+                file.flush()
+                os.fsync(file.fileno())
+
+            os.replace(f"{path}.tmp", path)
+            fsync_directory(self.directory)
+
+            files = self.files()
+            for kind, extension in [("wal", "log"), ("snapshot", "ndjson")]:
+                for old in files[kind]:
+                    if old < number:
+                        name = f"{kind}-{old:08d}.{extension}"
+                        os.remove(os.path.join(self.directory, name))
+        finally:
+            self.snapshot_lock.release()
+
+    def close(self):
+        """
+        Waits for a snapshot being written and closes the log.
+        """
+
+        if self.snapshot_thread is not None:
+            self.snapshot_thread.join()
+
+        self.log.close()